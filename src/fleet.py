@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+DATADIR = '.novel'
+
+def find_projects(root):
+    """
+    @brief Every makenovel project under `root`, i.e. every directory with a
+        `.novel/` directory in it. Projects are not searched for further
+        projects, and hidden directories are skipped.
+
+    :returns: generator of absolute project paths, in sorted order
+    """
+    root = os.path.abspath(root)
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        if DATADIR in dirnames:
+            dirnames[:] = []
+            yield dirpath
+            continue
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+
+def op_stats(novel):
+    from records import novel_record
+    return novel_record(novel)
+
+def op_words(novel):
+    tree = novel.part_tree()
+    tree.rollup()
+    parts = {}
+    for (part, depth) in tree.walk():
+        parts[tree.tag(part)] = list(tree.total(part))
+    plotlines = {}
+    for plotline in novel.plotlines:
+        plotlines[plotline.tag] = list(tree.total(plotline))
+    (words, chars) = (0, 0)
+    for chapter in novel.chapters:
+        (w, c) = tree.count(chapter)
+        (words, chars) = (words + w, chars + c)
+    return {
+        'words': words,
+        'characters': chars,
+        'parts': parts,
+        'plotlines': plotlines,
+        }
+
+def op_bind(novel):
+    version = novel.bind(workers=1)
+    return {
+        'version': novel.versions.index(version) + 1,
+        'outputs': list(version.outputs),
+        }
+
+def op_fsck(novel):
+    from fsck import check
+    problems = check(novel, workers=1)
+    return {
+        'problems': len(problems),
+        'details': [repr(p) for p in problems],
+        }
+
+# Operations that write to the project take its lock, like the makenovel
+# commands in `WRITE_COMMANDS`.
+OPERATIONS = {
+    'stats': (op_stats, False),
+    'words': (op_words, False),
+    'bind': (op_bind, True),
+    'fsck': (op_fsck, False),
+}
+
+def run_project(proj_path, op):
+    """
+    @brief Run one operation on one project. Runs in a pool worker.
+
+    :returns: The project's record; errors are reported in it, not raised
+    """
+    from models import Novel, NovelEnvironment, ProjectLock
+    from postedit import PostEditQueue
+
+    (func, writes) = OPERATIONS[op]
+    record = {'project': proj_path, 'op': op}
+    start = time.time()
+    currdir = os.path.abspath('.')
+    try:
+        os.chdir(proj_path)
+        if writes:
+            env = NovelEnvironment.load(proj_path)
+            # Before taking the lock: the post-edit worker needs it.
+            PostEditQueue(env).wait()
+            lock = ProjectLock(env)
+            with lock:
+                record.update(func(Novel.load(proj_path, lock=lock)))
+        else:
+            record.update(func(Novel.load(proj_path)))
+        record['ok'] = True
+    except Exception as e:
+        logger.info("%s: %s failed: %s" % (proj_path, op, e))
+        record['ok'] = False
+        record['error'] = str(e) or e.__class__.__name__
+    finally:
+        os.chdir(currdir)
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+def run_fleet(root, op, jobs=None, out=sys.stdout):
+    """
+    @brief Run `op` on every project under `root` in a process pool, and
+        write one NDJSON record per project as soon as it finishes.
+
+    :param jobs: Number of worker processes. Defaults to the CPU count.
+    :type jobs: int
+
+    :returns: The number of projects that failed
+    """
+    if op not in OPERATIONS:
+        raise RuntimeError("%s: unknown operation (choose from %s)" % (
+            op, ', '.join(sorted(OPERATIONS))))
+    root = os.path.abspath(root)
+    projects = list(find_projects(root))
+    logger.info("%d projects under %s" % (len(projects), root))
+    failed = 0
+    if not projects:
+        return failed
+    jobs = min(jobs or os.cpu_count() or 1, len(projects))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_project, p, op) for p in projects]
+        for future in as_completed(futures):
+            record = future.result()
+            record['project'] = os.path.relpath(record['project'], root)
+            if not record['ok']:
+                failed += 1
+            out.write(json.dumps(record))
+            out.write('\n')
+            out.flush()
+    return failed
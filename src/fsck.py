@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+import os
+import re
+import shutil
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from models import Novel, Manifest, blob_hash
+
+logger = logging.getLogger(__name__)
+
+LOST_FOUND = 'lost+found'
+
+class Problem(object):
+    """
+    @brief Something `check` found wrong with a project.
+
+    `fix`, if set, repairs it; several problems may share one fix, which
+    `repair` then runs once.
+    """
+
+    def __init__(self, kind, path, message, fix=None):
+        self.kind = kind
+        self.path = path
+        self.message = message
+        self.fix = fix
+        self.repaired = False
+
+    def __repr__(self):
+        return "%-8s %s: %s" % (self.kind, self.path, self.message)
+
+def load(proj_path=None, lock=None):
+    """
+    @brief Load a project for checking.
+
+    :returns: (novel, problems); novel is None if the data files cannot be
+        loaded, and problems then says why.
+    """
+    try:
+        return (Novel.load(proj_path, lock=lock), [])
+    except (RuntimeError, ValueError) as e:
+        return (None, [Problem('table', os.path.join('.novel', '*.csv'),
+                               str(e))])
+
+def _git(novel, args, stdin=None):
+    CMD = [novel.get_config('git.path'), '-C', novel.env.proj_path] + args
+    logger.info("[shell] %s" % ' '.join(CMD))
+    return subprocess.run(CMD, input=stdin, stdout=subprocess.PIPE,
+                          universal_newlines=True, check=True).stdout
+
+def _git_objects(novel, rels, orphan_rels, objects):
+    """
+    @brief Everything asked of git, in as few commands as possible: the
+        committed blob of each chapter, which orphans are tracked, and which
+        of `objects` (plus those blobs) are in the object database.
+    """
+    head = {}
+    tracked = set()
+    if _has_head(novel):
+        wanted = set(rels)
+        out = _git(novel, ['-c', 'core.quotepath=off', 'ls-tree', '-r',
+                           'HEAD'])
+        for line in out.splitlines():
+            (meta, path) = line.split('\t', 1)
+            if path in wanted:
+                head[path] = meta.split()[2]
+    if orphan_rels:
+        out = _git(novel, ['-c', 'core.quotepath=off', 'ls-files', '--'] +
+                   orphan_rels)
+        tracked = set(out.splitlines())
+    ids = sorted(set(objects) | set(head.values()))
+    present = set()
+    if ids:
+        out = _git(novel, ['cat-file', '--batch-check'],
+                   stdin=''.join('%s\n' % i for i in ids))
+        # One line per id, in order; ids may be abbreviated.
+        for (i, line) in zip(ids, out.splitlines()):
+            if len(line.split()) == 3:
+                present.add(i)
+    return (head, tracked, present)
+
+def _has_head(novel):
+    try:
+        _git(novel, ['rev-parse', '--verify', '-q', 'HEAD'])
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+def find_orphans(novel):
+    """
+    @brief Files that look like chapters but are in no row of chapters.csv:
+        left behind by renames or copies, or by a crash in the middle of
+        renumbering.
+
+    :returns: list of absolute paths
+    """
+    proj_path = novel.env.proj_path
+    ext = novel.get_config('chapter.ext')
+    pattern = re.compile(r'^\d+(__.*)?\.%s(\.renumber-\d+)?$' % re.escape(ext))
+    known = set(c.path for c in novel.chapters)
+    dirs = [proj_path] + [os.path.join(proj_path, p.tag)
+                          for p in novel.plotlines]
+    orphans = []
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for name in sorted(os.listdir(d)):
+            path = os.path.join(d, name)
+            if pattern.match(name) and path not in known and \
+                    os.path.isfile(path):
+                orphans.append(path)
+    return orphans
+
+def check(novel, workers=None):
+    """
+    @brief Check the data files against the working tree and the git object
+        database, in one pass.
+
+    Chapter files are hashed in a thread pool while git is asked about the
+    objects the project refers to: the commits of versions and drafts, the
+    blobs of bound manifests and of committed chapters.
+
+    :param workers: Number of threads. Defaults to the CPU count.
+    :type workers: int
+
+    :returns: list of Problem, in the order `repair` should fix them
+    """
+    proj_path = novel.env.proj_path
+    ext = novel.get_config('chapter.ext')
+
+    def rel(path):
+        return os.path.relpath(path, proj_path)
+
+    # Tables
+    table = []
+    seen = {}
+    for chapter in novel.chapters:
+        if chapter.path in seen:
+            table.append(Problem('table', rel(chapter.path),
+                                 "listed for both %s and %s" % (
+                                     seen[chapter.path].tag, chapter.tag)))
+        seen[chapter.path] = chapter
+    misnamed = [c for c in novel.chapters
+                if os.path.basename(c.path) != '%s.%s' % (c.tag, ext)]
+    if misnamed and len(seen) == len(novel.chapters):
+        renumber = _rename(novel, misnamed)
+        for chapter in misnamed:
+            table.append(Problem('table', rel(chapter.path),
+                                 "file name does not match tag %s" %
+                                 chapter.tag, renumber))
+    manifests = {}
+    objects = set()
+    for version in novel.versions + novel.drafts:
+        if version.git_hash:
+            objects.add(version.git_hash)
+        if version.manifest and version.manifest not in manifests:
+            try:
+                manifests[version.manifest] = Manifest.load(novel,
+                                                            version.manifest)
+            except RuntimeError as e:
+                manifests[version.manifest] = None
+                table.append(Problem('table', version.path, str(e)))
+    for manifest in manifests.values():
+        for node in (manifest.nodes if manifest else []):
+            if node.blob:
+                objects.add(node.blob)
+
+    # Hash the files while git checks the objects.
+    orphans = find_orphans(novel)
+    files = [c.path for c in novel.chapters if os.path.exists(c.path)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        git = pool.submit(_git_objects, novel,
+                          [rel(c.path) for c in novel.chapters],
+                          [rel(p) for p in orphans], objects)
+        hashes = dict(zip(files + orphans,
+                          pool.map(blob_hash, files + orphans)))
+        (head, tracked, present) = git.result()
+    by_hash = {}
+    for chapter in novel.chapters:
+        if chapter.path in hashes:
+            by_hash.setdefault(hashes[chapter.path], chapter)
+
+    # Git objects
+    problems = []
+    for version in novel.versions + novel.drafts:
+        if version.git_hash and version.git_hash not in present:
+            problems.append(Problem('object', version.path,
+                                    "commit %s is missing" % version.git_hash))
+    blobs = set(head.values())
+    for manifest in manifests.values():
+        for node in (manifest.nodes if manifest else []):
+            if node.blob:
+                blobs.add(node.blob)
+    files_by_hash = dict((h, p) for (p, h) in hashes.items())
+    for blob in sorted(blobs - present):
+        source = files_by_hash.get(blob)
+        fix = None
+        if source is not None:
+            fix = _restore_object(novel, source)
+        problems.append(Problem('object', blob, "blob is missing%s" % (
+            " (a copy is in %s)" % rel(source) if source else ''), fix))
+
+    # Files
+    for chapter in novel.chapters:
+        if os.path.exists(chapter.path):
+            continue
+        r = rel(chapter.path)
+        fix = None
+        if head.get(r) in present:
+            fix = _checkout(novel, r)
+        problems.append(Problem('missing', r, "chapter %s has no file%s" % (
+            chapter.tag, " (it is in HEAD)" if fix else ''), fix))
+    for path in orphans:
+        original = by_hash.get(hashes[path])
+        if original is not None:
+            problems.append(Problem('orphan', rel(path),
+                                    "copy of %s" % original.tag,
+                                    _remove(novel, path, rel(path) in tracked)))
+        else:
+            problems.append(Problem('orphan', rel(path),
+                                    "not in chapters.csv",
+                                    _lose(novel, path, rel(path) in tracked)))
+    return problems + table
+
+def _rename(novel, chapters):
+    def fix():
+        # The tags are right but the files are not; forget the tags so that
+        # renumbering moves the files to match.
+        for chapter in chapters:
+            chapter.tag = None
+        novel.renumber_chapters("fsck: rename %d chapters" % len(chapters))
+    return fix
+
+def _restore_object(novel, path):
+    def fix():
+        _git(novel, ['hash-object', '-w', '--', path])
+    return fix
+
+def _checkout(novel, rel):
+    def fix():
+        _git(novel, ['checkout', 'HEAD', '--', rel])
+    return fix
+
+def _untrack(novel, path, tracked):
+    if tracked:
+        _git(novel, ['rm', '-q', '--cached', '--',
+                     os.path.relpath(path, novel.env.proj_path)])
+        return True
+    return False
+
+def _remove(novel, path, tracked):
+    def fix():
+        changed = _untrack(novel, path, tracked)
+        os.remove(path)
+        return changed
+    return fix
+
+def _lose(novel, path, tracked):
+    def fix():
+        changed = _untrack(novel, path, tracked)
+        dest = os.path.join(novel.env.local_path(LOST_FOUND),
+                            os.path.relpath(path, novel.env.proj_path))
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(path, dest)
+        return changed
+    return fix
+
+def repair(novel, problems):
+    """
+    @brief Fix what can be fixed, and commit any change to the tracked
+        files at the end.
+
+    Orphans go to `.novel/lost+found/` unless they are copies of a chapter;
+    missing chapters and objects are restored from HEAD or from a file with
+    the same contents; misnamed chapters are renumbered.
+
+    :returns: The number of problems repaired
+    """
+    done = {}
+    changed = False
+    for problem in problems:
+        if problem.fix is None:
+            continue
+        if problem.fix not in done:
+            done[problem.fix] = True
+            changed = problem.fix() is True or changed
+        problem.repaired = True
+    if changed:
+        novel.git_commit_files([novel.env.chapters_path],
+                               "fsck: repair %d problems" % len(done))
+    return len([p for p in problems if p.repaired])
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import os
+import csv
+import datetime
+import subprocess
+import logging
+
+logger = logging.getLogger(__name__)
+
+COMMIT_MARK = '\x00'
+
+class WordHistory(object):
+    """
+    @brief Words added and removed per commit and chapter file, read from a
+        single `git log --word-diff` stream.
+
+    Results are cached in `.novel/history` by commit hash. Later runs only
+    ask git for commits made since the cached head, plus the full history of
+    chapter directories the cache has not seen yet. Renames are followed, so
+    the words of a renumbered or moved chapter stay with it.
+    """
+
+    FORMAT = '2'
+
+    def __init__(self, novel):
+        self.novel = novel
+        self.cache_path = novel.env.local_path('history')
+        self.head = None
+        # Pathspecs scanned so far
+        self.paths = set()
+        # (commit hash, unix time, current path, words added, words removed)
+        self.deltas = []
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path) as cache_file:
+            rows = list(csv.reader(cache_file))
+        if not rows or rows[0] != ['format', self.FORMAT]:
+            logger.info("%s: old cache format; rebuilding" % self.cache_path)
+            return
+        for row in rows[1:]:
+            if row[0] == 'head':
+                self.head = row[1]
+            elif row[0] == 'path':
+                self.paths.add(row[1])
+            elif row[0] == 'delta':
+                self.deltas.append((row[1], int(row[2]), row[3],
+                                    int(row[4]), int(row[5])))
+
+    def save(self):
+        with open(self.cache_path, 'w') as cache_file:
+            writer = csv.writer(cache_file)
+            writer.writerow(['format', self.FORMAT])
+            writer.writerow(['head', self.head])
+            for p in sorted(self.paths):
+                writer.writerow(['path', p])
+            for d in self.deltas:
+                writer.writerow(['delta'] + list(d))
+
+    def _git(self, *args):
+        return [self.novel.get_config('git.path'),
+                '-C', self.novel.env.proj_path,
+                '-c', 'core.quotepath=off'] + list(args)
+
+    def _resolve(self, rev):
+        proc = subprocess.run(self._git('rev-parse', '--verify', '-q',
+                                        '%s^{commit}' % rev),
+                              stdout=subprocess.PIPE, universal_newlines=True)
+        return proc.stdout.strip() or None
+
+    def _specs(self):
+        # Whole chapter directories rather than single files: git only
+        # detects a rename when both names match the pathspec.
+        proj_path = self.novel.env.proj_path
+        ext = self.novel.get_config('chapter.ext')
+        specs = set()
+        for chapter in self.novel.chapters:
+            rel = os.path.relpath(chapter.path, proj_path)
+            if os.path.dirname(rel):
+                specs.add('%s/*.%s' % (os.path.dirname(rel), ext))
+            else:
+                specs.add(rel)
+        return specs
+
+    def _scan(self, revs, paths):
+        """
+        @brief Stream `git log -p -M --word-diff=porcelain`.
+
+        :returns: generator of (commit, unix time, {path: [added, removed]},
+            [(old path, new path)]) per commit, newest first, with the paths
+            as they were in that commit
+        """
+        CMD = self._git('log', '--no-merges', '--format=%x00%H %at', '-p',
+                        '-M', '--word-diff=porcelain', '--no-color', *revs)
+        logger.info("[shell] %s -- <%d paths>" % (' '.join(CMD), len(paths)))
+        CMD += ['--'] + sorted(paths)
+        proc = subprocess.Popen(CMD, stdout=subprocess.PIPE,
+                                universal_newlines=True, errors='replace')
+        (commit, when, path, in_hunk) = (None, 0, None, False)
+        (counts, renames) = ({}, [])
+
+        for line in proc.stdout:
+            if line.startswith(COMMIT_MARK):
+                if commit is not None:
+                    yield (commit, when, counts, renames)
+                (counts, renames) = ({}, [])
+                (commit, when) = line[1:].split()
+                when = int(when)
+                continue
+            if line.startswith('diff --git '):
+                (path, in_hunk) = (None, False)
+            elif not in_hunk:
+                if line.startswith('rename from '):
+                    renames.append([line[12:].rstrip('\n'), None])
+                elif line.startswith('rename to '):
+                    renames[-1][1] = line[10:].rstrip('\n')
+                elif line.startswith('--- a/'):
+                    path = line[6:].rstrip('\n')
+                elif line.startswith('+++ b/'):
+                    path = line[6:].rstrip('\n')
+                elif line.startswith('@@'):
+                    in_hunk = True
+            elif path and line[:1] in ('+', '-'):
+                c = counts.setdefault(path, [0, 0])
+                c[0 if line[0] == '+' else 1] += len(line[1:].split())
+            elif line.startswith('@@'):
+                in_hunk = True
+        if commit is not None:
+            yield (commit, when, counts, renames)
+        proc.wait()
+
+    def _read(self, revs, paths):
+        """
+        @brief Scan `revs` and return their deltas under the names the files
+            have at the newest of them.
+
+        :returns: (deltas, commits with deltas, {old path: newest path}) --
+            the last maps older deltas through the renames found
+        """
+        (deltas, seen, names) = ([], set(), {})
+        for (commit, when, counts, renames) in self._scan(revs, paths):
+            for (p, (added, removed)) in counts.items():
+                if added or removed:
+                    seen.add(commit)
+                    deltas.append((commit, when, names.get(p, p), added,
+                                   removed))
+            # Before this commit the files had their old names. A renumber
+            # renames many files at once (2 -> 3, 3 -> 4...), so map them
+            # all through the names as they were after it.
+            moved = [(old, names.get(new, new)) for (old, new) in renames]
+            for (old, new) in renames:
+                names.pop(new, None)
+            names.update(moved)
+        return (deltas, seen, names)
+
+    def update(self):
+        """
+        @brief Bring the cache up to date with HEAD and the current chapters.
+
+        :returns: number of commits read from git
+        """
+        self.load()
+        if self.head and self._resolve(self.head) is None:
+            logger.info("history cache head %s is gone; rebuilding" % self.head)
+            (self.head, self.paths, self.deltas) = (None, set(), [])
+        paths = self._specs()
+        head = self._resolve('HEAD')
+        seen = set()
+        if head is None or not paths:
+            return 0
+
+        new_paths = paths - self.paths
+        if self.head and new_paths:
+            # Paths we have not seen before need their older history too.
+            (deltas, commits, names) = self._read([self.head], new_paths)
+            self.deltas += deltas
+            seen |= commits
+        if self.head and self.head != head:
+            (deltas, commits, names) = self._read(
+                ['%s..%s' % (self.head, head)], paths | self.paths)
+            self.deltas = [(c, w, names.get(p, p), a, r)
+                           for (c, w, p, a, r) in self.deltas] + deltas
+            seen |= commits
+        elif not self.head:
+            (deltas, commits, names) = self._read([head], paths)
+            self.deltas += deltas
+            seen |= commits
+
+        self.head = head
+        self.paths |= paths
+        self.save()
+        return len(seen)
+
+    def by_day(self):
+        """
+        :returns: sorted list of (date, words added, words removed)
+        """
+        days = {}
+        for (commit, when, path, added, removed) in self.deltas:
+            day = datetime.date.fromtimestamp(when)
+            d = days.setdefault(day, [0, 0])
+            d[0] += added
+            d[1] += removed
+        return [(day, a, r) for (day, (a, r)) in sorted(days.items())]
+
+    def by_path(self):
+        """
+        :returns: dict of path => [words added, words removed]
+        """
+        paths = {}
+        for (commit, when, path, added, removed) in self.deltas:
+            p = paths.setdefault(path, [0, 0])
+            p[0] += added
+            p[1] += removed
+        return paths
@@ -11,8 +11,19 @@ import argparse
 import csv
 import subprocess
 import textwrap
+import re
+import glob
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from models import *
+from renderers import RENDERERS
+from records import FORMATS, RECORDS, novel_record, write_records
+from watch import watch
+from history import WordHistory
+from search import SearchIndex
+from postedit import PostEditQueue
+import worddiff
 
 PROJDIR = os.path.abspath('.')
 DATADIR = os.path.join(PROJDIR, '.novel')
@@ -46,6 +57,8 @@ parser_config.set_defaults(which='config')
 parser_list = subparsers.add_parser('list')
 parser_list.add_argument('object', choices=[
     'plotlines', 'parts', 'chapters', 'versions', 'drafts'])
+parser_list.add_argument('-f', '--format', default='text', choices=FORMATS,
+    help="Output format; json, ndjson and csv use a fixed schema per object")
 parser_list.set_defaults(which='list')
 
 ### "show" subparser ###
@@ -57,6 +70,8 @@ parser_show.add_argument('object',
 parser_show.add_argument('-tag', '--tag',
     help="Tag to show (not required for `show novel`)", 
     required=False)
+parser_show.add_argument('-f', '--format', default='text', choices=FORMATS,
+    help="Output format; json, ndjson and csv use a fixed schema per object")
 parser_show.set_defaults(which='show')
 
 
@@ -150,6 +165,22 @@ chapter_order.add_argument('-a', '--after', nargs=1,
     metavar='chapter_tag',
     help='update this chapter after `chapter_tag`')
 
+### "move" subparser ###
+parser_move = subparsers.add_parser('move')
+parser_move.add_argument('object', choices=('chapters', 'parts'))
+parser_move.add_argument('tags', nargs='*',
+    help='Tags of the chapters or parts to move')
+parser_move.add_argument('-r', '--range', nargs=2, metavar=('FIRST', 'LAST'),
+    help='Move every chapter or part from FIRST to LAST')
+move_order = parser_move.add_mutually_exclusive_group()
+move_order.add_argument('-b', '--before', metavar='TAG',
+    help='Put them before `TAG`')
+move_order.add_argument('-a', '--after', metavar='TAG',
+    help='Put them after `TAG`')
+parser_move.add_argument('-i', '--into', metavar='PART_TAG',
+    help='Chapters: put them in this part. Parts: put them below this part')
+parser_move.set_defaults(which='move')
+
 ### "update version" subparser ###
 parser_update_version = subparsers_update.add_parser('version')
 parser_update_version.add_argument('-t', '--tag')
@@ -193,8 +224,89 @@ parser_bind.add_argument('-s', '--stage', type=str,
                          help="If you're creating a draft, what type of draft?")
 parser_bind.add_argument('-c', '--comment', type=str,
                          help="A long description of this version.")
+parser_bind.add_argument('-f', '--format', action='append',
+                         choices=sorted(RENDERERS.keys()),
+                         help="Output format; repeat for several formats " +
+                         "(default: native)")
+parser_bind.add_argument('-j', '--jobs', type=int,
+                         help="Processes used for CPU-heavy formats " +
+                         "(default: the `bind.workers` setting)")
 parser_bind.set_defaults(which='bind')
 
+### "flush" subparser
+parser_flush = subparsers.add_parser('flush',
+    help="Commit queued changes now (see git.commit_interval)")
+parser_flush.set_defaults(which='flush')
+
+### "watch" subparser
+parser_watch = subparsers.add_parser('watch')
+parser_watch.add_argument('--poll', action='store_true',
+                          help="Poll with stat instead of using inotify")
+parser_watch.add_argument('-d', '--debounce', type=float, default=0.5,
+                          help="Seconds of quiet before counts are updated")
+parser_watch.add_argument('-i', '--interval', type=float, default=1.0,
+                          help="Polling interval in seconds")
+parser_watch.set_defaults(which='watch')
+
+### "history" subparser
+parser_history = subparsers.add_parser('history')
+parser_history.add_argument('-b', '--by', default='day',
+                            choices=('day', 'chapter'),
+                            help="Group word counts by day (default) or chapter")
+parser_history.set_defaults(which='history')
+
+### "search" subparser
+parser_search = subparsers.add_parser('search')
+parser_search.add_argument('query', nargs='+',
+                           help='Words to find; quote a phrase to match it exactly')
+parser_search.set_defaults(which='search')
+
+### "diff" subparser
+parser_diff = subparsers.add_parser('diff')
+parser_diff.add_argument('old', help="Version number (or dN for a draft)")
+parser_diff.add_argument('new', help="Version number (or dN for a draft)")
+parser_diff.add_argument('-f', '--format', default='text',
+                         choices=('text', 'html'))
+parser_diff.add_argument('-C', '--context', type=int, default=5,
+                         help="Words of context around each change")
+parser_diff.set_defaults(which='diff')
+
+### "status" subparser
+parser_status = subparsers.add_parser('status')
+parser_status.add_argument('-f', '--format', choices=FORMATS, default='text',
+                           help="Output format")
+parser_status.set_defaults(which='status')
+
+### "changes" subparser
+parser_changes = subparsers.add_parser('changes')
+parser_changes.add_argument('-s', '--since', required=True,
+                            help="Version number (or dN for a draft)")
+parser_changes.set_defaults(which='changes')
+
+### "archive" subparser
+parser_archive = subparsers.add_parser('archive')
+parser_archive.add_argument('-a', '--age', type=float,
+                            help="Archive versions older than this many days " +
+                            "(default: the `archive.age` setting)")
+parser_archive.set_defaults(which='archive')
+
+### "export" subparser
+parser_export = subparsers.add_parser('export')
+parser_export.add_argument('version', help="Version number (or dN for a draft)")
+parser_export.add_argument('-f', '--format', choices=sorted(RENDERERS.keys()),
+                           help="Output format (default: the first one bound)")
+parser_export.add_argument('-o', '--output',
+                           help="Copy the bound file here")
+parser_export.set_defaults(which='export')
+
+### "fsck" subparser
+parser_fsck = subparsers.add_parser('fsck')
+parser_fsck.add_argument('-r', '--repair', action='store_true',
+                         help="Fix what can be fixed, in one commit")
+parser_fsck.add_argument('-j', '--jobs', type=int,
+                         help="Files to hash at once (default: CPU count)")
+parser_fsck.set_defaults(which='fsck')
+
 ### "import" subparser
 parser_import = subparsers.add_parser("import")
 parser_import.set_defaults(which='import')
@@ -223,6 +335,50 @@ chapter_import_order.add_argument('-a', '--after', nargs=1,
     metavar='CHAPTER',
     help='update this chapter after `CHAPTER`')
 
+### IMPORT MANUSCRIPT
+parser_import_manuscript = subparsers_import.add_parser('manuscript')
+parser_import_manuscript.add_argument("path",
+    help="Single-file manuscript to split into chapters.")
+parser_import_manuscript.add_argument("-P", "--plotline",
+    help="Plotline tag for the new chapters",
+    required=True)
+parser_import_manuscript.add_argument("-s", "--split-on",
+    metavar='REGEX',
+    help="Lines matching REGEX start a new chapter. The `title` group (or " +
+    "the first group) becomes the chapter title.",
+    required=True)
+parser_import_manuscript.add_argument("--part-on",
+    metavar='REGEX',
+    help="Lines matching REGEX start a new part, titled like chapters.")
+parser_import_manuscript.add_argument("-p", "--part",
+    help="Part for chapters that come before the first part heading")
+parser_import_manuscript.set_defaults(which='import_manuscript')
+
+### IMPORT DIRECTORY
+parser_import_directory = subparsers_import.add_parser('directory')
+parser_import_directory.add_argument("path",
+    help="Directory holding one file per chapter.")
+parser_import_directory.add_argument("-P", "--plotline",
+    help="Plotline tag for the new chapters",
+    required=True)
+parser_import_directory.add_argument("-p", "--part",
+    help="Add the chapters to this part tag")
+parser_import_directory.add_argument("-g", "--glob", default='*',
+    help="Only import files matching this pattern (default: *)")
+parser_import_directory.add_argument("-o", "--order", default='natural',
+    choices=('natural', 'name', 'mtime'),
+    help="Chapter order: by name with numbers compared numerically " +
+    "(default), plain name, or modification time")
+parser_import_directory.add_argument("--title-from",
+    metavar='REGEX',
+    help="Take the title from the `title` group (or first group) of REGEX " +
+    "matched against the file name without its extension")
+parser_import_directory.add_argument("-e", "--encoding", default='utf-8',
+    help="Encoding of the files; they are stored as UTF-8 (default: utf-8)")
+parser_import_directory.add_argument("-j", "--jobs", type=int,
+    help="Number of threads used to check and copy files")
+parser_import_directory.set_defaults(which='import_directory')
+
 def ask_to_delete(obj, force=False):
     if not force:
         f = ''
@@ -251,37 +407,29 @@ def list_parts(novel):
     for part in novel.parts:
         print("%10s%20s" % (part.tag, part.title or ''))
 
-def _print_tree_parts(part, level=0):
-    sys.stdout.write('  '*level)
-    sys.stdout.write('+- [%s] %s\n' % (part.tag, part.title or ''))
-    if part.chapters and len(part.chapters) > 0:
-        for chapter in part.chapters:
-            sys.stdout.write('  '*(level+1))
-            sys.stdout.write('+- %s\n' % chapter)
-    if part.children and len(part.children) > 0:
-        for child in part.children:
-            _print_tree_parts(child, level+1)
+def _render_tree(tree):
+    out = []
+    for (part, level) in tree.walk():
+        out.append('%s+- [%s] %s\n' % ('  '*level, tree.tag(part),
+                                        part.title or ''))
+        indent = '  '*(level+1)
+        for chapter in tree.chapters[part]:
+            out.append('%s+- %s\n' % (indent, chapter))
+    if tree.orphans:
+        out.append("Orphaned Chapters (without a part):\n")
+        for chapter in tree.orphans:
+            out.append("- %s\n" % chapter)
+    return ''.join(out)
 
 def list_chapters(novel):
-    for part in novel.parts:
-        _print_tree_parts(part)
-    
-    orphaned = []
-    for chapter in novel.chapters:
-        if chapter.part is None:
-            orphaned.append(chapter)
-    
-    if len(orphaned) > 0:
-        print("Orphaned Chapters (without a part):")
-        for i in orphaned:
-            print("- %s" % i)
+    sys.stdout.write(_render_tree(novel.part_tree()))
 
 def list_versions(novel):
     if len(novel.versions) == 0:
         print("No versions found.")
         return
     for v in novel.versions:
-        print("%-5d%20s%50s" % (v.number, v.timestamp, os.path.abspath(v.path)))
+        print("%-5d%20s%50s" % (v.number, v.timestamp, _location(v)))
 
 def list_drafts(novel):
     if len(novel.drafts) == 0:
@@ -289,7 +437,13 @@ def list_drafts(novel):
         return
     for d in novel.drafts:
         print("[%-5d]%-10s%20s%50s" % (d.number, d.stage, d.timestamp,
-                                       os.path.abspath(d.path)))
+                                       _location(d)))
+
+def _location(version):
+    (path, state) = version.location()
+    if state:
+        return "%s (%s)" % (path, state)
+    return path
 
 # show
 
@@ -306,23 +460,26 @@ def show_part(novel, part_tag):
     if part is None:
         tags = ', '.join(["'%s'" % p.tag for p in novel.parts])
         raise RuntimeError("%s: Part not found in [%s]" % (part_tag, tags))
-    wc = 0
-    for ch in part.chapters:
-        wc += ch.word_count()
+    tree = novel.part_tree()
+    (words, chars) = tree.total(part)
     print("part #: %d" % part.number)
     print("tag: %s" % part.tag)
     print("title: %s" % part.title)
-    print("chapters: %d" % len(part.chapters))
-    print("%d words" % wc)
+    print("parts: %d" % len(tree.children[part]))
+    print("chapters: %d" % len(tree.chapters[part]))
+    print("%d words, %d characters" % (words, chars))
 
 def show_plotline(novel, plotline_tag):
     plotline = novel.find_plotline(plotline_tag)
     if not plotline:
         print("%s: plotline not found" % plotline_tag)
+        sys.exit(1)
     
+    (words, chars) = novel.part_tree().total(plotline)
     print("tag: %s" % plotline.tag)
     print("description: %s" % plotline.comment)
     print("%d chapters follow this plotline" % len(plotline.chapters))
+    print("%d words, %d characters" % (words, chars))
 
 def show_chapter(novel, chapter_tag):
     chapter = novel.find_chapter(chapter_tag)
@@ -335,11 +492,79 @@ def show_chapter(novel, chapter_tag):
         print("Title: %s" % chapter.title)
     print("Word Count: %s" % chapter.word_count())
 
-def show_version(novel):
-    pass
-
-def show_draft(novel):
-    pass
+def show_version(novel, tag):
+    version = novel.find_version(tag)
+    if version is None:
+        print("%s: version not found" % tag)
+        sys.exit(1)
+    print("Version #: %d" % version.number)
+    print("Bound: %s" % version.timestamp)
+    print("Commit: %s" % version.git_hash)
+    if version.comment:
+        print("Comment: %s" % version.comment)
+    print("Files: %s" % ', '.join(version.outputs))
+
+def show_draft(novel, tag):
+    show_version(novel, tag if tag.startswith('d') else 'd%s' % tag)
+
+# machine-readable list and show
+
+LIST_KINDS = {
+    'plotlines': 'plotline',
+    'parts': 'part',
+    'chapters': 'chapter',
+    'versions': 'version',
+    'drafts': 'draft',
+}
+
+def list_records(novel, obj, fmt, out=sys.stdout):
+    """
+    @brief `list` in a machine-readable format (see `records`).
+    """
+    kind = LIST_KINDS[obj]
+    return write_records(kind, RECORDS[kind](novel), fmt, out)
+
+def _counts(novel, kind, obj):
+    if kind == 'chapter':
+        return obj.counts()
+    tree = novel.part_tree()
+    if kind == 'novel':
+        (words, chars) = (0, 0)
+        for part in tree.roots:
+            (w, c) = tree.total(part)
+            (words, chars) = (words + w, chars + c)
+        for chapter in tree.orphans:
+            (w, c) = tree.count(chapter)
+            (words, chars) = (words + w, chars + c)
+        return (words, chars)
+    return tree.total(obj)
+
+def show_record(novel, kind, tag, fmt, out=sys.stdout):
+    """
+    @brief `show` in a machine-readable format: the `list` record of the
+        object plus its word count.
+    """
+    if kind == 'novel':
+        record = novel_record(novel)
+    else:
+        find = {
+            'plotline': novel.find_plotline,
+            'part': novel.find_part,
+            'chapter': novel.find_chapter,
+            'version': novel.find_version,
+            'draft': lambda t: novel.find_version(
+                t if t.startswith('d') else 'd%s' % t),
+        }[kind]
+        obj = find(tag)
+        if obj is None:
+            print("%s: %s not found" % (tag, kind))
+            sys.exit(1)
+        record = next(RECORDS[kind](novel, [obj]))
+    detail = kind not in ('version', 'draft')
+    if detail:
+        (record['words'], record['characters']) = _counts(
+            novel, kind, None if kind == 'novel' else obj)
+    return write_records(kind, [record], fmt, out, detail=detail, single=True)
 
 # add
 
@@ -427,6 +652,7 @@ def add_chapter(novel, plotline_tag, title, part_tag):
         open(c.path, 'w+').close()
         
     novel.write_chapters()
+    novel.git_add_files([c.path, novel.env.chapters_path])
     novel.git_commit_files([c.path, novel.env.chapters_path], "Add %s" % c)
 
 # update
@@ -552,40 +778,83 @@ def update_chapter(novel, tag, **kwargs):
             raise RuntimeError("%s: part not found" % part_tag)
         old_part = chapter.part
         logger.debug("part_tag: %s => %s" % (chapter, part))
-        part.chapters.append(
-            old_part.chapters.parts.pop(
-                old_part.chapters.index(chapter)
-            )
-        )
+        if old_part is not None:
+            old_part.chapters.remove(chapter)
+        part.chapters.append(chapter)
         chapter.part = part
     
     if before_tag:
         before = novel.find_chapter(before_tag)
         if before is None:
-            raise RuntimeError("%s: chapter not found" % before)
+            raise RuntimeError("%s: chapter not found" % before_tag)
         logger.debug("before_tag: %s => %s" % (chapter, before))
         
-        novel.chapters.insert(
-            novel.chapters.index(chapter),
-            novel.chapters.pop(chapter)
-            )
+        novel.chapters.remove(chapter)
+        novel.chapters.insert(novel.chapters.index(before), chapter)
     
     elif after_tag:
         after = novel.find_chapter(after_tag)
         if after is None:
-            raise RuntimeError("%s: chapter not found" % after)
+            raise RuntimeError("%s: chapter not found" % after_tag)
         
-        novel.chapters.insert(
-            novel.chapters.index(chapter)+1,
-            novel.chapters.pop(chapter)
-            )
+        novel.chapters.remove(chapter)
+        novel.chapters.insert(novel.chapters.index(after)+1, chapter)
     
-    novel.write_chapters()
-    novel.git_add_files([novel.env.data_dir, chapter.path])
-    novel.git_commit_files([chapter.path, novel.env.chapters_path],
-                           "Update %s" % chapter)
+    # Tags, and so file names, follow titles and positions.
+    novel.renumber_chapters("Update %s" % chapter)
         
 
+def move(novel, obj, tags=None, first_last=None, before_tag=None,
+         after_tag=None, into_tag=None):
+    """
+    @brief Move a list or range of chapters or parts in one operation.
+    
+    :param obj: 'chapters' or 'parts'
+    :type obj: str
+    
+    :param first_last: (first tag, last tag) of a range to move, in addition
+        to `tags`.
+    :type first_last: tuple
+    """
+    if obj == 'chapters':
+        (find, find_range) = (novel.find_chapter, novel.chapter_range)
+    else:
+        (find, find_range) = (novel.find_part, novel.part_range)
+    
+    items = []
+    if first_last:
+        items.extend(find_range(*first_last))
+    for tag in tags or []:
+        item = find(tag)
+        if item is None:
+            raise RuntimeError("%s: not found" % tag)
+        if item not in items:
+            items.append(item)
+    if not items:
+        print("Nothing to move")
+        sys.exit(1)
+    
+    (before, after, into) = (None,)*3
+    if before_tag:
+        before = find(before_tag)
+        if before is None:
+            raise RuntimeError("%s: not found" % before_tag)
+    if after_tag:
+        after = find(after_tag)
+        if after is None:
+            raise RuntimeError("%s: not found" % after_tag)
+    if into_tag:
+        into = novel.find_part(into_tag)
+        if into is None:
+            raise RuntimeError("%s: part not found" % into_tag)
+    
+    if obj == 'chapters':
+        novel.move_chapters(items, before, after, into)
+    else:
+        novel.move_parts(items, before, after, into)
+    print("Moved %d %s" % (len(items), obj))
+    return items
+
 def update_version(novel, tag, rename_tag, comment):
     pass
 
@@ -621,9 +890,11 @@ def edit_chapter(novel, cont, tag, editor):
     print("[shell] %s" % ' '.join(CMD))
     subprocess.call(CMD)
     
-    novel.git_add_files([chapter.path, novel.env.chapters_path])
-    novel.git_commit_files([chapter.path, novel.env.chapters_path],
-                           "Edit %s" % chapter)
+    # Staging, committing and refreshing the index happen in the
+    # background; see `postedit`.
+    queue = PostEditQueue(novel.env)
+    queue.add(chapter.path, "Edit %s" % chapter)
+    queue.start_worker()
 
 ## Delete methods ##
 
@@ -657,12 +928,7 @@ def delete_chapter(novel, tag, force):
     
     os.remove(chapter.path)
     novel.chapters.remove(chapter)
-    
-    with open(CHAPTERSFILE, 'w') as chaptersfile:
-        writer = csv.writer(chaptersfile)
-        for chapter in novel.chapters:
-            chapter.write_row(writer)
-        chaptersfile.close()
+    novel.write_chapters()
 
 def delete_version(novel, tag, force):
     version = novel.find_version(tag)
@@ -737,9 +1003,409 @@ def import_chapter(novel, origin, plotline_tag, title, part_tag, before_tag,
     novel.git_commit_files([chapter.path, novel.env.chapters_path],
                            "Import %s" % chapter)
 
-def bind_novel(novel, comment, stage):
-    version = novel.bind(comment, stage)
-    print("New %s created: %s" % (type(version).__name__, version.path))
+def _heading_title(match):
+    if 'title' in match.re.groupindex:
+        return match.group('title').strip() or None
+    if match.re.groups > 0 and match.group(1):
+        return match.group(1).strip() or None
+    return None
+
+def import_manuscript(novel, origin, plotline_tag, split_on, part_on=None,
+                      part_tag=None):
+    """
+    @brief Split a single-file manuscript into chapters (and parts).
+    
+    The manuscript is streamed once: each line is written straight into the
+    chapter it belongs to, and the data files are written and committed once
+    at the end.
+    
+    :param origin: Path of the manuscript.
+    :type origin: str
+    
+    :param split_on: Regular expression; a matching line starts a new
+        chapter and is not copied into it.
+    :type split_on: str
+    
+    :param part_on: Regular expression; a matching line starts a new part.
+    :type part_on: str
+    
+    :param part_tag: Part for chapters before the first part heading.
+    :type part_tag: str
+    
+    :returns: The list of new chapters
+    """
+    plotline = novel.find_plotline(plotline_tag)
+    if not plotline:
+        print("%s: plotline not found" % plotline_tag)
+        sys.exit(1)
+    
+    part = None
+    if part_tag:
+        part = novel.find_part(part_tag)
+        if not part:
+            print("%s: part not found" % part_tag)
+            sys.exit(1)
+    
+    if not os.path.exists(origin):
+        print("%s: Origin path does not exist." % origin)
+        sys.exit(1)
+    
+    chapter_re = re.compile(split_on)
+    part_re = None
+    if part_on:
+        part_re = re.compile(part_on)
+    
+    (chapters, parts, dirs) = ([], [], [])
+    destfile = None
+    
+    def start_chapter(title):
+        chapter = Chapter(novel=novel, plotline=plotline, title=title,
+                          part=part, number=len(novel.chapters)+1)
+        if os.path.exists(chapter.path):
+            raise RuntimeError("%s: chapter file already exists" % chapter.path)
+        if not os.path.exists(os.path.dirname(chapter.path)):
+            os.makedirs(os.path.dirname(chapter.path))
+            dirs.append(os.path.dirname(chapter.path))
+        novel.chapters.append(chapter)
+        plotline.chapters.append(chapter)
+        if part:
+            part.chapters.append(chapter)
+        chapters.append(chapter)
+        return open(chapter.path, 'w')
+    
+    try:
+        with open(origin, 'r') as originfile:
+            for line in originfile:
+                m = None
+                if part_re:
+                    m = part_re.match(line)
+                if m:
+                    part = Part(novel, _heading_title(m))
+                    novel.parts.append(part)
+                    parts.append(part)
+                    continue
+                m = chapter_re.match(line)
+                if m:
+                    if destfile:
+                        destfile.close()
+                    destfile = start_chapter(_heading_title(m))
+                    continue
+                if destfile is None:
+                    # Skip leading blank lines; anything else before the
+                    # first heading becomes an untitled chapter.
+                    if not line.strip():
+                        continue
+                    destfile = start_chapter(None)
+                destfile.write(line)
+    except Exception:
+        # Leave the novel as it was: the chapter headings are only known
+        # while streaming, so a clash or a decoding error can come late.
+        if destfile:
+            destfile.close()
+            destfile = None
+        for chapter in chapters:
+            if os.path.exists(chapter.path):
+                os.remove(chapter.path)
+            novel.chapters.remove(chapter)
+            chapter.plotline.chapters.remove(chapter)
+            if chapter.part:
+                chapter.part.chapters.remove(chapter)
+        for part in parts:
+            novel.parts.remove(part)
+        for d in reversed(dirs):
+            if not os.listdir(d):
+                os.rmdir(d)
+        raise
+    finally:
+        if destfile:
+            destfile.close()
+    
+    files = [c.path for c in chapters] + [novel.env.chapters_path]
+    novel.write_chapters()
+    if parts:
+        novel.write_parts()
+        files.append(novel.env.parts_path)
+    novel.git_add_files(files)
+    novel.git_commit_files(files, "Import %d chapters from %s" % (
+        len(chapters), os.path.basename(origin)))
+    print("Imported %d chapters and %d parts from %s" % (
+        len(chapters), len(parts), origin))
+    return chapters
+
+def _natural_key(path):
+    return [int(t) if t.isdigit() else t.lower()
+            for t in re.split(r'(\d+)', os.path.basename(path))]
+
+def _file_title(path, title_re=None):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if title_re:
+        m = title_re.search(stem)
+        return _heading_title(m) if m else None
+    # "01_the_beginning" => "the beginning"
+    title = re.sub(r'^[\d\s._-]+', '', stem)
+    title = re.sub(r'[_-]+', ' ', title).strip()
+    return title or None
+
+def _check_encoding(path, encoding):
+    try:
+        with open(path, 'rb') as f:
+            f.read().decode(encoding)
+    except (UnicodeDecodeError, LookupError) as e:
+        return "%s: %s" % (path, e)
+    return None
+
+def _copy_chapter(origin, dest, encoding):
+    if encoding.lower().replace('-', '') in ('utf8', 'ascii'):
+        shutil.copyfile(origin, dest)
+        return
+    with open(origin, 'r', encoding=encoding) as originfile:
+        with open(dest, 'w', encoding='utf-8') as destfile:
+            shutil.copyfileobj(originfile, destfile)
+
+def import_directory(novel, directory, plotline_tag, part_tag=None,
+                     pattern='*', order='natural', title_from=None,
+                     encoding='utf-8', jobs=None):
+    """
+    @brief Import every file in a directory as a chapter, in one commit.
+    
+    Files are checked for `encoding` and then copied by a thread pool; the
+    chapters are registered only once every copy has succeeded.
+    
+    :param order: 'natural', 'name' or 'mtime'.
+    :type order: str
+    
+    :param title_from: Regular expression applied to each file name (without
+        extension) to find the chapter title.
+    :type title_from: str
+    
+    :returns: The list of new chapters
+    """
+    plotline = novel.find_plotline(plotline_tag)
+    if not plotline:
+        print("%s: plotline not found" % plotline_tag)
+        sys.exit(1)
+    
+    part = None
+    if part_tag:
+        part = novel.find_part(part_tag)
+        if not part:
+            print("%s: part not found" % part_tag)
+            sys.exit(1)
+    
+    if not os.path.isdir(directory):
+        print("%s: not a directory." % directory)
+        sys.exit(1)
+    
+    origins = [p for p in glob.glob(os.path.join(directory, pattern))
+               if os.path.isfile(p)]
+    if order == 'mtime':
+        origins.sort(key=os.path.getmtime)
+    elif order == 'name':
+        origins.sort()
+    else:
+        origins.sort(key=_natural_key)
+    if not origins:
+        print("%s: no files matching '%s'" % (directory, pattern))
+        return []
+    
+    title_re = re.compile(title_from) if title_from else None
+    
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        errors = [e for e in pool.map(_check_encoding, origins,
+                                      [encoding]*len(origins)) if e]
+        if errors:
+            for e in errors:
+                print(e)
+            raise RuntimeError("%d files are not valid %s; nothing imported" % (
+                len(errors), encoding))
+        
+        chapters = []
+        for origin in origins:
+            n = len(novel.chapters) + len(chapters) + 1
+            chapter = Chapter(novel=novel, plotline=plotline,
+                              title=_file_title(origin, title_re),
+                              part=part, number=n)
+            if os.path.exists(chapter.path):
+                raise RuntimeError("%s: chapter file already exists" %
+                                   chapter.path)
+            chapters.append(chapter)
+        
+        for d in set(os.path.dirname(c.path) for c in chapters):
+            if not os.path.exists(d):
+                os.makedirs(d)
+        
+        copies = [pool.submit(_copy_chapter, o, c.path, encoding)
+                  for (o, c) in zip(origins, chapters)]
+        try:
+            for f in copies:
+                f.result()
+        except Exception:
+            for c in chapters:
+                if os.path.exists(c.path):
+                    os.remove(c.path)
+            raise
+    
+    for chapter in chapters:
+        novel.chapters.append(chapter)
+        plotline.chapters.append(chapter)
+        if part:
+            part.chapters.append(chapter)
+    
+    files = [c.path for c in chapters] + [novel.env.chapters_path]
+    novel.write_chapters()
+    novel.git_add_files(files)
+    novel.git_commit_files(files, "Import %d chapters from %s" % (
+        len(chapters), directory))
+    print("Imported %d chapters from %s" % (len(chapters), directory))
+    return chapters
+
+def show_history(novel, by='day'):
+    history = WordHistory(novel)
+    history.update()
+    print("%-40s%10s%10s%10s" % (by, "added", "removed", "net"))
+    print("=" * 70)
+    if by == 'chapter':
+        tags = dict((os.path.relpath(c.path, novel.env.proj_path), c.tag)
+                    for c in novel.chapters)
+        for (path, (added, removed)) in sorted(history.by_path().items()):
+            print("%-40s%10d%10d%+10d" % (tags.get(path, path), added, removed,
+                                          added - removed))
+    else:
+        for (day, added, removed) in history.by_day():
+            print("%-40s%10d%10d%+10d" % (day, added, removed, added - removed))
+
+def search_chapters(novel, query):
+    index = SearchIndex(novel)
+    try:
+        index.update()
+        results = index.search(query)
+    finally:
+        index.close()
+    if not results:
+        print("No chapters match %s" % query)
+        return results
+    for (chapter, hits) in results:
+        print("%5d  %s" % (hits, chapter))
+    return results
+
+def diff_versions(novel, old_tag, new_tag, fmt='text', context=5):
+    (old, new) = (novel.find_version(old_tag), novel.find_version(new_tag))
+    for (tag, version) in ((old_tag, old), (new_tag, new)):
+        if version is None:
+            print("%s: version not found" % tag)
+            sys.exit(1)
+    changes = worddiff.diff_versions(novel, old, new)
+    if fmt == 'html':
+        sys.stdout.write(worddiff.format_html(changes, context))
+    else:
+        sys.stdout.write(worddiff.format_text(changes, context))
+    return changes
+
+def show_status(novel, fmt='text', out=sys.stdout):
+    """
+    @brief The chapters that are modified, missing or not yet committed,
+        by tag (see `status.chapter_status`).
+    """
+    from status import chapter_status
+    from records import status_records
+    changes = chapter_status(novel)
+    if fmt != 'text':
+        return write_records('status', status_records(novel, changes), fmt,
+                             out)
+    proj_path = novel.env.proj_path
+    for (status, chapter) in changes:
+        out.write("%-10s%-30s%s\n" % (status, chapter.tag,
+                                      os.path.relpath(chapter.path, proj_path)))
+    if not changes:
+        out.write("No chapter changed since the last commit.\n")
+    queue = PostEditQueue(novel.env)
+    if queue.pending() or queue.worker_running():
+        out.write("Edits are still being committed in the background.\n")
+    return len(changes)
+
+def show_changes(novel, since):
+    version = novel.find_version(since)
+    if version is None:
+        print("%s: version not found" % since)
+        sys.exit(1)
+    changes = worddiff.changes_since(novel, version)
+    if not changes:
+        print("No chapters changed since %s" % since)
+    for (status, old_path, new_path, title, delta) in changes:
+        if status == 'moved':
+            print("%-10s%s -> %s" % (status, old_path, new_path))
+        else:
+            print("%-10s%-40s%+8d words  %s" % (status, new_path or old_path,
+                                               delta, title))
+    return changes
+
+def bind_novel(novel, comment, stage, formats=None, workers=None):
+    version = novel.bind(comment, stage, formats, workers)
+    formats = formats or ['native']
+    print("New %s created: %s" % (type(version).__name__,
+                                  ', '.join(version.materialize(f)
+                                            for f in formats)))
+
+def archive_versions(novel, age=None):
+    archived = novel.archive_versions(age)
+    for version in archived:
+        print("Archived %s" % version.path)
+    if not archived:
+        print("Nothing to archive")
+    return archived
+
+def export_version(novel, tag, fmt=None, output=None):
+    version = novel.find_version(tag)
+    if version is None:
+        print("%s: version not found" % tag)
+        sys.exit(1)
+    path = version.materialize(fmt)
+    if output:
+        shutil.copyfile(path, output)
+        path = output
+    print(path)
+    return path
+
+def fsck(proj_path=None, repair=False, jobs=None, lock=None):
+    """
+    @brief Check the project (see `fsck.check`) and print the problems.
+        Exits with 1 if any are left unrepaired.
+    """
+    import fsck as checker
+    (novel, problems) = checker.load(proj_path, lock)
+    if novel is not None:
+        problems = checker.check(novel, jobs)
+        if repair:
+            checker.repair(novel, problems)
+    for problem in problems:
+        print("%r%s" % (problem, " (repaired)" if problem.repaired else
+                        " (repairable)" if problem.fix and not repair else ''))
+    left = len([p for p in problems if not p.repaired])
+    print("%d problems, %d repaired" % (len(problems),
+                                        len(problems) - left))
+    if left:
+        sys.exit(1)
+
+# Commands that change the project, and so hold its lock while they run.
+# Editing takes it only to commit, and bind only to record the version;
+# `config` takes it when it changes a setting.
+WRITE_COMMANDS = ('add', 'update', 'delete', 'import', 'move', 'archive',
+                  'flush')
+
+# Commands that read commits or the search index, and so wait for the
+# post-edit worker to finish first. Writers wait too (see `main`).
+WAIT_COMMANDS = ('bind', 'history', 'search', 'diff', 'changes', 'archive',
+                 'export', 'flush')
+
+def writes(args):
+    """
+    @brief Whether the command changes the project (see `WRITE_COMMANDS`).
+    """
+    if getattr(args, 'which', '') == 'config':
+        # Only changing a setting writes the config.
+        return (getattr(args, 'set', None) is not None or
+                getattr(args, 'set_default', False))
+    return getattr(args, 'which', '').startswith(WRITE_COMMANDS)
 
 def main(argv):
     if not os.path.exists(DATADIR):
@@ -753,7 +1419,41 @@ Use `mnadmin' to create the novel project. Thank you.")
         
     args = parser.parse_args(argv[1:])
     
-    novel = Novel.load()
+    if getattr(args, 'which', '') == 'fsck':
+        # The project may be too broken to load, so fsck loads it itself.
+        parsed = parser_fsck.parse_args(argv[2:])
+        if not parsed.repair:
+            fsck(jobs=parsed.jobs)
+            return
+        PostEditQueue(NovelEnvironment.load()).wait()
+        lock = ProjectLock(NovelEnvironment.load())
+        with lock:
+            fsck(repair=True, jobs=parsed.jobs, lock=lock)
+        return
+    
+    if getattr(args, 'which', '') in WAIT_COMMANDS or writes(args):
+        # Before taking the lock: the post-edit worker needs it to commit.
+        # Writers commit with `-a` and rename chapter files, so queued edits
+        # must be committed on their own first.
+        PostEditQueue(NovelEnvironment.load()).wait()
+    
+    if not writes(args):
+        # Readers work from a snapshot and never wait for the lock.
+        run(Novel.load(), args, argv)
+        return
+    
+    lock = ProjectLock(NovelEnvironment.load())
+    with lock:
+        run(Novel.load(lock=lock), args, argv)
+
+def run(novel, args, argv):
+    if getattr(args, 'which', '') == 'flush':
+        n = novel.git_flush()
+        print("%d queued changes committed." % n)
+        return
+    if writes(args):
+        # Readers never commit; they do not hold the lock.
+        novel.git_flush(force=False)
     
     if getattr(args, 'which', '') == 'config':
         parsed = parser_config.parse_args(argv[2:])
@@ -797,8 +1497,11 @@ Use `mnadmin' to create the novel project. Thank you.")
                 print()
     
     elif getattr(args, 'which', '') == 'list':
-        obj = parser_list.parse_args(argv[2:]).object
-        if obj == 'plotlines':
+        parsed = parser_list.parse_args(argv[2:])
+        obj = parsed.object
+        if parsed.format != 'text':
+            list_records(novel, obj, parsed.format)
+        elif obj == 'plotlines':
             list_plotlines(novel)        
         elif obj == 'parts':
             list_parts(novel)
@@ -810,13 +1513,16 @@ Use `mnadmin' to create the novel project. Thank you.")
             list_drafts(novel)
     
     elif getattr(args, 'which', '') == 'show':
-        obj = getattr(parser_show.parse_args(argv[2:]), 'object', None)
-        tag = getattr(parser_show.parse_args(argv[2:]), 'tag', None)
-        if obj == 'novel':
-            show_novel(novel)
-        elif tag is None:
+        parsed = parser_show.parse_args(argv[2:])
+        obj = getattr(parsed, 'object', None)
+        tag = getattr(parsed, 'tag', None)
+        if obj != 'novel' and tag is None:
             print("Error: tag [-t, --tag] required!")
             sys.exit(1)
+        elif parsed.format != 'text':
+            show_record(novel, obj, tag, parsed.format)
+        elif obj == 'novel':
+            show_novel(novel)
         elif obj == 'plotline':
             show_plotline(novel, tag)
         elif obj == 'part':
@@ -878,6 +1584,11 @@ Use `mnadmin' to create the novel project. Thank you.")
             parser_update.print_help()
             sys.exit(1)
     
+    elif getattr(args, 'which', '') == 'move':
+        parsed = parser_move.parse_args(argv[2:])
+        move(novel, parsed.object, parsed.tags, parsed.range, parsed.before,
+             parsed.after, parsed.into)
+    
     elif getattr(args, 'which', '') == 'edit_chapter':
         parsed = parser_edit.parse_args(argv[2:])
         cont = getattr(parsed, 'continue', False)
@@ -911,19 +1622,65 @@ Use `mnadmin' to create the novel project. Thank you.")
         part = getattr(parsed, 'part', None)
         before = getattr(parsed, 'before', None)
         after = getattr(parsed, 'after', None)
+        split_on = getattr(parsed, 'split_on', None)
+        part_on = getattr(parsed, 'part_on', None)
         
         if args.which == 'import_chapter':
             import_chapter(novel, origin, plotline, title, part, before, after)
         
+        if args.which == 'import_manuscript':
+            import_manuscript(novel, origin, plotline, split_on, part_on, part)
+        
+        if args.which == 'import_directory':
+            import_directory(novel, origin, plotline, part,
+                             parsed.glob, parsed.order, parsed.title_from,
+                             parsed.encoding, parsed.jobs)
+        
         if args.which == 'import':
             parser_import.print_usage()
     
     elif getattr(args, 'which', '') == 'bind':
-        parsed = parser_import.parse_args(argv[2:])
+        parsed = parser_bind.parse_args(argv[2:])
         comment = getattr(parsed, 'comment', None)
         stage = getattr(parsed, 'stage', None)
+        formats = getattr(parsed, 'format', None)
+        jobs = getattr(parsed, 'jobs', None)
         
-        bind_novel(novel, comment, stage)
+        bind_novel(novel, comment, stage, formats, jobs)
+    
+    elif getattr(args, 'which', '') == 'history':
+        parsed = parser_history.parse_args(argv[2:])
+        show_history(novel, parsed.by)
+    
+    elif getattr(args, 'which', '') == 'search':
+        parsed = parser_search.parse_args(argv[2:])
+        search_chapters(novel, ' '.join(
+            '"%s"' % q if ' ' in q else q for q in parsed.query))
+    
+    elif getattr(args, 'which', '') == 'diff':
+        parsed = parser_diff.parse_args(argv[2:])
+        diff_versions(novel, parsed.old, parsed.new, parsed.format,
+                      parsed.context)
+    
+    elif getattr(args, 'which', '') == 'status':
+        parsed = parser_status.parse_args(argv[2:])
+        show_status(novel, parsed.format)
+    
+    elif getattr(args, 'which', '') == 'changes':
+        parsed = parser_changes.parse_args(argv[2:])
+        show_changes(novel, parsed.since)
+    
+    elif getattr(args, 'which', '') == 'archive':
+        parsed = parser_archive.parse_args(argv[2:])
+        archive_versions(novel, parsed.age)
+    
+    elif getattr(args, 'which', '') == 'export':
+        parsed = parser_export.parse_args(argv[2:])
+        export_version(novel, parsed.version, parsed.format, parsed.output)
+    
+    elif getattr(args, 'which', '') == 'watch':
+        parsed = parser_watch.parse_args(argv[2:])
+        watch(novel, parsed.poll, parsed.debounce, parsed.interval)
 
 if __name__=="__main__":
     main(sys.argv)
@@ -3,8 +3,15 @@
 import argparse
 import sys
 import os
+import csv
+import json
+import time
+import tempfile
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from fleet import OPERATIONS, run_fleet
 
 import logging
 logger = logging.getLogger(__name__)
@@ -36,6 +43,44 @@ parser.add_argument("-p", "--path",
 parser.add_argument("-b", "--branch",
     help="Name of this specific git branch")
 
+parser_create = argparse.ArgumentParser(prog="mnadmin create",
+    description="Create the projects listed in a manifest, in parallel, "
+                "from a template repository")
+parser_create.add_argument("-m", "--manifest", required=True,
+    help="CSV file with one project per row: name, title[, branch]")
+parser_create.add_argument("-p", "--path", default=CURRDIR,
+    help="Directory to create the projects in. Default is the current one.")
+parser_create.add_argument("-T", "--template",
+    help="Template repository to copy. Default is a fresh empty project.")
+parser_create.add_argument("-c", "--config",
+    help="makenovel configuration file. Default is %s" % DFLT_CONFIG_FILE,
+    default=DFLT_CONFIG_FILE)
+parser_create.add_argument("-j", "--jobs", type=int,
+    help="Number of projects to create at once. Default is the CPU count.")
+
+parser_fleet = argparse.ArgumentParser(prog="mnadmin fleet",
+    description="Run an operation on every project under a directory, in "
+                "parallel, printing one JSON record per project as it "
+                "finishes")
+parser_fleet.add_argument("op", choices=sorted(OPERATIONS),
+    help="stats: the `show novel` numbers; words: word and character "
+         "totals per part and plotline; bind: bind a new version; fsck: "
+         "check the project (without repairing it)")
+parser_fleet.add_argument("-r", "--root", default=CURRDIR,
+    help="Directory to search for projects. Default is the current one.")
+parser_fleet.add_argument("-j", "--jobs", type=int,
+    help="Number of projects to work on at once. Default is the CPU count.")
+
+DATA_FILES = ("novel", "chapters.csv", "parts.csv",
+              "plotlines.csv", "versions.csv", "drafts.csv")
+
+def write_novel_file(data_dir, title, config=None):
+    with open(os.path.join(data_dir, "novel"), 'w') as nf:
+        nf.write('title=%s\n' % title)
+        if config:
+            nf.write('config=%s\n' % config)
+        nf.close()
+
 def create_project(name, title, branch=None, path=None, config=None):
     projdir = path
     if path is None:
@@ -46,17 +91,12 @@ def create_project(name, title, branch=None, path=None, config=None):
         
     logger.info("Creating project in %s\n" % dest_data_dir)
     
-    for f in ("novel", "chapters.csv", "parts.csv", 
-              "plotlines.csv","versions.csv", "drafts.csv"):
+    for f in DATA_FILES:
             tf = os.path.join(dest_data_dir, f)
             if not os.path.exists(tf):
                 open(tf,'w').close()
     
-    with open(os.path.join(dest_data_dir, "novel"), 'w') as nf:
-        nf.write('title=%s' % title)
-        if config:
-            nf.write('config=%s' % config)
-        nf.close()
+    write_novel_file(dest_data_dir, title, config)
         
     currdir = os.path.abspath('.')
         
@@ -73,7 +113,170 @@ def create_project(name, title, branch=None, path=None, config=None):
     
     os.chdir(currdir)
     
+def make_template(path, config=None):
+    """
+    @brief Create a template repository: an empty project with one commit,
+        which `copy_template` turns into real projects.
+    """
+    data_dir = os.path.join(path, '.novel')
+    os.makedirs(data_dir)
+    for f in DATA_FILES:
+        open(os.path.join(data_dir, f), 'w').close()
+    write_novel_file(data_dir, "template", config)
+    for args in (['init', '-q'], ['add', '.novel'],
+                 ['commit', '-q', '-m', "makenovel - template"]):
+        CMD = [GIT, '-C', path] + args
+        logger.info("[shell] %s" % ' '.join(CMD))
+        subprocess.check_call(CMD, stdout=subprocess.DEVNULL)
+    return path
+
+def copy_template(template, projdir, title, branch=None, config=None):
+    """
+    @brief Create a project from a template repository.
+    
+    The template's git objects are hard-linked and its other files copied,
+    then the title is written and the template's commit is amended into the
+    project's first commit: one or two git commands instead of four.
+    
+    :param template: Path of a template made by `make_template`.
+    :type template: str
+    
+    :returns: The project's path
+    """
+    if os.path.exists(os.path.join(projdir, '.novel')):
+        raise RuntimeError("%s: project already exists" % projdir)
+    objects = os.path.join(os.path.abspath(template), '.git', 'objects')
+    
+    def link_or_copy(src, dst):
+        # Git never changes an object file once written, so projects can
+        # share them; everything else gets its own copy.
+        if os.path.abspath(src).startswith(objects + os.sep):
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError:
+                pass
+        return shutil.copy2(src, dst)
+    
+    shutil.copytree(template, projdir, copy_function=link_or_copy,
+                    dirs_exist_ok=True)
+    write_novel_file(os.path.join(projdir, '.novel'), title, config)
+    if branch:
+        CMD = [GIT, '-C', projdir, 'branch', '-m', branch]
+        logger.info("[shell] %s" % ' '.join(CMD))
+        subprocess.check_call(CMD, stdout=subprocess.DEVNULL)
+    CMD = [GIT, '-C', projdir, 'commit', '-q', '-a', '--amend',
+           '--reset-author', '-m', "makenovel - create project `%s'" % title]
+    logger.info("[shell] %s" % ' '.join(CMD))
+    subprocess.check_call(CMD, stdout=subprocess.DEVNULL)
+    return projdir
+
+def read_manifest(path, base):
+    """
+    @brief Read a provisioning manifest: a CSV file with one project per
+        row, as name, title and optionally a branch. Blank rows and rows
+        starting with '#' are skipped.
+    
+    :param base: Directory the projects are created in.
+    :type base: str
+    
+    :returns: list of (project path, title, branch)
+    """
+    projects = []
+    with open(path) as mf:
+        for row in csv.reader(mf):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            if len(row) < 2 or not row[1].strip():
+                raise RuntimeError("%s: %s: a title is required" % (
+                    path, row[0]))
+            branch = row[2].strip() if len(row) > 2 else ''
+            projects.append((os.path.join(base, row[0].strip()),
+                             row[1].strip(), branch or None))
+        mf.close()
+    return projects
+
+def create_projects(projects, template=None, config=None, jobs=None,
+                    out=sys.stdout):
+    """
+    @brief Create many projects from a template, in parallel, writing one
+        JSON record with the project's timing as each one is done.
+    
+    :param projects: list of (project path, title, branch)
+    :type projects: list
+    
+    :param template: A template repository; if None, one is made first
+        and removed at the end.
+    :type template: str
+    
+    :param jobs: Number of projects to create at once. Defaults to the
+        CPU count.
+    :type jobs: int
+    
+    :returns: The number of projects that failed
+    """
+    tmpdir = None
+    if template is None:
+        tmpdir = tempfile.mkdtemp(prefix='mnadmin-')
+        template = make_template(os.path.join(tmpdir, 'template'), config)
+    
+    def create(project):
+        (projdir, title, branch) = project
+        record = {'project': projdir, 'title': title}
+        start = time.time()
+        try:
+            copy_template(template, projdir, title, branch, config)
+            record['ok'] = True
+        except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+            logger.info("%s: not created: %s" % (projdir, e))
+            record['ok'] = False
+            record['error'] = str(e)
+        record['seconds'] = round(time.time() - start, 3)
+        return record
+    
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            for record in pool.map(create, projects):
+                if not record['ok']:
+                    failed += 1
+                out.write(json.dumps(record))
+                out.write('\n')
+                out.flush()
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return failed
+
+def create(argv):
+    args = parser_create.parse_args(argv)
+    if args.template and not os.path.isdir(
+            os.path.join(args.template, '.git')):
+        print("%s: not a git repository" % args.template)
+        sys.exit(1)
+    start = time.time()
+    projects = read_manifest(args.manifest, args.path)
+    failed = create_projects(projects, args.template, args.config, args.jobs)
+    logger.info("%d projects created in %.1fs" % (len(projects) - failed,
+                                                  time.time() - start))
+    if failed:
+        sys.exit(1)
+
+def fleet(argv):
+    args = parser_fleet.parse_args(argv)
+    if not os.path.isdir(args.root):
+        print("%s: not a directory" % args.root)
+        sys.exit(1)
+    if run_fleet(args.root, args.op, args.jobs):
+        sys.exit(1)
+
 def main():
+    if sys.argv[1:2] == ['create']:
+        create(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['fleet']:
+        fleet(sys.argv[2:])
+        return
     args = parser.parse_args(sys.argv[1:])
     create_project(args.name, args.title, args.branch, path=args.path,
                    config=args.config)
@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 
+import io
 import os
 import sys
 import csv
+import gzip
+import pickle
 import shutil
+import hashlib
+import itertools
+import time
 import datetime
 import logging
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 UNIX_DATE_FORMAT="%Y-%m-%d %H:%M:%S %z"
@@ -17,6 +28,62 @@ def machine_str(s):
         s2 = s2.replace(i, '')
     return s2
 
+def blob_id(data):
+    """
+    @brief The git blob id of `data` (bytes).
+    """
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def blob_hash(path):
+    """
+    @brief The git blob id of a file (what `git hash-object` prints).
+    """
+    h = hashlib.sha1()
+    h.update(b'blob %d\0' % os.path.getsize(path))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def rename_files(moves):
+    """
+    @brief Apply a batch of renames, in an order that never overwrites a
+        file that is still to be moved.
+    
+    Each move is done once, after the move out of its destination; a cycle
+    (a -> b -> a) is broken by parking one file under a temporary name.
+    
+    :param moves: (old path, new path) pairs. No two may share a new path.
+    :type moves: list
+    """
+    pending = dict(moves)
+    if len(set(pending.values())) != len(pending):
+        raise RuntimeError("rename: two files would get the same name")
+    for (src, dst) in pending.items():
+        if os.path.exists(dst) and dst not in pending:
+            raise RuntimeError("%s: file already exists" % dst)
+    
+    for start in list(pending.keys()):
+        chain = []
+        src = start
+        while src in pending and src not in chain:
+            chain.append(src)
+            src = pending[src]
+        if not chain:
+            continue
+        if src == chain[0] and len(chain) > 1:
+            tmp = '%s.renumber-%d' % (chain[0], os.getpid())
+            logger.info("[shell] mv %s %s" % (chain[0], tmp))
+            os.rename(chain[0], tmp)
+            pending[tmp] = pending.pop(chain[0])
+            chain[0] = tmp
+        for src in reversed(chain):
+            dst = pending.pop(src)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            logger.info("[shell] mv %s %s" % (src, dst))
+            os.rename(src, dst)
+
 def parse_cfg(path):
     cfg = {}
     with open(path, 'r') as cfg_file:
@@ -80,7 +147,7 @@ class Config(object):
                 changes = True
         for (k, v) in template_config.items():
             if k not in user_config:
-                user_config.update({k: str(v.thetype(v.value)) or ''})
+                user_config.update({k: v.get_value() or ''})
                 changes = True
         
         if not changes:
@@ -190,6 +257,7 @@ class NovelEnvironment(object):
     
     config_path = None
     title = None
+    excluded = None
     
     def __init__(self, projdir=None, config_path=None, last_edit=None, title=None):
         self.last_edit = last_edit
@@ -212,6 +280,32 @@ class NovelEnvironment(object):
         
         self.title = title
     
+    def local_path(self, name):
+        """
+        @brief Path of a file in the data directory that belongs to this
+            working copy only (queues, caches, indexes).
+        
+        The path is added to `.git/info/exclude`, which git never commits,
+        so the file stays out of commits and of `git status`.
+        """
+        if self.excluded is None:
+            self.excluded = set()
+            exclude_path = os.path.join(self.proj_path, '.git', 'info',
+                                        'exclude')
+            if os.path.exists(exclude_path):
+                with open(exclude_path) as exclude_file:
+                    self.excluded = set(l.strip() for l in exclude_file)
+        entry = '/.novel/%s' % name
+        if entry not in self.excluded and \
+                os.path.isdir(os.path.join(self.proj_path, '.git')):
+            info_dir = os.path.join(self.proj_path, '.git', 'info')
+            if not os.path.isdir(info_dir):
+                os.makedirs(info_dir)
+            with open(os.path.join(info_dir, 'exclude'), 'a') as exclude_file:
+                exclude_file.write('%s\n' % entry)
+            self.excluded.add(entry)
+        return os.path.join(self.data_dir, name)
+    
     @classmethod
     def load(Klass, path=None):
         if not path:
@@ -236,6 +330,204 @@ class NovelEnvironment(object):
             'title': self.title,
             })
 
+# How often, and how long apart, `Novel.load` tries to read a snapshot while
+# another process is writing.
+SNAPSHOT_RETRIES = 200
+SNAPSHOT_WAIT = 0.05
+
+class ProjectLock(object):
+    """
+    @brief Advisory lock on a project (`.novel/lock`), taken by every process
+        that writes to it.
+    
+    The lock is re-entrant within a process. Readers do not take it: the
+    data files are replaced atomically, and `.novel/generation` counts
+    write batches like a sequence lock -- odd while a batch is being
+    written, even once it is done -- so a reader can tell whether what it
+    read is a consistent snapshot (see `Novel.load`).
+    """
+    
+    def __init__(self, env):
+        self.path = env.local_path('lock')
+        self.generation_path = env.local_path('generation')
+        self.fd = None
+        self.depth = 0
+        self.batches = 0
+    
+    def acquire(self):
+        if self.depth == 0:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logger.info("waiting for another process to release %s"
+                                % self.path)
+                    fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+    
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            os.close(self.fd)
+            self.fd = None
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+    
+    def held_elsewhere(self):
+        """
+        :returns: True if another process (or file handle) holds the lock
+        """
+        if fcntl is None or self.depth > 0:
+            return False
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+    
+    def generation(self):
+        try:
+            with open(self.generation_path) as generation_file:
+                return int(generation_file.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+    
+    def set_generation(self, n):
+        tmp = '%s.%d' % (self.generation_path, os.getpid())
+        with open(tmp, 'w') as generation_file:
+            generation_file.write('%d\n' % n)
+        os.replace(tmp, self.generation_path)
+
+class WriteBatch(object):
+    """
+    @brief See `Novel.writing`. Nested batches count as one.
+    """
+    
+    def __init__(self, lock):
+        self.lock = lock
+    
+    def __enter__(self):
+        self.lock.acquire()
+        if self.lock.batches == 0:
+            n = self.lock.generation()
+            # An odd generation here means a writer died mid-batch.
+            self.lock.set_generation(n + 1 + n % 2)
+        self.lock.batches += 1
+        return self
+    
+    def __exit__(self, *exc):
+        self.lock.batches -= 1
+        try:
+            if self.lock.batches == 0:
+                self.lock.set_generation(self.lock.generation() + 1)
+        finally:
+            self.lock.release()
+
+# Bump when the pickled layout of the model classes changes incompatibly
+# (`SnapshotCache` also notices when this module changes).
+SNAPSHOT_FORMAT = 1
+
+class _SnapshotPickler(pickle.Pickler):
+    
+    def __init__(self, f, novel):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.novel = novel
+    
+    def persistent_id(self, obj):
+        # The novel itself, with its config, environment and lock, is made
+        # fresh by `Novel.load`; only what hangs off it is cached.
+        if obj is self.novel:
+            return 'novel'
+        return None
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    
+    def __init__(self, f, novel):
+        pickle.Unpickler.__init__(self, f)
+        self.novel = novel
+    
+    def persistent_load(self, pid):
+        if pid != 'novel':
+            raise pickle.UnpicklingError("%s: unknown object" % pid)
+        return self.novel
+
+class SnapshotCache(object):
+    """
+    @brief The loaded object graph of a project -- plotlines, parts,
+        chapters, versions and drafts -- pickled in `.novel/cache/snapshot`.
+    
+    The cache is keyed by the size and mtime of every data file, the config
+    files and this module, and by the project's path and generation, so a
+    hit needs a few `stat` calls and a single read. Anything else is a miss
+    and `Novel.load` parses the data files as usual.
+    """
+    
+    def __init__(self, env):
+        self.env = env
+        self.dir = env.local_path('cache')
+        self.path = os.path.join(self.dir, 'snapshot')
+    
+    def key(self, generation):
+        paths = [self.env.novel_path, self.env.parts_path,
+                 self.env.plotlines_path, self.env.chapters_path,
+                 self.env.versions_path, self.env.drafts_path,
+                 self.env.config_path,
+                 os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'config.csv'),
+                 os.path.abspath(__file__)]
+        stats = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stats.append((path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                stats.append((path, None, None))
+        return (SNAPSHOT_FORMAT, self.env.proj_path, generation, stats)
+    
+    def load(self, key, novel):
+        """
+        @brief Fill `novel` from the cache if it was saved under `key`.
+        
+        :returns: True on a hit
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        try:
+            unpickler = _SnapshotUnpickler(io.BytesIO(data), novel)
+            if unpickler.load() != key:
+                return False
+            (novel.plotlines, novel.parts, novel.chapters, novel.versions,
+             novel.drafts) = unpickler.load()
+        except Exception as e:
+            logger.info("%s: unreadable cache (%s)" % (self.path, e))
+            return False
+        return True
+    
+    def save(self, key, novel):
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        out = io.BytesIO()
+        pickler = _SnapshotPickler(out, novel)
+        pickler.dump(key)
+        pickler.dump((novel.plotlines, novel.parts, novel.chapters,
+                      novel.versions, novel.drafts))
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(out.getvalue())
+        os.replace(tmp, self.path)
+
 class Novel(object):
     title = None
     author = None
@@ -247,12 +539,34 @@ class Novel(object):
     chapters = []
     versions = []
     drafts = []
+    tree = None
     
     def __init__(self, title=None, author=None, config={}, env=None):
         self.title = title
         self.author = author
         self.config = config
         self.env = env
+        self.plotlines = []
+        self.parts = []
+        self.chapters = []
+        self.versions = []
+        self.drafts = []
+        # Generation of the data files this novel was loaded from (see
+        # `ProjectLock`).
+        self.generation = None
+        self._lock = None
+    
+    def project_lock(self):
+        if self._lock is None:
+            self._lock = ProjectLock(self.env)
+        return self._lock
+    
+    def writing(self):
+        """
+        @brief Context manager for changing the data files: holds the
+            project lock and marks the generation as being written.
+        """
+        return WriteBatch(self.project_lock())
     
     def set_config(self, key, value, create=False):
         #if create and key not in self.config:
@@ -283,6 +597,187 @@ class Novel(object):
                 return p
         return None
     
+    def renumber_chapters(self, message=None):
+        """
+        @brief Number the chapters by their position in `chapters`, and move
+            every file whose tag or plotline changed in a single commit.
+        
+        The files are renamed in place (see `rename_files`) and staged as
+        removals and additions, which git records as renames.
+        
+        :returns: list of (old path, new path) of the moved files
+        """
+        moves = []
+        for (i, chapter) in enumerate(self.chapters):
+            chapter.number = i+1
+            (old_path, new_path) = chapter.reset_tag_and_path()
+            if old_path and old_path != new_path and os.path.exists(old_path):
+                moves.append((old_path, new_path))
+        rename_files(moves)
+        self.write_chapters()
+        
+        if moves:
+            self.git_output('rm', '--cached', '-q', '--ignore-unmatch', '--',
+                            *[old for (old, new) in moves])
+        paths = [self.env.chapters_path] + [new for (old, new) in moves]
+        self.git_add_files(paths)
+        self.git_commit_files(paths, message or
+                              "Renumber %d chapters" % len(moves))
+        return moves
+    
+    def chapter_range(self, first, last):
+        """
+        @brief The chapters from tag `first` to tag `last`, inclusive.
+        """
+        return self._range(self.chapters, self.find_chapter, first, last)
+    
+    def part_range(self, first, last):
+        """
+        @brief The parts from tag `first` to tag `last`, inclusive, in the
+            order of `parts`.
+        """
+        return self._range(self.parts, self.find_part, first, last)
+    
+    def _range(self, items, find, first, last):
+        (a, b) = (find(first), find(last))
+        for (tag, item) in ((first, a), (last, b)):
+            if item is None:
+                raise RuntimeError("%s: not found" % tag)
+        (i, j) = (items.index(a), items.index(b))
+        if j < i:
+            raise RuntimeError("%s comes before %s" % (last, first))
+        return items[i:j+1]
+    
+    def _place(self, items, moving, before=None, after=None):
+        # Splice `moving` (in its current order) back into `items` at the
+        # anchor, in one pass; no anchor puts it at the end.
+        rest = [x for x in items if x not in moving]
+        selected = [x for x in items if x in moving]
+        if before is not None:
+            i = rest.index(before)
+        elif after is not None:
+            i = rest.index(after)+1
+        else:
+            i = len(rest)
+        return rest[:i] + selected + rest[i:]
+    
+    def move_chapters(self, chapters, before=None, after=None, part=None,
+                      message=None):
+        """
+        @brief Move several chapters at once, keeping their relative order.
+        
+        The chapters are renumbered and written once at the end, in a single
+        commit (see `renumber_chapters`).
+        
+        :param chapters: Chapters to move, e.g. from `chapter_range`.
+        :type chapters: list
+        
+        :param before: Put them before this chapter.
+        :type before: Chapter
+        
+        :param after: Put them after this chapter.
+        :type after: Chapter
+        
+        :param part: Also move them into this part.
+        :type part: Part
+        
+        :returns: list of (old path, new path) of the renamed files
+        """
+        moving = set(chapters)
+        for anchor in (before, after):
+            if anchor is not None and anchor in moving:
+                raise RuntimeError("%s: cannot move a chapter next to itself"
+                                   % anchor.tag)
+        self.chapters = self._place(self.chapters, moving, before, after)
+        if part is not None:
+            for chapter in chapters:
+                chapter.part = part
+        for p in self.parts:
+            p.chapters = []
+        for chapter in self.chapters:
+            if chapter.part is not None:
+                chapter.part.chapters.append(chapter)
+        return self.renumber_chapters(message or
+                                      "Move %d chapters" % len(moving))
+    
+    def move_parts(self, parts, before=None, after=None, parent=None,
+                   message=None):
+        """
+        @brief Move several parts, with everything below them, at once.
+        
+        With `before` or `after` the parts become siblings of that part,
+        which must then be a child of `parent` if that is given too;
+        otherwise they become the last children of `parent` (or top-level
+        parts if it is None). Parts and chapters are written once, in a
+        single commit.
+        """
+        moving = set(parts)
+        # A part's descendants move with it.
+        for p in self.parts:
+            q = p.parent
+            while q is not None and p not in moving:
+                if q in moving:
+                    moving.add(p)
+                q = q.parent
+        anchor = before or after
+        if anchor is not None:
+            if anchor in moving:
+                raise RuntimeError("%s: cannot move a part next to itself"
+                                   % anchor.tag)
+            if parent is not None and anchor.parent is not parent:
+                raise RuntimeError("%s: not a part of %s" % (anchor.tag,
+                                                             parent.tag))
+            parent = anchor.parent
+        elif parent is not None:
+            if parent in moving:
+                raise RuntimeError("%s: cannot move a part below itself"
+                                   % parent.tag)
+        if after is not None:
+            # Land after the anchor's own children too.
+            below = set([after])
+            for p in self.parts:
+                if p.parent in below:
+                    below.add(p)
+            after = [p for p in self.parts if p in below and
+                     p not in moving][-1]
+        elif anchor is None and parent is not None:
+            below = set([parent])
+            for p in self.parts:
+                if p.parent in below:
+                    below.add(p)
+            after = [p for p in self.parts if p in below and
+                     p not in moving][-1]
+        
+        roots = [p for p in parts if p.parent not in moving]
+        self.parts = self._place(self.parts, moving, before, after)
+        for p in roots:
+            p.parent = parent
+        for p in self.parts:
+            p.children = []
+        for p in self.parts:
+            if p.parent is not None:
+                p.parent.children.append(p)
+        
+        # Chapters refer to their part by tag, which may have changed.
+        with self.writing():
+            self.write_parts()
+            self.write_chapters()
+        paths = [self.env.parts_path, self.env.chapters_path]
+        self.git_add_files(paths)
+        self.git_commit_files(paths, message or "Move %d parts" % len(parts))
+    
+    def index_parts(self):
+        """
+        @brief Rebuild the part tree (see `PartTree`).
+        """
+        self.tree = PartTree(self)
+        return self.tree
+    
+    def part_tree(self):
+        if self.tree is None:
+            return self.index_parts()
+        return self.tree
+    
     def find_part(self, tag):
         for p in self.parts:
             if p.tag == tag:
@@ -295,13 +790,31 @@ class Novel(object):
                 return p
         return None
     
+    def find_version(self, tag):
+        """
+        @brief Find a version by number, or a draft by number prefixed with
+            'd' (e.g. 'd2').
+        """
+        tag = str(tag)
+        versions = self.versions
+        if tag[:1] == 'd':
+            (versions, tag) = (self.drafts, tag[1:])
+        if not tag.isdigit() or not 0 < int(tag) <= len(versions):
+            return None
+        return versions[int(tag)-1]
+    
     def _write_csv(self, obj_set, path):
         p = os.path.join(self.env.proj_path, path)
-        with open(path, 'w') as csv_file:
-            csv_writer = csv.writer(csv_file)
-            for obj in obj_set:
-                obj.write_row(csv_writer)
-            csv_file.close()
+        # Write a new file and rename it over the old one, so that readers
+        # never see a half-written file.
+        tmp = '%s.%d' % (p, os.getpid())
+        with self.writing():
+            with open(tmp, 'w') as csv_file:
+                csv_writer = csv.writer(csv_file)
+                for obj in obj_set:
+                    obj.write_row(csv_writer)
+                csv_file.close()
+            os.replace(tmp, p)
     
     def _get_data_path(self, p):
         return os.path.join(self.env.proj_path, p)
@@ -311,9 +824,11 @@ class Novel(object):
     
     def write_parts(self):
         self._write_csv(self.parts, self.env.parts_path)
+        self.tree = None
     
     def write_chapters(self):
         self._write_csv(self.chapters, self.env.chapters_path)
+        self.tree = None
     
     def write_versions(self):
         self._write_csv(self.versions, self.env.versions_path)
@@ -327,54 +842,297 @@ class Novel(object):
                 cfg_file.write('%s=%s\n' % (k, v.get_value()))
             cfg_file.close()
     
-    def bind(self, comment=None, stage=None):
-        num = len(self.versions)+1
-        # Create a temporary filename for the novel.
-        outpath = '%s_%d.%s' % (machine_str(self.title),
-                                num,
-                             self.get_config('chapter.ext'))
-        title = (
-            '<h1 id="title">%s<h1>' % self.title,
-            '<h1 id="by">by</h1>',
-            '<h1 id="author">%s<h1>' % self.author
-            )
-        with open(outpath, "w+") as outfile:
-            for t in title:
-                outfile.write('%s\n' % t)
-            
-            if self.parts and len(self.parts) > 0:
-                for p in self.parts:
-                    p.create_version(outfile)
+    def walk(self, h=2, read=False, parts=None):
+        """
+        @brief Yield every part and chapter in reading order.
+        
+        :param h: Heading level of the top-level parts.
+        :type h: int
+        
+        :param read: Also yield each chapter's text (None for parts).
+        :type read: bool
+        
+        :param parts: Only walk these parts, each with everything below it.
+        :type parts: list
+        
+        :returns: (Part or Chapter, heading level) pairs, or triples with
+            the text if `read` is set
+        """
+        nodes = []
+        if parts is not None:
+            nodes = (node for p in parts for node in p.walk(h))
+        elif self.parts and len(self.parts) > 0:
+            # Chapters outside any part follow the parts.
+            nodes = itertools.chain(
+                (node for p in self.parts if p.parent is None
+                 for node in p.walk(h)),
+                ((c, h+1) for c in self.chapters if c.part is None))
+        else:
+            nodes = ((c, h+1) for c in self.chapters)
+        for (obj, level) in nodes:
+            if not read:
+                yield (obj, level)
+            elif isinstance(obj, Part):
+                yield (obj, level, None)
             else:
-                for c in self.chapters:
-                    c.create_version(outfile)
+                yield (obj, level, obj.read())
+    
+    def iter_render(self, format='native', parts=None):
+        """
+        @brief Render the novel, or some of its parts, as a stream of chunks.
+        
+        Nothing is written to disk and git is not run: the chapter files
+        are read one at a time and each rendered chunk is yielded as soon as
+        it is ready, e.g. to send a book over a socket with bounded memory.
+        Unlike `bind`, no version is recorded.
+        
+        :param format: Name of the renderer (see `renderers.RENDERERS`).
+        :type format: str
+        
+        :param parts: Parts, or part tags, to render, each with everything
+            below it. Defaults to the whole novel.
+        :type parts: list
+        
+        :returns: generator of str chunks, or of bytes for binary formats
+            such as epub
+        """
+        from renderers import get_renderer, iter_render
+        
+        renderer = get_renderer(format)(self)
+        if parts is not None:
+            found = []
+            for p in parts:
+                part = p if isinstance(p, Part) else self.find_part(p)
+                if part is None:
+                    raise RuntimeError("%s: part not found" % p)
+                found.append(part)
+            parts = found
+        return iter_render(renderer, self.walk(read=True, parts=parts))
+    
+    def bind(self, comment=None, stage=None, formats=None, workers=None):
+        """
+        @brief Record the novel as a new version (or draft) and render it.
+        
+        The version is stored as a manifest of the chapters' git blob ids
+        (see `Manifest`); only the manifest and the chapter files are
+        committed. The rendered files go to the local cache and can be
+        re-created at any time with `Version.materialize`.
+        
+        :param formats: Names of the renderers to use (see
+            `renderers.RENDERERS`). Defaults to the native `chapter.ext`
+            markup.
+        :type formats: list
+        
+        :param workers: Process pool size for CPU-heavy formats. Defaults to
+            the `bind.workers` setting.
+        :type workers: int
+        
+        :returns: The new Version or Draft
+        """
+        from renderers import get_renderer, render
+        
+        if workers is None:
+            workers = int(self.get_config('bind.workers') or 0)
+        formats = formats or ['native']
+        
+        renderers = []
+        for f in formats:
+            r = get_renderer(f)(self)
+            if r.ext in [x.ext for x in renderers]:
+                raise RuntimeError("%s: output requested twice" % r.ext)
+            r.outpath = Manifest.tmp_path(self, '%s.%s' % (
+                machine_str(self.title), r.ext))
+            renderers.append(r)
+        
+        manifest = Manifest(self, {
+            'title': self.title,
+            'author': str(self.author),
+            'formats': ';'.join(formats),
+            'chapter.ext': self.get_config('chapter.ext'),
+            })
+        for r in renderers:
+            r.open()
+        try:
+            render(self, renderers, workers, manifest.record(self.walk()))
+        finally:
+            for r in renderers:
+                r.close()
+        manifest_path = manifest.write()
+        
+        # Rendering works from the snapshot this novel was loaded from; only
+        # recording the version needs the lock.
+        with self.project_lock():
+            # Other processes may have bound versions in the meantime.
+            if (len(load_csv(self.env.versions_path)) != len(self.versions) or
+                len(load_csv(self.env.drafts_path)) != len(self.drafts)):
+                (self.versions, self.drafts) = ([], [])
+                Version.from_file(self)
+                Draft.from_file(self)
+            num = len(self.versions)+1
+            names = ['%s_%d.%s' % (machine_str(self.title), num, r.ext)
+                     for r in renderers]
+            for (r, name) in zip(renderers, names):
+                os.rename(r.outpath, manifest.cache_path(name))
             
-            outfile.close()
-        self.git_add_files([outpath,])
-        self.git_commit_files([outpath,], "Creating version %d" % num)
-        
-        commits = self.git_file_commits(outpath)
-        (git_hash, timestamp) = commits[0]
-        
-        if stage:
-            draft = Draft(self, outpath, stage, git_hash, comment, timestamp)
-            self.drafts.append(draft)
-            self.write_drafts()
-            self.git_commit_files([self.env.drafts_path,],
-                                  "Create draft %s" % draft.stage)
-            return draft
-        else:
-            version = Version(self, outpath, git_hash, comment, timestamp)
-            self.versions.append(version)
-            self.write_versions()
-            self.git_commit_files([self.env.versions_path,],
-                                  "Create version %s" % version.number)
-            return version
+            paths = [manifest_path] + [c.path for c in self.chapters
+                                       if os.path.exists(c.path)]
+            self.git_add_files(paths)
+            self.git_commit_files(paths, "Creating version %d" % num)
+            self.git_flush()
+            
+            commits = self.git_file_commits(manifest_path)
+            (git_hash, timestamp) = commits[0]
+            
+            if stage:
+                draft = Draft(self, names[0], stage, git_hash, comment,
+                              timestamp, names, manifest.id)
+                self.drafts.append(draft)
+                self.write_drafts()
+                self.git_commit_files([self.env.drafts_path,],
+                                      "Create draft %s" % draft.stage)
+                return draft
+            else:
+                version = Version(self, names[0], git_hash, comment, timestamp,
+                                  names, manifest.id)
+                self.versions.append(version)
+                self.write_versions()
+                self.git_commit_files([self.env.versions_path,],
+                                      "Create version %s" % version.number)
+                return version
+    
+    def archive_versions(self, age=None):
+        """
+        @brief Move the bound files of old versions and drafts into
+            `.novel/archive/`, gzip-compressed.
+        
+        Only versions bound before manifests have files in the working tree;
+        those are compressed and removed from it in one commit, and
+        `Version.resolve` reads them back from the archive. Versions with a
+        manifest only lose their rendered files from the local cache, since
+        they can be rendered again.
+        
+        :param age: Minimum age in days. Defaults to the `archive.age`
+            setting.
+        :type age: float
+        
+        :returns: The archived versions and drafts
+        """
+        if age is None:
+            age = float(self.get_config('archive.age') or 0)
+        cutoff = time.time() - age * 86400
+        archived = []
+        paths = []
+        keep = set(v.manifest for v in self.versions + self.drafts
+                   if v.manifest and v.bound_at() >= cutoff)
+        for v in self.versions + self.drafts:
+            if v.bound_at() >= cutoff:
+                continue
+            if v.manifest:
+                if v.manifest in keep:
+                    continue
+                cache = os.path.join(self.env.local_path('cache'),
+                                     v.manifest[:12])
+                if os.path.isdir(cache):
+                    shutil.rmtree(cache)
+                    archived.append(v)
+                continue
+            moved = False
+            for name in v.outputs:
+                src = os.path.join(self.env.proj_path, name)
+                if not os.path.exists(src):
+                    continue
+                dest = v.archive_path(name)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                tmp = '%s.%d' % (dest, os.getpid())
+                with open(src, 'rb') as infile, open(tmp, 'wb') as raw:
+                    with gzip.GzipFile(name, 'wb', fileobj=raw, mtime=0) as outfile:
+                        shutil.copyfileobj(infile, outfile, 1024*1024)
+                os.rename(tmp, dest)
+                os.remove(src)
+                paths.append(dest)
+                moved = True
+            if moved:
+                archived.append(v)
+        if paths:
+            self.git_add_files(paths)
+            self.git_commit_files(paths, "Archive %d bound files" % len(paths))
+        return archived
+    
+    def chapter_hashes(self):
+        """
+        @brief The git blob id of every chapter in the working tree.
+        
+        Ids are taken from the git index; only chapters git reports as
+        modified (by size and mtime) or that are not tracked are read and
+        hashed.
+        
+        :returns: list of (path, title, blob id) in reading order. Paths are
+            relative to the project; the blob id is None if the file is
+            missing.
+        """
+        proj_path = self.env.proj_path
+        paths = [os.path.relpath(c.path, proj_path) for c in self.chapters]
+        if not paths:
+            return []
+        staged = {}
+        for line in self.git_output('-c', 'core.quotepath=off', 'ls-files',
+                                    '-s', '--', *paths).splitlines():
+            (meta, path) = line.split('\t', 1)
+            staged[path] = meta.split()[1]
+        dirty = set(self.git_output('-c', 'core.quotepath=off', 'diff-files',
+                                    '--name-only', '--', *paths).splitlines())
+        hashes = []
+        for (chapter, path) in zip(self.chapters, paths):
+            h = staged.get(path)
+            if h is None or path in dirty:
+                h = None
+                if os.path.exists(chapter.path):
+                    h = blob_hash(chapter.path)
+            hashes.append((path, chapter.title, h))
+        return hashes
+    
+    def git_output(self, *args):
+        import subprocess
+        CMD = [self.get_config('git.path'), '-C', self.env.proj_path] + list(args)
+        logger.info("[shell] %s" % ' '.join(CMD))
+        return subprocess.check_output(CMD, universal_newlines=True)
+    
+    def git_blobs(self, hashes):
+        """
+        @brief Read git blobs through a single `git cat-file --batch`.
+        
+        :param hashes: Iterable of blob ids; None yields an empty blob.
+        
+        :returns: generator of blob contents (bytes), in order
+        """
+        import subprocess
+        CMD = [self.get_config('git.path'), '-C', self.env.proj_path,
+               'cat-file', '--batch']
+        logger.info("[shell] %s" % ' '.join(CMD))
+        proc = subprocess.Popen(CMD, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        try:
+            for h in hashes:
+                if h is None:
+                    yield b''
+                    continue
+                proc.stdin.write(('%s\n' % h).encode())
+                proc.stdin.flush()
+                header = proc.stdout.readline().split()
+                if len(header) < 3:
+                    raise RuntimeError("%s: git object not found" % h)
+                data = proc.stdout.read(int(header[2]))
+                proc.stdout.read(1)
+                yield data
+        finally:
+            proc.stdin.close()
+            proc.wait()
     
     def git_file_commits(self, path):
         import subprocess
         git = self.get_config('git.path')
-        CMD = [git, 'log', '--pretty="format:%H;%ai"', '--', path]
+        CMD = [git, 'log', '--pretty=format:%H;%ai', '--', path]
         logger.info("[shell] %s" % ' '.join(CMD))
         out = subprocess.check_output(CMD, universal_newlines=True)
         lines = out.split('\n')
@@ -400,16 +1158,21 @@ class Novel(object):
                 raise RuntimeError("%s: path not found\n" % i)
             
         git_cmd = self.get_config('git.path')
-        for p in paths:
-            CMD=[git_cmd, 'add', p]
-            logger.info("[shell] %s" % (" ".join(CMD)))
-            return subprocess.call(CMD)
+        CMD=[git_cmd, 'add'] + paths
+        logger.info("[shell] %s" % (" ".join(CMD)))
+        ret = subprocess.call(CMD)
         
         os.chdir(curr_dir)
+        return ret
         
     def git_commit_files(self, paths=[], message=None):
-        import subprocess
+        """
+        @brief Commit `paths` (and any other tracked changes).
         
+        When `git.commit_interval` or `git.commit_changes` is set, the commit
+        is queued in `.novel/pending` instead, and the queue is committed as
+        one once it is old enough or long enough (see `git_flush`).
+        """
         curr_dir = os.path.abspath(os.path.dirname('.'))
         os.chdir(self.env.proj_path)
         
@@ -417,20 +1180,104 @@ class Novel(object):
             if not os.path.exists(p):
                 raise RuntimeError("%s: path not found" % p)
         
+        paths = [os.path.abspath(p) for p in paths]
+        os.chdir(curr_dir)
+        
+        if not self._coalescing():
+            return self._git_commit(paths, message)
+        
+        with self.project_lock():
+            with open(self.env.local_path('pending'), 'a') as pending_file:
+                csv.writer(pending_file).writerow(
+                    [time.time(), message or '[autocommit]', ';'.join(paths)])
+            return self.git_flush(force=False)
+    
+    def _coalescing(self):
+        return (float(self.get_config('git.commit_interval') or 0) > 0 or
+                int(self.get_config('git.commit_changes') or 0) > 1)
+    
+    def _git_commit(self, paths, message=None):
+        import subprocess
+        
+        curr_dir = os.path.abspath(os.path.dirname('.'))
+        os.chdir(self.env.proj_path)
+        
         git_cmd = self.get_config('git.path')
         CMD=[git_cmd, 'commit', '-am', '"[autocommit]"']
         if message:
             CMD = [git_cmd, 'commit', '-am', '"%s"' % message]
         logger.info("[shell] %s" % (" ".join(CMD)))
-        return subprocess.call(CMD)
-    
+        with self.project_lock():
+            ret = subprocess.call(CMD)
+        
         os.chdir(curr_dir)
+        return ret
+    
+    def pending_commits(self):
+        """
+        :returns: queued [timestamp, message, paths] rows
+        """
+        pending_path = os.path.join(self.env.data_dir, 'pending')
+        if not os.path.exists(pending_path):
+            return []
+        return [[float(r[0]), r[1], [p for p in r[2].split(';') if p]]
+                for r in load_csv(pending_path) if r]
+    
+    def git_flush(self, force=True):
+        """
+        @brief Commit every queued change in a single commit.
+        
+        :param force: If False, only commit when the oldest queued change is
+            older than `git.commit_interval` seconds or at least
+            `git.commit_changes` changes are queued.
+        :type force: bool
+        
+        :returns: The number of changes committed
+        """
+        pending = self.pending_commits()
+        if not pending or not (force or self._due(pending)):
+            return 0
+        # A due queue is committed even if another process is writing: it
+        # only flushes what was queued when it started, so waiting for it
+        # to do so could leave the queue until the next writer runs.
+        with self.project_lock():
+            return self._flush(force)
+    
+    def _due(self, pending):
+        interval = float(self.get_config('git.commit_interval') or 0)
+        max_changes = int(self.get_config('git.commit_changes') or 0)
+        return ((interval > 0 and time.time() - pending[0][0] >= interval) or
+                (max_changes > 0 and len(pending) >= max_changes))
+    
+    def _flush(self, force):
+        pending = self.pending_commits()
+        if not pending or not (force or self._due(pending)):
+            return 0
+        
+        paths = []
+        for (timestamp, message, row_paths) in pending:
+            for p in row_paths:
+                if p not in paths:
+                    paths.append(p)
+        # Stage new files and removals; `commit -a` only sees tracked ones.
+        existing = [p for p in paths if os.path.exists(p)]
+        if existing:
+            self.git_add_files(existing)
+        
+        if len(pending) == 1:
+            message = pending[0][1]
+        else:
+            message = "%d changes\n\n%s" % (len(pending), '\n'.join(
+                "- %s" % r[1] for r in pending))
+        self._git_commit(paths, message)
+        os.remove(os.path.join(self.env.data_dir, 'pending'))
+        return len(pending)
     
     def git_commit_data(self, datafile, message=None):
         self.git_commit_files([datafile,], message)
         
     @classmethod
-    def load(Klass, path=None):
+    def load(Klass, path=None, lock=None):
         """
         @brief Given a project's path, load the novel from that path.
         
@@ -438,6 +1285,10 @@ class Novel(object):
             directory.
         :type path: str
         
+        :param lock: The project's lock, if the caller holds it; otherwise
+            the novel is read as a consistent snapshot without locking.
+        :type lock: ProjectLock
+        
         :returns: A new Novel
         """
         
@@ -448,14 +1299,40 @@ class Novel(object):
         #print("Config: %s" % pformat(cfg))
         author = Author.from_config(cfg)
         
-        novel = Novel(env.title, author, cfg, env)
-        
-        Part.from_file(novel)
-        Plotline.from_file(novel)
-        Chapter.from_file(novel)
-        Version.from_file(novel)
-        Draft.from_file(novel)
+        # Read without taking the lock: retry until the generation is the
+        # same before and after, with no write in progress.
+        lock = lock or ProjectLock(env)
+        cache = SnapshotCache(env)
+        for attempt in range(SNAPSHOT_RETRIES):
+            generation = lock.generation()
+            if generation % 2 and lock.held_elsewhere():
+                time.sleep(SNAPSHOT_WAIT)
+                continue
+            
+            novel = Novel(env.title, author, cfg, env)
+            
+            key = cache.key(generation)
+            hit = cache.load(key, novel)
+            if not hit:
+                Part.from_file(novel)
+                Plotline.from_file(novel)
+                Chapter.from_file(novel)
+                Version.from_file(novel)
+                Draft.from_file(novel)
+            novel.index_parts()
+            
+            if lock.generation() == generation:
+                if not hit and generation % 2 == 0 and \
+                        cache.key(generation) == key:
+                    cache.save(key, novel)
+                break
+            logger.info("project changed while loading; reading it again")
+        else:
+            raise RuntimeError("%s: could not get a consistent snapshot" %
+                               env.proj_path)
         
+        novel.generation = generation
+        novel._lock = lock
         return novel
     
     def __repr__(self):
@@ -493,6 +1370,7 @@ class Plotline(Novelable, Commentable, Taggable):
         self.novel = novel
         self.tag = tag
         self.comment = comment
+        self.chapters = []
     
     def create_directory(self):
         os.makedirs(self.path)
@@ -529,16 +1407,29 @@ class Part(Novelable, Taggable):
         self.novel = novel
         self.title = title
         self.parent = parent
+        self.children = []
+        self.chapters = []
         
         if self.parent:
             self.parent.children.append(self)
     
-    def create_version(self, outfile, h=2):
+    def formatted_title(self):
         fmt = self.novel.get_config("title_format.part")
-        outfile.write(fmt % {
+        return fmt % {
             'title': self.title,
             'number': self.number,}
-        )
+    
+    def walk(self, h=2):
+        yield (self, h)
+        for child in self.children:
+            for node in child.walk(h=h+1):
+                yield node
+        for chapter in self.chapters:
+            if chapter.part is self:
+                yield (chapter, h+1)
+    
+    def create_version(self, outfile, h=2):
+        outfile.write(self.formatted_title())
         for child in self.children:
             child.create_version(outfile, h=h+1)
         for chapter in self.chapters:
@@ -553,10 +1444,13 @@ class Part(Novelable, Taggable):
     
     @property
     def tag(self):
+        return self.make_tag(self.number)
+    
+    def make_tag(self, number):
         if self.title is None:
-            return '%d' % self.number
+            return '%d' % number
         else:
-            return '%d__%s' % (self.number, machine_str(self.title))
+            return '%d__%s' % (number, machine_str(self.title))
         
     @classmethod
     def from_file(Klass, novel):
@@ -566,7 +1460,7 @@ class Part(Novelable, Taggable):
                 (title, parent) = row
                 
                 parent = novel.find_part(parent)
-                part = Part(novel, title, parent=parent)
+                part = Part(novel, title or None, parent=parent)
                 
                 novel.parts.append(part)
             partsfile.close()
@@ -582,6 +1476,150 @@ class Part(Novelable, Taggable):
             return 'Part %d: %s' % (self.number, self.title)
         return 'Part %d' % self.number
 
+def _add(a, b, sign=1):
+    return (a[0] + sign*b[0], a[1] + sign*b[1])
+
+class PartTree(object):
+    """
+    @brief The part hierarchy of a novel, indexed in a single pass over its
+        parts and chapters.
+    
+    `Novel.load` builds the tree and writing the parts or chapters drops
+    it; call `Novel.index_parts` after changing them without writing.
+    """
+    
+    def __init__(self, novel):
+        # Top-level parts, and every part's child parts and chapters, in
+        # order; numbers are the parts' positions among their siblings.
+        self.roots = []
+        self.children = {}
+        self.chapters = {}
+        self.numbers = {}
+        self.orphans = []
+        for part in novel.parts:
+            self.children[part] = []
+            self.chapters[part] = []
+        for (i, part) in enumerate(novel.parts):
+            if part.parent is None:
+                # Like `Part.number`, top-level parts count every part.
+                self.roots.append(part)
+                self.numbers[part] = i+1
+            else:
+                siblings = self.children.setdefault(part.parent, [])
+                siblings.append(part)
+                self.numbers[part] = len(siblings)
+        self.plotlines = {}
+        for chapter in novel.chapters:
+            if chapter.part is None or chapter.part not in self.chapters:
+                self.orphans.append(chapter)
+            else:
+                self.chapters[chapter.part].append(chapter)
+            if chapter.plotline is not None:
+                self.plotlines.setdefault(chapter.plotline, []).append(chapter)
+        # (words, characters) of the chapters counted so far, and the totals
+        # of the parts (with their child parts) and plotlines summed so far;
+        # see `total`.
+        self.counts = {}
+        self.totals = {}
+    
+    def count(self, chapter):
+        """
+        @brief The (words, characters) of a chapter, read once.
+        """
+        if chapter not in self.counts:
+            self.counts[chapter] = chapter.counts()
+        return self.counts[chapter]
+    
+    def rollup(self):
+        """
+        @brief Count every chapter and sum the counts up the tree.
+        
+        Later changes to single chapters go through `recount`.
+        """
+        for part in self.roots:
+            self.total(part)
+        for plotline in self.plotlines:
+            self.total(plotline)
+        for chapter in self.orphans:
+            self.count(chapter)
+        return self.totals
+    
+    def total(self, obj):
+        """
+        @brief The (words, characters) of a part, including its child parts,
+            or of a plotline.
+        
+        Only the chapters below `obj` are read, and only the first time;
+        `recount` keeps the totals up to date after that.
+        """
+        if obj in self.totals:
+            return self.totals[obj]
+        if obj not in self.chapters:
+            total = (0, 0)
+            for chapter in self.plotlines.get(obj, []):
+                total = _add(total, self.count(chapter))
+            self.totals[obj] = total
+            return total
+        # Children come after their parents in `walk`, so going backwards
+        # every part is complete before it is added to its parent.
+        for part in reversed(list(self._subtree(obj))):
+            if part in self.totals:
+                continue
+            total = (0, 0)
+            for chapter in self.chapters[part]:
+                total = _add(total, self.count(chapter))
+            for child in self.children[part]:
+                total = _add(total, self.totals[child])
+            self.totals[part] = total
+        return self.totals[obj]
+    
+    def recount(self, chapter):
+        """
+        @brief Count one chapter again and apply the difference to the
+            totals of its part, the part's ancestors and its plotline.
+        
+        :returns: The new (words, characters) of the chapter
+        """
+        new = chapter.counts()
+        old = self.counts.get(chapter)
+        self.counts[chapter] = new
+        if old is None:
+            # No total includes a chapter that was never counted.
+            return new
+        delta = _add(new, old, -1)
+        if delta == (0, 0):
+            return new
+        part = chapter.part
+        while part is not None and part in self.totals:
+            self.totals[part] = _add(self.totals[part], delta)
+            part = part.parent
+        if chapter.plotline in self.totals:
+            self.totals[chapter.plotline] = _add(
+                self.totals[chapter.plotline], delta)
+        return new
+    
+    def _subtree(self, part):
+        stack = [part]
+        while stack:
+            part = stack.pop()
+            yield part
+            stack.extend(reversed(self.children[part]))
+    
+    def walk(self):
+        """
+        @brief Every part depth-first, without recursion.
+        
+        :returns: generator of (part, depth)
+        """
+        stack = [(p, 0) for p in reversed(self.roots)]
+        while stack:
+            (part, depth) = stack.pop()
+            yield (part, depth)
+            stack.extend((c, depth+1) for c in reversed(self.children[part]))
+    
+    def tag(self, part):
+        return part.make_tag(self.numbers[part])
+
 class Chapter(Novelable, Taggable):
     
     path = None
@@ -607,9 +1645,20 @@ class Chapter(Novelable, Taggable):
         
         if self.tag is None or len(self.tag) == 0:
             self.reset_tag_and_path()
+            if path is not None:
+                # The file stays where it is until the chapters are
+                # renumbered (see `Novel.renumber_chapters`).
+                self.path = os.path.abspath(path)
     
     def reset_tag_and_path(self):
-        old_tag = self.tag
+        """
+        @brief Recompute the tag and path from the number, title and
+            plotline, so a chapter whose plotline changed gets a path in the
+            new plotline's directory even if its tag is the same. The
+            chapter file is not moved.
+        
+        :returns: (old path, new path)
+        """
         old_path = self.path
         
         if self.title is None or len(self.title) == 0:
@@ -619,34 +1668,30 @@ class Chapter(Novelable, Taggable):
             ttl = machine_str(self.title)
             self.tag = '%d__%s' % (self.number, ttl)
                 
-        if self.path is None or old_tag != self.tag:
-            filename = '%s.%s' % (self.tag, self.novel.get_config('chapter.ext'))
-            if self.plotline is not None:
-                pre = os.path.join(self.novel.env.proj_path, self.plotline.tag)
-            else:
-                pre = os.path.join(self.novel.env.proj_path)
-            self.path = os.path.join(pre, filename)
+        filename = '%s.%s' % (self.tag, self.novel.get_config('chapter.ext'))
+        if self.plotline is not None:
+            pre = os.path.join(self.novel.env.proj_path, self.plotline.tag)
+        else:
+            pre = os.path.join(self.novel.env.proj_path)
+        self.path = os.path.abspath(os.path.join(pre, filename))
         
         if old_path is not None:
             old_path = os.path.abspath(old_path)
         
-        if self.path is not None:
-            self.path = os.path.abspath(self.path)
-        
-        if None in (old_path, self.path) or old_path == self.path:
-            return
-        
-        shutil.copy(old_path, self.path)
-        logger.info("[shell] cp %s %s" % (old_path, self.path))
+        return (old_path, self.path)
 
     def word_count(self):
-        count = 0
+        return self.counts()[0]
+    
+    def counts(self):
+        """
+        @brief (words, characters) of the chapter file.
+        """
         if not os.path.exists(self.path):
-            return 0
-        with open(self.path, 'r+') as f:
-            count += len(f.read().split(' '))
-            f.close()
-        return count
+            return (0, 0)
+        with open(self.path, 'r') as f:
+            text = f.read()
+        return (len(text.split(' ')), len(text))
     
     def __repr__(self):
         if self.title:
@@ -677,12 +1722,12 @@ class Chapter(Novelable, Taggable):
                 (path, plotline_tag, part_tag, title) = row
                 (part, plotline) = (None,)*2
                 
-                if part_tag is not None:
+                if part_tag:
                     part = novel.find_part(part_tag)
                     if part is None:
                         raise RuntimeError("%s: part not found" % part_tag)
                             
-                if plotline_tag is not None:
+                if plotline_tag:
                     plotline = novel.find_plotline(plotline_tag)
                     if plotline is None:
                         raise RuntimeError("%s: plotline not found" % plotline_tag)
@@ -702,14 +1747,23 @@ class Chapter(Novelable, Taggable):
                     part.chapters.append(chapter)
             chaptersfile.close()
     
-    def create_version(self, outfile, h=3):
+    def formatted_title(self):
         format_str = self.novel.get_config("title_format.chapter")
         format_vars = {}
         if '%(number)' in format_str:
             format_vars.update({'number': self.number,})
         if '%(title)' in format_str:
             format_vars.update({'title': self.title,})
-        ch_title =  format_str % format_vars
+        return format_str % format_vars
+    
+    def read(self):
+        if not os.path.exists(self.path):
+            return ''
+        with open(self.path, 'r') as chapterfile:
+            return chapterfile.read()
+    
+    def create_version(self, outfile, h=3):
+        ch_title = self.formatted_title()
         outfile.write('<h%d class="chapter">%s</h%d>\n' % (h, ch_title, h))
         with open(self.path, 'r') as chapterfile:
             outfile.write(chapterfile.read())
@@ -723,8 +1777,11 @@ class Version(Taggable, Commentable, Novelable):
     comment=None
     timestamp=None
     path=None
+    outputs=None
+    manifest=None
     
-    def __init__(self, novel, path, git_hash, comment=None, timestamp=None):
+    def __init__(self, novel, path, git_hash, comment=None, timestamp=None,
+                 outputs=None, manifest=None):
         self.novel = novel
         self.path = path
         self.git_hash = git_hash
@@ -732,13 +1789,142 @@ class Version(Taggable, Commentable, Novelable):
         self.timestamp = timestamp
         if not timestamp:
             self.timestamp = datetime.datetime.now()
+        # Every file bound for this version; `path` is the first of them.
+        if isinstance(outputs, str):
+            outputs = [o for o in outputs.split(';') if o]
+        self.outputs = outputs or [path]
+        # Id of the version's Manifest; None for versions bound before
+        # manifests, whose output files were committed instead.
+        self.manifest = manifest or None
     
     @property
     def number(self):
         return self.novel.versions.index(self)+1
     
+    def bound_at(self):
+        """
+        :returns: When the version was bound, as a unix time
+        """
+        timestamp = self.timestamp
+        if isinstance(timestamp, str):
+            try:
+                timestamp = datetime.datetime.fromisoformat(timestamp)
+            except ValueError:
+                timestamp = datetime.datetime.strptime(timestamp,
+                                                       UNIX_DATE_FORMAT)
+        return timestamp.timestamp()
+    
+    def archive_path(self, name):
+        return os.path.join(self.novel.env.data_dir, 'archive', '%s.gz' % name)
+    
+    def resolve(self, name=None):
+        """
+        @brief Path of a bound file of a version without a manifest, reading
+            it back from `.novel/archive/` if it was archived.
+        
+        :param name: One of `outputs`; defaults to `path`.
+        :type name: str
+        """
+        name = name or self.path
+        path = os.path.join(self.novel.env.proj_path, name)
+        archived = self.archive_path(name)
+        if os.path.exists(path) or not os.path.exists(archived):
+            return path
+        cache = os.path.join(self.novel.env.local_path('cache'), 'archive')
+        path = os.path.join(cache, name)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = '%s.%d' % (path, os.getpid())
+            with gzip.open(archived, 'rb') as infile, open(tmp, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, 1024*1024)
+            os.rename(tmp, path)
+        return path
+    
+    def location(self):
+        """
+        @brief Where the bound file of this version is now, without rendering
+            or unpacking it.
+        
+        :returns: (path, state); state is None if the file is there,
+            'archived' if path is the compressed copy `resolve` reads back,
+            'not rendered' if path is where `materialize` will render it,
+            or 'missing'
+        """
+        if self.manifest:
+            path = os.path.join(self.novel.env.local_path('cache'),
+                                self.manifest[:12], self.path)
+            return (path, None if os.path.exists(path) else 'not rendered')
+        path = os.path.join(self.novel.env.proj_path, self.path)
+        if os.path.exists(path):
+            return (path, None)
+        if os.path.exists(self.archive_path(self.path)):
+            return (self.archive_path(self.path), 'archived')
+        return (path, 'missing')
+    
+    def materialize(self, fmt=None):
+        """
+        @brief Get a bound file for this version, rendering it from the
+            manifest if it is not in the cache.
+        
+        :param fmt: Renderer name; defaults to the first format the version
+            was bound in. Any format can be materialized, not only those
+            that were bound.
+        :type fmt: str
+        
+        :returns: Path of the bound file
+        """
+        if not self.manifest:
+            return self.resolve()
+        manifest = Manifest.load(self.novel, self.manifest)
+        return manifest.materialize(self.path, fmt)
+    
+    def chapter_manifest(self):
+        """
+        @brief The chapters as they were at this version.
+        
+        :returns: list of (path, title, blob id) in reading order. Paths are
+            relative to the project; the blob id is None if the chapter file
+            was not committed.
+        """
+        if self.manifest:
+            return [(n.path, n.chapter_title, n.blob) for n in
+                    Manifest.load(self.novel, self.manifest).nodes
+                    if n.kind == 'chapter']
+        # Versions without a manifest are read from git once, then cached.
+        cache_path = self.novel.env.local_path('version-chapters')
+        if os.path.exists(cache_path):
+            rows = [r[1:] for r in load_csv(cache_path)
+                    if r and r[0] == self.git_hash]
+            if rows:
+                return [(p, t, h or None) for (p, t, h) in rows]
+        chapters = self._git_chapters()
+        with open(cache_path, 'a') as cache_file:
+            writer = csv.writer(cache_file)
+            for (p, t, h) in chapters:
+                writer.writerow([self.git_hash, p, t, h or ''])
+        return chapters
+    
+    def _git_chapters(self):
+        proj_path = self.novel.env.proj_path
+        data_path = os.path.relpath(self.novel.env.chapters_path, proj_path)
+        rows = list(csv.reader(self.novel.git_output(
+            'show', '%s:%s' % (self.git_hash, data_path)).splitlines()))
+        paths = [os.path.relpath(os.path.join(proj_path, r[0]), proj_path)
+                 for r in rows if r]
+        titles = [r[3] if len(r) > 3 else '' for r in rows if r]
+        blobs = {}
+        if paths:
+            for line in self.novel.git_output(
+                    '-c', 'core.quotepath=off', 'ls-tree', '-r',
+                    self.git_hash, '--', *paths).splitlines():
+                (meta, path) = line.split('\t', 1)
+                blobs[path] = meta.split()[2]
+        return [(p, t, blobs.get(p)) for (p, t) in zip(paths, titles)]
+    
     def write_row(self, writer):
-        writer.writerow([self.path, self.git_hash, self.comment, self.timestamp])
+        writer.writerow([self.path, self.git_hash, self.comment, self.timestamp,
+                         ';'.join(self.outputs), self.manifest or ''])
     
     @classmethod
     def from_file(Klass, novel):
@@ -753,20 +1939,193 @@ class Draft(Version):
     
     stage = None
     
-    def __init__(self, novel, path, stage, git_hash, comment=None, timestamp=None):
-        super(Draft, self).__init__(novel, git_hash, comment, timestamp)
+    def __init__(self, novel, path, stage, git_hash, comment=None, timestamp=None,
+                 outputs=None, manifest=None):
+        super(Draft, self).__init__(novel, path, git_hash, comment, timestamp,
+                                    outputs, manifest)
         self.stage = stage
     
+    @property
+    def number(self):
+        return self.novel.drafts.index(self)+1
+    
     def write_row(self, writer):
         writer.writerow([self.path, self.stage, self.git_hash, self.comment,
-                         self.timestamp.strftime(UNIX_DATE_FORMAT)])
+                         self.timestamp.strftime(UNIX_DATE_FORMAT),
+                         ';'.join(self.outputs), self.manifest or ''])
     
     @classmethod
     def from_file(Klass, novel):
         with open(novel.env.drafts_path) as drafts_file:
             drafts_reader = csv.reader(drafts_file)
             for row in drafts_reader:
-                timestamp = datetime.datetime.strptime(row[-1], UNIX_DATE_FORMAT)
-                draft = Draft(novel, *row[:-2])
+                timestamp = datetime.datetime.strptime(row[4], UNIX_DATE_FORMAT)
+                draft = Draft(novel, row[0], row[1], row[2], row[3], timestamp,
+                              *row[5:])
                 novel.drafts.append(draft)
             drafts_file.close()
+
+class ManifestNode(object):
+    """
+    @brief A part or chapter as recorded in a Manifest.
+    """
+    
+    def __init__(self, kind, h, title, path=None, blob=None, chapter_title=None):
+        self.kind = kind
+        self.h = int(h)
+        self.title = title
+        self.path = path
+        self.blob = blob or None
+        self.chapter_title = chapter_title
+    
+    def formatted_title(self):
+        return self.title
+    
+    def row(self):
+        if self.kind == 'part':
+            return ['part', self.h, self.title]
+        return ['chapter', self.h, self.title, self.path, self.blob or '',
+                self.chapter_title or '']
+
+class Manifest(object):
+    """
+    @brief A bound version: the rendering parameters plus, in reading order,
+        every part title and every chapter's path and git blob id.
+    
+    Manifests live in `.novel/manifests/` under the sha1 of their contents,
+    so two versions of identical text share one. The chapter blobs are
+    committed with the manifest, which is all that is needed to render the
+    version again; rendered files are kept in `.novel/cache/`.
+    """
+    
+    novel = None
+    params = None
+    nodes = None
+    id = None
+    
+    def __init__(self, novel, params=None, nodes=None, id=None):
+        self.novel = novel
+        self.params = params or {}
+        self.nodes = nodes or []
+        self.id = id
+    
+    @classmethod
+    def directory(Klass, novel):
+        return os.path.join(novel.env.data_dir, 'manifests')
+    
+    @classmethod
+    def tmp_path(Klass, novel, name):
+        cache = novel.env.local_path('cache')
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+        return os.path.join(cache, '.%d.%s' % (os.getpid(), name))
+    
+    def cache_path(self, name):
+        d = os.path.join(self.novel.env.local_path('cache'), self.id[:12])
+        if not os.path.exists(d):
+            os.makedirs(d)
+        return os.path.join(d, name)
+    
+    def record(self, walk):
+        """
+        @brief Wrap `Novel.walk()`, adding each node to the manifest.
+        
+        Every chapter file is read once; the same bytes give the blob id
+        and the text.
+        
+        :returns: generator of (node, heading level, text) for `render`
+        """
+        proj_path = self.novel.env.proj_path
+        for (obj, h) in walk:
+            if isinstance(obj, Part):
+                self.nodes.append(ManifestNode('part', h, obj.formatted_title()))
+                yield (obj, h, None)
+                continue
+            data = b''
+            blob = None
+            if os.path.exists(obj.path):
+                with open(obj.path, 'rb') as chapterfile:
+                    data = chapterfile.read()
+                blob = blob_id(data)
+            self.nodes.append(ManifestNode(
+                'chapter', h, obj.formatted_title(),
+                os.path.relpath(obj.path, proj_path), blob, obj.title))
+            yield (obj, h, data.decode('utf-8'))
+    
+    def _rows(self):
+        rows = [['param', k, v] for (k, v) in sorted(self.params.items())]
+        return rows + [n.row() for n in self.nodes]
+    
+    def write(self):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(self._rows())
+        data = buf.getvalue().encode('utf-8')
+        self.id = hashlib.sha1(data).hexdigest()
+        d = Manifest.directory(self.novel)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        path = os.path.join(d, '%s.csv' % self.id)
+        with open(path, 'wb') as manifest_file:
+            manifest_file.write(data)
+        return path
+    
+    @classmethod
+    def load(Klass, novel, id):
+        path = os.path.join(Klass.directory(novel), '%s.csv' % id)
+        if not os.path.exists(path):
+            raise RuntimeError("%s: manifest not found" % id)
+        manifest = Klass(novel, id=id)
+        for row in load_csv(path):
+            if row[0] == 'param':
+                manifest.params[row[1]] = row[2]
+            else:
+                manifest.nodes.append(ManifestNode(*row))
+        return manifest
+    
+    def iter_nodes(self):
+        """
+        @brief The manifest as (node, heading level, text) for `render`,
+            with chapter text streamed from git one chapter at a time.
+        """
+        blobs = self.novel.git_blobs(n.blob for n in self.nodes
+                                     if n.kind == 'chapter')
+        try:
+            for n in self.nodes:
+                if n.kind == 'part':
+                    yield (n, n.h, None)
+                else:
+                    yield (n, n.h, next(blobs).decode('utf-8'))
+        finally:
+            blobs.close()
+    
+    def materialize(self, name, fmt=None, workers=1):
+        """
+        @brief Render the manifest into the cache unless it is there already.
+        
+        :param name: File name the version was bound as; its extension is
+            replaced when `fmt` differs.
+        :type name: str
+        
+        :returns: Path of the cached file
+        """
+        from renderers import get_renderer, render
+        
+        formats = self.params.get('formats', 'native').split(';')
+        r = get_renderer(fmt or formats[0])(self.novel)
+        r.title = self.params.get('title')
+        r.author = self.params.get('author')
+        if r.name == 'native':
+            r.ext = self.params.get('chapter.ext') or r.ext
+        name = '%s.%s' % (os.path.splitext(name)[0], r.ext)
+        path = self.cache_path(name)
+        if os.path.exists(path):
+            return path
+        
+        r.outpath = Manifest.tmp_path(self.novel, name)
+        r.open()
+        try:
+            render(self.novel, [r], workers, self.iter_nodes())
+        finally:
+            r.close()
+        os.rename(r.outpath, path)
+        return path
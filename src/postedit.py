@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import csv
+import time
+import subprocess
+import logging
+
+from models import Novel, NovelEnvironment, load_csv
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+QUEUE = 'postedit'
+QUEUE_LOCK = 'postedit.queue-lock'
+WORKER_LOCK = 'postedit.lock'
+LOG = 'postedit.log'
+
+class QueueLock(object):
+    """
+    @brief Lock on the queue file alone, so queueing and taking jobs never
+        wait for the project lock -- which the caller may hold already.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        self.fd = None
+
+class PostEditQueue(object):
+    """
+    @brief Work left to do after a chapter was edited -- staging, commit and
+        index refresh -- run by a detached worker process.
+
+    `edit` only appends a job to `.novel/postedit` and starts the worker if
+    none is running, so the prompt comes back as soon as the editor exits.
+    The worker holds `.novel/postedit.lock` while it drains the queue and
+    logs to `.novel/postedit.log`. Commands that need the commits call
+    `wait` first.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.path = env.local_path(QUEUE)
+        self.queue_lock_path = env.local_path(QUEUE_LOCK)
+        self.worker_lock_path = env.local_path(WORKER_LOCK)
+        self.log_path = env.local_path(LOG)
+
+    def add(self, chapter_path, message):
+        with QueueLock(self.queue_lock_path):
+            with open(self.path, 'a') as queue_file:
+                csv.writer(queue_file).writerow([time.time(), chapter_path,
+                                                 message])
+
+    def take(self):
+        """
+        @brief Remove and return every queued job.
+
+        :returns: list of (timestamp, chapter path, message)
+        """
+        with QueueLock(self.queue_lock_path):
+            if not os.path.exists(self.path):
+                return []
+            jobs = [(float(r[0]), r[1], r[2]) for r in load_csv(self.path) if r]
+            os.remove(self.path)
+        return jobs
+
+    def pending(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def worker_running(self):
+        if fcntl is None:
+            return False
+        fd = os.open(self.worker_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def start_worker(self):
+        """
+        @brief Start a detached worker unless one is running already.
+        """
+        if self.worker_running():
+            return None
+        log = open(self.log_path, 'a')
+        CMD = [sys.executable, os.path.abspath(__file__), self.env.proj_path]
+        logger.info("[shell] %s &" % ' '.join(CMD))
+        proc = subprocess.Popen(CMD, stdin=subprocess.DEVNULL, stdout=log,
+                                stderr=log, start_new_session=True,
+                                close_fds=True)
+        log.close()
+        return proc
+
+    def wait(self, timeout=None, interval=0.1):
+        """
+        @brief Block until the queue is empty and the worker has finished.
+
+        If jobs are queued but no worker is running (it was killed, say),
+        they are processed here instead.
+
+        :returns: True unless `timeout` seconds passed first
+        """
+        start = time.time()
+        while self.worker_running() or self.pending():
+            if not self.worker_running():
+                run_worker(self.env.proj_path)
+                continue
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(interval)
+        return True
+
+def process(novel, jobs):
+    """
+    @brief Commit the edited chapters and refresh what depends on them.
+    """
+    from search import SearchIndex
+
+    paths = []
+    for (timestamp, path, message) in jobs:
+        if os.path.exists(path) and path not in paths:
+            paths.append(path)
+    if not paths:
+        return 0
+    messages = []
+    for (timestamp, path, message) in jobs:
+        if message not in messages:
+            messages.append(message)
+    message = messages[0]
+    if len(messages) > 1:
+        message = "%d edits\n\n%s" % (len(messages), '\n'.join(
+            "- %s" % m for m in messages))
+
+    with novel.project_lock():
+        novel.git_add_files(paths)
+        novel.git_commit_files(paths, message)
+    logger.info("committed %d chapters" % len(paths))
+
+    index = SearchIndex(novel)
+    try:
+        index.update()
+    finally:
+        index.close()
+    return len(paths)
+
+def run_worker(proj_path):
+    """
+    @brief Drain the queue, unless another worker is doing so already.
+
+    :returns: number of jobs processed
+    """
+    env = NovelEnvironment.load(proj_path)
+    queue = PostEditQueue(env)
+    fd = os.open(queue.worker_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+        done = 0
+        while True:
+            jobs = queue.take()
+            if not jobs:
+                break
+            logger.info("processing %d post-edit jobs" % len(jobs))
+            try:
+                process(Novel.load(proj_path), jobs)
+            except Exception:
+                logger.exception("post-edit jobs failed; queueing them again")
+                for (timestamp, path, message) in jobs:
+                    queue.add(path, message)
+                raise
+            done += len(jobs)
+        return done
+    finally:
+        os.close(fd)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(process)d] %(name)s: %(message)s')
+    os.chdir(sys.argv[1])
+    run_worker(sys.argv[1])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import os
+import csv
+import json
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('text', 'json', 'ndjson', 'csv')
+
+# The fields of each kind of record, in output order. `show` adds the
+# DETAIL_FIELDS, which need the chapter files to be read.
+FIELDS = {
+    'novel': ('title', 'author', 'parts', 'plotlines', 'chapters',
+              'versions', 'drafts'),
+    'plotline': ('tag', 'comment', 'chapters'),
+    'part': ('tag', 'number', 'title', 'parent', 'depth', 'parts', 'chapters'),
+    'chapter': ('tag', 'number', 'title', 'part', 'plotline', 'path'),
+    'version': ('number', 'path', 'git_hash', 'comment', 'timestamp',
+                'outputs', 'manifest'),
+    'draft': ('number', 'stage', 'path', 'git_hash', 'comment', 'timestamp',
+              'outputs', 'manifest'),
+    'status': ('status', 'tag', 'title', 'path'),
+}
+DETAIL_FIELDS = {
+    'novel': ('words', 'characters'),
+    'plotline': ('words', 'characters'),
+    'part': ('words', 'characters'),
+    'chapter': ('words', 'characters'),
+    'version': (),
+    'draft': (),
+    'status': (),
+}
+
+def _timestamp(version):
+    return datetime.datetime.fromtimestamp(version.bound_at(),
+                                           datetime.timezone.utc).isoformat()
+
+def novel_record(novel):
+    return {
+        'title': novel.title,
+        'author': str(novel.author),
+        'parts': len(novel.parts),
+        'plotlines': len(novel.plotlines),
+        'chapters': len(novel.chapters),
+        'versions': len(novel.versions),
+        'drafts': len(novel.drafts),
+        }
+
+def plotline_records(novel, plotlines=None):
+    counts = {}
+    for chapter in novel.chapters:
+        counts[chapter.plotline] = counts.get(chapter.plotline, 0) + 1
+    for plotline in (novel.plotlines if plotlines is None else plotlines):
+        yield {
+            'tag': plotline.tag,
+            'comment': plotline.comment,
+            'chapters': counts.get(plotline, 0),
+            }
+
+def part_records(novel, parts=None):
+    """
+    @brief Part records in tree order, using the numbers and adjacency of
+        `Novel.part_tree`.
+    """
+    tree = novel.part_tree()
+    for (part, depth) in tree.walk():
+        if parts is not None and part not in parts:
+            continue
+        yield {
+            'tag': tree.tag(part),
+            'number': tree.numbers[part],
+            'title': part.title,
+            'parent': tree.tag(part.parent) if part.parent else None,
+            'depth': depth,
+            'parts': len(tree.children[part]),
+            'chapters': len(tree.chapters[part]),
+            }
+
+def chapter_records(novel, chapters=None):
+    tree = novel.part_tree()
+    proj_path = novel.env.proj_path
+    for chapter in (novel.chapters if chapters is None else chapters):
+        part = None
+        if chapter.part is not None and chapter.part in tree.numbers:
+            part = tree.tag(chapter.part)
+        yield {
+            'tag': chapter.tag,
+            'number': chapter.number,
+            'title': chapter.title,
+            'part': part,
+            'plotline': chapter.plotline.tag if chapter.plotline else None,
+            'path': os.path.relpath(chapter.path, proj_path),
+            }
+
+def version_records(novel, versions=None):
+    numbers = dict((v, i) for (i, v) in enumerate(novel.versions, 1))
+    for version in (novel.versions if versions is None else versions):
+        yield {
+            'number': numbers[version],
+            'path': version.path,
+            'git_hash': version.git_hash,
+            'comment': version.comment,
+            'timestamp': _timestamp(version),
+            'outputs': list(version.outputs),
+            'manifest': version.manifest,
+            }
+
+def draft_records(novel, drafts=None):
+    numbers = dict((d, i) for (i, d) in enumerate(novel.drafts, 1))
+    for draft in (novel.drafts if drafts is None else drafts):
+        yield {
+            'number': numbers[draft],
+            'stage': draft.stage,
+            'path': draft.path,
+            'git_hash': draft.git_hash,
+            'comment': draft.comment,
+            'timestamp': _timestamp(draft),
+            'outputs': list(draft.outputs),
+            'manifest': draft.manifest,
+            }
+
+def status_records(novel, changes):
+    proj_path = novel.env.proj_path
+    for (status, chapter) in changes:
+        yield {
+            'status': status,
+            'tag': chapter.tag,
+            'title': chapter.title,
+            'path': os.path.relpath(chapter.path, proj_path),
+            }
+
+RECORDS = {
+    'plotline': plotline_records,
+    'part': part_records,
+    'chapter': chapter_records,
+    'version': version_records,
+    'draft': draft_records,
+}
+
+def write_records(kind, records, fmt, out, detail=False, single=False):
+    """
+    @brief Write records as they are produced.
+
+    :param kind: Key of FIELDS.
+    :type kind: str
+
+    :param fmt: 'json' (an array, or one object if `single`), 'ndjson' (one
+        object per line) or 'csv' (with a header row).
+    :type fmt: str
+
+    :param detail: Include the DETAIL_FIELDS.
+    :type detail: bool
+
+    :returns: The number of records written
+    """
+    fields = FIELDS[kind] + (DETAIL_FIELDS[kind] if detail else ())
+    n = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for r in records:
+            writer.writerow([';'.join(r[f]) if isinstance(r[f], list) else
+                             ('' if r[f] is None else r[f]) for f in fields])
+            n += 1
+    elif fmt == 'ndjson' or (fmt == 'json' and single):
+        for r in records:
+            out.write(json.dumps(dict((f, r[f]) for f in fields)))
+            out.write('\n')
+            n += 1
+    elif fmt == 'json':
+        out.write('[')
+        for r in records:
+            out.write(',\n' if n else '\n')
+            out.write(json.dumps(dict((f, r[f]) for f in fields)))
+            n += 1
+        out.write('\n]\n' if n else ']\n')
+    else:
+        raise RuntimeError("%s: unknown format (choose from %s)" % (
+            fmt, ', '.join(FORMATS[1:])))
+    return n
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+import os
+import html
+import uuid
+import zipfile
+import datetime
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class Renderer(object):
+    """
+    @brief An output format for `Novel.bind`.
+
+    A renderer turns the title page, part headings and chapters of a novel
+    into text. `render_chapter` must be a pure function of its arguments so
+    that renderers flagged as `pooled` can run it in a worker process.
+    """
+    name = None
+    ext = None
+    pooled = False
+    # Whether the output is bytes rather than text.
+    binary = False
+
+    def __init__(self, novel, outpath=None):
+        self.novel = novel
+        self.outpath = outpath
+        self.outfile = None
+        self.title = novel.title
+        self.author = novel.author
+
+    def open(self):
+        if hasattr(self.outpath, 'write'):
+            # A stream of the caller's (see `iter_render`), left open.
+            self.outfile = self.outpath
+        else:
+            self.outfile = open(self.outpath, 'w')
+
+    def write(self, s):
+        self.outfile.write(s)
+
+    def close(self):
+        if self.outfile is not self.outpath:
+            self.outfile.close()
+
+    def render_header(self):
+        return ''
+
+    def render_footer(self):
+        return ''
+
+    def render_part(self, part, h):
+        raise NotImplementedError()
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        raise NotImplementedError()
+
+    def begin(self):
+        self.write(self.render_header())
+
+    def end(self):
+        self.write(self.render_footer())
+
+    def write_part(self, part, h, rendered):
+        self.write(rendered)
+
+    def write_chapter(self, chapter, h, rendered):
+        self.write(rendered)
+
+class NativeRenderer(Renderer):
+    """
+    @brief The original `bind` output: chapters are concatenated in the
+        markup given by `chapter.ext`.
+    """
+    name = 'native'
+
+    def __init__(self, novel, outpath=None):
+        super(NativeRenderer, self).__init__(novel, outpath)
+        self.ext = novel.get_config('chapter.ext')
+
+    def render_header(self):
+        return ''.join('%s\n' % t for t in (
+            '<h1 id="title">%s<h1>' % self.title,
+            '<h1 id="by">by</h1>',
+            '<h1 id="author">%s<h1>' % self.author))
+
+    def render_part(self, part, h):
+        return part.formatted_title()
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        return '<h%d class="chapter">%s</h%d>\n%s\n' % (h, title, h, text)
+
+class HtmlRenderer(Renderer):
+    name = 'html'
+    ext = 'html'
+    pooled = True
+
+    def render_header(self):
+        title = html.escape(self.title or '')
+        return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8"/>\n'
+                '<title>%s</title>\n</head>\n<body>\n'
+                '<h1 id="title">%s</h1>\n<h1 id="by">by</h1>\n'
+                '<h1 id="author">%s</h1>\n' % (
+                    title, title, html.escape(str(self.author))))
+
+    def render_footer(self):
+        return '</body>\n</html>\n'
+
+    def render_part(self, part, h):
+        return '<h%d class="part">%s</h%d>\n' % (
+            h, html.escape(part.formatted_title()), h)
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        out = ['<h%d class="chapter">%s</h%d>\n' % (h, html.escape(title), h)]
+        for para in paragraphs(text):
+            out.append('<p>%s</p>\n' % html.escape(para))
+        return ''.join(out)
+
+class MarkdownRenderer(Renderer):
+    name = 'md'
+    ext = 'md'
+
+    def render_header(self):
+        return '# %s\n\nby %s\n\n' % (self.title, self.author)
+
+    def render_part(self, part, h):
+        return '%s %s\n\n' % ('#' * min(h, 6), part.formatted_title())
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        return '%s %s\n\n%s\n\n' % ('#' * min(h, 6), title, text.strip('\n'))
+
+class TextRenderer(Renderer):
+    name = 'txt'
+    ext = 'txt'
+
+    def render_header(self):
+        by = 'by %s' % self.author
+        return '%s\n%s\n\n' % (self.title, by)
+
+    def render_part(self, part, h):
+        t = part.formatted_title()
+        return '%s\n%s\n\n' % (t, '=' * len(t))
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        return '%s\n%s\n\n%s\n\n' % (title, '-' * len(title), text.strip('\n'))
+
+class EpubRenderer(Renderer):
+    """
+    @brief EPUB 3 output, written straight into the zip container.
+
+    Every part and chapter is its own XHTML entry, written through
+    `ZipFile.open(name, 'w')` as soon as it is rendered, so only one chapter
+    is held in memory at a time. The navigation document, NCX and package
+    files only need titles and entry names, and are written last.
+    """
+    name = 'epub'
+    ext = 'epub'
+    pooled = True
+    binary = True
+
+    XHTML_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<!DOCTYPE html>\n'
+                  '<html xmlns="http://www.w3.org/1999/xhtml" '
+                  'xmlns:epub="http://www.idpf.org/2007/ops">\n'
+                  '<head><title>%s</title></head>\n<body>\n')
+    XHTML_FOOT = '</body>\n</html>\n'
+
+    def open(self):
+        # `outpath` may also be a stream; zipfile needs no seeking to write.
+        self.zip = zipfile.ZipFile(self.outpath, 'w', zipfile.ZIP_DEFLATED)
+        # The mimetype must come first and be stored uncompressed.
+        self.zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip',
+                          compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<container version="1.0" '
+            'xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" '
+            'media-type="application/oebps-package+xml"/></rootfiles>\n'
+            '</container>\n')
+        # (heading level, label, entry name) for the table of contents.
+        self.toc = []
+        self.base_h = None
+
+    def close(self):
+        self.zip.close()
+
+    def _write_entry(self, title, *chunks):
+        name = 'text/%04d.xhtml' % (len(self.toc) + 1)
+        with self.zip.open('OEBPS/%s' % name, 'w') as entry:
+            entry.write((self.XHTML_HEAD % html.escape(title)).encode('utf-8'))
+            for chunk in chunks:
+                entry.write(chunk.encode('utf-8'))
+            entry.write(self.XHTML_FOOT.encode('utf-8'))
+        return name
+
+    def begin(self):
+        name = self._write_entry(self.title or '',
+            '<h1 id="title">%s</h1>\n<h1 id="by">by</h1>\n'
+            '<h1 id="author">%s</h1>\n' % (
+                html.escape(self.title or ''),
+                html.escape(str(self.author))))
+        self.toc.append((1, self.title or '', name))
+
+    def render_part(self, part, h):
+        return '<h%d class="part">%s</h%d>\n' % (
+            min(h, 6), html.escape(part.formatted_title()), min(h, 6))
+
+    @staticmethod
+    def render_chapter(title, text, h):
+        return HtmlRenderer.render_chapter(title, text, min(h, 6))
+
+    def _level(self, h):
+        # The first heading seen is a top-level entry of the contents.
+        if self.base_h is None:
+            self.base_h = h
+        return max(h - self.base_h + 1, 1)
+
+    def write_part(self, part, h, rendered):
+        title = part.formatted_title()
+        self.toc.append((self._level(h), title,
+                         self._write_entry(title, rendered)))
+
+    def write_chapter(self, chapter, h, rendered):
+        title = chapter.formatted_title()
+        self.toc.append((self._level(h), title,
+                         self._write_entry(title, rendered)))
+
+    def _nav_list(self):
+        # Turn the flat (level, label, entry) list into nested <ol>s.
+        out = ['<ol>\n']
+        depth = 1
+        first = True
+        # Levels of the open entries. A skipped level (a chapter right under
+        # the book, next to parts) nests one deeper only, and never before
+        # the first entry: every <ol> needs an <li> to hold it.
+        opened = []
+        for (level, label, name) in self.toc:
+            while opened and opened[-1] >= level:
+                opened.pop()
+            opened.append(level)
+            level = len(opened)
+            if level > depth:
+                out.append('\n<ol>\n')
+                depth = level
+            else:
+                if not first:
+                    out.append('</li>\n')
+                while depth > level:
+                    out.append('</ol>\n</li>\n')
+                    depth -= 1
+            out.append('<li><a href="%s">%s</a>' % (name, html.escape(label)))
+            first = False
+        if not first:
+            out.append('</li>\n')
+        while depth > 1:
+            out.append('</ol>\n</li>\n')
+            depth -= 1
+        out.append('</ol>\n')
+        return ''.join(out)
+
+    def end(self):
+        title = html.escape(self.title or '')
+        uid = 'urn:uuid:%s' % uuid.uuid4()
+        modified = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        self.zip.writestr('OEBPS/nav.xhtml',
+            (self.XHTML_HEAD % title) +
+            '<nav epub:type="toc" id="toc">\n<h1>Contents</h1>\n' +
+            self._nav_list() + '</nav>\n' + self.XHTML_FOOT)
+
+        points = []
+        for (i, (level, label, name)) in enumerate(self.toc):
+            points.append('<navPoint id="np%d" playOrder="%d"><navLabel>'
+                          '<text>%s</text></navLabel><content src="%s"/>'
+                          '</navPoint>\n' % (i+1, i+1, html.escape(label), name))
+        self.zip.writestr('OEBPS/toc.ncx',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+            '<head><meta name="dtb:uid" content="%s"/></head>\n'
+            '<docTitle><text>%s</text></docTitle>\n<navMap>\n%s</navMap>\n'
+            '</ncx>\n' % (uid, title, ''.join(points)))
+
+        items = []
+        spine = []
+        for (i, (level, label, name)) in enumerate(self.toc):
+            items.append('<item id="e%d" href="%s" '
+                         'media-type="application/xhtml+xml"/>\n' % (i+1, name))
+            spine.append('<itemref idref="e%d"/>\n' % (i+1))
+        self.zip.writestr('OEBPS/content.opf',
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" '
+            'unique-identifier="uid">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            '<dc:identifier id="uid">%s</dc:identifier>\n'
+            '<dc:title>%s</dc:title>\n<dc:creator>%s</dc:creator>\n'
+            '<dc:language>en</dc:language>\n'
+            '<meta property="dcterms:modified">%s</meta>\n</metadata>\n'
+            '<manifest>\n'
+            '<item id="nav" href="nav.xhtml" '
+            'media-type="application/xhtml+xml" properties="nav"/>\n'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+            '%s</manifest>\n<spine toc="ncx">\n%s</spine>\n</package>\n' % (
+                uid, title, html.escape(str(self.author)), modified,
+                ''.join(items), ''.join(spine)))
+
+RENDERERS = dict((r.name, r) for r in (
+    NativeRenderer, HtmlRenderer, MarkdownRenderer, TextRenderer, EpubRenderer))
+
+def paragraphs(text):
+    """
+    @brief Split chapter text into paragraphs on blank lines.
+    """
+    para = []
+    for line in text.splitlines():
+        if line.strip():
+            para.append(line.strip())
+        elif para:
+            yield ' '.join(para)
+            para = []
+    if para:
+        yield ' '.join(para)
+
+def get_renderer(name):
+    if name not in RENDERERS:
+        raise RuntimeError("%s: unknown format (choose from %s)" % (
+            name, ', '.join(sorted(RENDERERS))))
+    return RENDERERS[name]
+
+def _flush(pending, limit):
+    while len(pending) > limit:
+        (write, obj, h, payload) = pending.popleft()
+        if hasattr(payload, 'result'):
+            payload = payload.result()
+        write(obj, h, payload)
+
+def render(novel, renderers, workers=0, nodes=None):
+    """
+    @brief Feed the novel to every renderer, reading each chapter once.
+
+    Chapters for `pooled` renderers are converted in a process pool. At most
+    a couple of chapters per worker are in flight for each renderer, so
+    memory stays bounded however long the book is.
+
+    :param novel: Novel to render.
+    :type novel: Novel
+
+    :param renderers: Opened renderers to write to.
+    :type renderers: list
+
+    :param workers: Size of the process pool. 0 uses every CPU, 1 renders
+        everything in this process.
+    :type workers: int
+
+    :param nodes: (part or chapter, heading level, text) triples to render,
+        where text is None for parts. Defaults to the novel's current parts
+        and chapters (`Novel.walk`).
+    :type nodes: iterable
+    """
+    if nodes is None:
+        nodes = novel.walk(read=True)
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1 and any(r.pooled for r in renderers):
+        pool = ProcessPoolExecutor(max_workers=workers)
+    limit = workers * 2
+    pending = dict((r, deque()) for r in renderers)
+
+    try:
+        for r in renderers:
+            r.begin()
+
+        for (obj, h, text) in nodes:
+            if text is None:
+                for r in renderers:
+                    pending[r].append((r.write_part, obj, h,
+                                       r.render_part(obj, h)))
+            else:
+                title = obj.formatted_title()
+                for r in renderers:
+                    if pool and r.pooled:
+                        rendered = pool.submit(r.render_chapter, title, text, h)
+                    else:
+                        rendered = r.render_chapter(title, text, h)
+                    pending[r].append((r.write_chapter, obj, h, rendered))
+            for r in renderers:
+                _flush(pending[r], limit if pool and r.pooled else 0)
+
+        for r in renderers:
+            _flush(pending[r], 0)
+            r.end()
+    finally:
+        if pool:
+            pool.shutdown()
+
+class ChunkStream(object):
+    """
+    @brief A write-only stream that keeps what is written until `drain`.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if data:
+            self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        (chunks, self.chunks) = (self.chunks, [])
+        return chunks
+
+def iter_render(renderer, nodes):
+    """
+    @brief Render with a single renderer, yielding the output as it is
+        produced instead of writing it to `outpath`.
+
+    Only the current part or chapter is held in memory; the output of each
+    is yielded before the next one is read.
+
+    :param renderer: An unopened renderer.
+    :type renderer: Renderer
+
+    :param nodes: (part or chapter, heading level, text) triples, as for
+        `render`.
+    :type nodes: iterable
+
+    :returns: generator of str, or bytes if `renderer.binary`
+    """
+    stream = ChunkStream()
+    renderer.outpath = stream
+    renderer.open()
+    try:
+        renderer.begin()
+        for chunk in stream.drain():
+            yield chunk
+        for (obj, h, text) in nodes:
+            if text is None:
+                renderer.write_part(obj, h, renderer.render_part(obj, h))
+            else:
+                renderer.write_chapter(obj, h, renderer.render_chapter(
+                    obj.formatted_title(), text, h))
+            for chunk in stream.drain():
+                yield chunk
+        renderer.end()
+    finally:
+        renderer.close()
+    for chunk in stream.drain():
+        yield chunk
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sqlite3
+import logging
+from array import array
+
+from models import blob_hash
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+(?:'\w+)*")
+QUERY_RE = re.compile(r'"([^"]*)"?|(\S+)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    doc INTEGER,
+    positions BLOB,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+"""
+
+def tokenize(text):
+    return [t.lower() for t in TOKEN_RE.findall(text)]
+
+def parse_query(query):
+    """
+    @brief Split a query into phrases. Quoted text is one phrase; every
+        other word is a phrase of its own.
+
+    :returns: list of token lists
+    """
+    phrases = []
+    for (quoted, word) in QUERY_RE.findall(query):
+        if quoted:
+            phrases.append(tokenize(quoted))
+        else:
+            phrases.extend([t] for t in tokenize(word))
+    return [p for p in phrases if p]
+
+class SearchIndex(object):
+    """
+    @brief Inverted index of the chapter files, kept in `.novel/search`.
+
+    Each posting holds the token positions of a term in one chapter, so
+    phrase queries can be answered from the index alone. `update` only
+    re-tokenizes chapters whose size or mtime changed and whose content
+    hash no longer matches.
+    """
+
+    def __init__(self, novel):
+        self.novel = novel
+        self.db = sqlite3.connect(novel.env.local_path('search'))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self):
+        """
+        :returns: number of chapters (re)indexed
+        """
+        docs = dict((row[1], row) for row in
+                    self.db.execute("SELECT id, path, size, mtime, hash FROM docs"))
+        paths = set()
+        indexed = 0
+        with self.db:
+            for chapter in self.novel.chapters:
+                path = os.path.abspath(chapter.path)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # A missing file is dropped from the index below.
+                    continue
+                paths.add(path)
+                doc = docs.get(path)
+                if doc and (doc[2], doc[3]) == (st.st_size, st.st_mtime_ns):
+                    continue
+                h = blob_hash(path)
+                if doc and doc[4] == h:
+                    self.db.execute("UPDATE docs SET size=?, mtime=? WHERE id=?",
+                                    (st.st_size, st.st_mtime_ns, doc[0]))
+                    continue
+                if doc:
+                    doc_id = doc[0]
+                    self.db.execute("DELETE FROM postings WHERE doc=?", (doc_id,))
+                    self.db.execute(
+                        "UPDATE docs SET size=?, mtime=?, hash=? WHERE id=?",
+                        (st.st_size, st.st_mtime_ns, h, doc_id))
+                else:
+                    doc_id = self.db.execute(
+                        "INSERT INTO docs (path, size, mtime, hash) "
+                        "VALUES (?, ?, ?, ?)",
+                        (path, st.st_size, st.st_mtime_ns, h)).lastrowid
+                self._index(doc_id, chapter.read())
+                indexed += 1
+            for (path, doc) in docs.items():
+                if path not in paths:
+                    self.db.execute("DELETE FROM postings WHERE doc=?", (doc[0],))
+                    self.db.execute("DELETE FROM docs WHERE id=?", (doc[0],))
+        logger.info("search index: %d chapters reindexed" % indexed)
+        return indexed
+
+    def _index(self, doc_id, text):
+        terms = {}
+        for (i, term) in enumerate(tokenize(text)):
+            terms.setdefault(term, array('I')).append(i)
+        self.db.executemany(
+            "INSERT INTO postings (term, doc, positions) VALUES (?, ?, ?)",
+            ((term, doc_id, positions.tobytes())
+             for (term, positions) in terms.items()))
+
+    def _postings(self, term):
+        postings = {}
+        for (doc, blob) in self.db.execute(
+                "SELECT doc, positions FROM postings WHERE term=?", (term,)):
+            positions = array('I')
+            positions.frombytes(blob)
+            postings[doc] = positions
+        return postings
+
+    def _phrase(self, terms):
+        """
+        :returns: dict of doc id => start positions of the phrase
+        """
+        matches = None
+        for (offset, term) in enumerate(terms):
+            postings = self._postings(term)
+            if matches is None:
+                matches = dict((d, set(p)) for (d, p) in postings.items())
+            else:
+                for doc in list(matches.keys()):
+                    if doc not in postings:
+                        del matches[doc]
+                        continue
+                    later = set(p - offset for p in postings[doc])
+                    matches[doc] &= later
+                    if not matches[doc]:
+                        del matches[doc]
+            if not matches:
+                return {}
+        return matches
+
+    def search(self, query):
+        """
+        @brief Find the chapters containing every word and phrase in `query`.
+
+        :returns: list of (chapter, hits), most hits first
+        """
+        phrases = parse_query(query)
+        if not phrases:
+            return []
+        hits = None
+        for terms in phrases:
+            found = self._phrase(terms)
+            if hits is None:
+                hits = dict((d, len(p)) for (d, p) in found.items())
+            else:
+                hits = dict((d, n + len(found[d])) for (d, n) in hits.items()
+                            if d in found)
+            if not hits:
+                return []
+        chapters = dict((os.path.abspath(c.path), c) for c in self.novel.chapters)
+        results = []
+        for (doc, path) in self.db.execute("SELECT id, path FROM docs"):
+            if doc in hits and path in chapters:
+                results.append((chapters[path], hits[doc]))
+        results.sort(key=lambda r: (-r[1], r[0].number))
+        return results
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import os
+import csv
+import time
+import logging
+import subprocess
+
+from models import blob_hash, load_csv
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'status'
+
+class StatusManifest(object):
+    """
+    @brief What `status` knew last time: the HEAD commit with the blob id of
+        every chapter in it, and the (size, mtime, blob id) of every chapter
+        file, in `.novel/status`.
+
+    A file whose size and mtime are unchanged is not read again. As in git,
+    an entry whose mtime is not older than the manifest itself is "racy" --
+    the file could have changed again in the same tick -- and is hashed
+    every time until the manifest is newer.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.path = env.local_path(MANIFEST)
+        self.head = None
+        self.written = 0
+        self.committed = {}
+        self.files = {}
+        self.changed = True
+        if not os.path.exists(self.path):
+            return
+        rows = load_csv(self.path)
+        if not rows or rows[0][0] != 'head':
+            return
+        (self.head, self.written) = (rows[0][1] or None, int(rows[0][2]))
+        for row in rows[1:]:
+            (path, size, mtime, blob, committed) = row
+            if size:
+                self.files[path] = (int(size), int(mtime), blob)
+            if committed:
+                self.committed[path] = committed
+        self.changed = False
+
+    def blob(self, path, abspath):
+        """
+        @brief The blob id of a chapter file, or None if it is missing.
+        """
+        try:
+            st = os.stat(abspath)
+        except OSError:
+            if self.files.pop(path, None) is not None:
+                self.changed = True
+            return None
+        entry = self.files.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns) \
+                and st.st_mtime_ns < self.written:
+            return entry[2]
+        blob = blob_hash(abspath)
+        self.files[path] = (st.st_size, st.st_mtime_ns, blob)
+        self.changed = True
+        return blob
+
+    def write(self):
+        if not self.changed:
+            return
+        # Anything modified from now on is newer than the manifest.
+        self.written = time.time_ns()
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as manifest_file:
+            writer = csv.writer(manifest_file)
+            writer.writerow(['head', self.head or '', self.written])
+            for path in sorted(set(self.files) | set(self.committed)):
+                (size, mtime, blob) = self.files.get(path, ('', '', ''))
+                writer.writerow([path, size, mtime, blob,
+                                 self.committed.get(path, '')])
+        os.replace(tmp, self.path)
+
+def _head(novel):
+    # Read a plain `.git/HEAD` and loose ref directly, which is what
+    # `git rev-parse HEAD` does, without starting git.
+    git_dir = os.path.join(novel.env.proj_path, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+        if head.startswith('ref: '):
+            with open(os.path.join(git_dir, head[5:])) as ref_file:
+                head = ref_file.read().strip()
+        if len(head) == 40:
+            return head
+    except OSError:
+        pass
+    # Packed refs, worktrees, no commits yet...
+    try:
+        return novel.git_output('rev-parse', '-q', '--verify',
+                                'HEAD').strip() or None
+    except subprocess.CalledProcessError:
+        return None
+
+def chapter_status(novel):
+    """
+    @brief Which chapters differ from the last commit.
+
+    Git is only run when HEAD moved, for one `git ls-tree`; the working tree
+    is only `stat`ed, and files are read only when their size or mtime
+    changed.
+
+    :returns: list of (status, chapter), where status is 'modified',
+        'missing' or 'untracked', in chapter order
+    """
+    proj_path = novel.env.proj_path
+    manifest = StatusManifest(novel.env)
+    head = _head(novel)
+    if head != manifest.head:
+        manifest.head = head
+        manifest.committed = {}
+        manifest.changed = True
+        if head is not None:
+            out = novel.git_output('-c', 'core.quotepath=off', 'ls-tree',
+                                   '-r', head)
+            ext = '.%s' % novel.get_config('chapter.ext')
+            for line in out.splitlines():
+                (meta, path) = line.split('\t', 1)
+                if path.endswith(ext):
+                    manifest.committed[path] = meta.split()[2]
+    changes = []
+    seen = []
+    prefix = os.path.join(proj_path, '')
+    for chapter in novel.chapters:
+        # Chapter paths are absolute, so this is a cheap `relpath`.
+        path = chapter.path
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        else:
+            path = os.path.relpath(path, proj_path)
+        seen.append(path)
+        blob = manifest.blob(path, chapter.path)
+        committed = manifest.committed.get(path)
+        if blob is None:
+            changes.append(('missing', chapter))
+        elif committed is None:
+            changes.append(('untracked', chapter))
+        elif blob != committed:
+            changes.append(('modified', chapter))
+    if len(manifest.files) > len(seen):
+        manifest.files = dict((p, manifest.files[p]) for p in seen
+                              if p in manifest.files)
+        manifest.changed = True
+    manifest.write()
+    return changes
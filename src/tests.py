@@ -25,6 +25,9 @@ from models import (
 from mnadmin import create_project
 
 from makenovel import *
+from watch import StatWatcher, recount
+from history import WordHistory
+from search import SearchIndex
 
 class TestNovel(unittest.TestCase):
     
@@ -110,6 +113,612 @@ class TestNovel(unittest.TestCase):
         self.assertIn(chapter, self.novel.parts[0].chapters)
         self.assertNotIn(chapter, self.novel.parts[1].chapters)
     
+    def testBindFormats(self):
+        add_chapter(self.novel, "main", "Bound Chapter", "1")
+        before = len(self.novel.versions)
+        version = self.novel.bind("multi", formats=['html', 'txt'], workers=1)
+        self.assertEqual(len(self.novel.versions), before+1)
+        self.assertEqual(len(version.outputs), 2)
+        for fmt in ('html', 'txt'):
+            self.assertTrue(os.path.exists(version.materialize(fmt)))
+    
+    def testBindEpub(self):
+        import zipfile
+        add_chapter(self.novel, "main", "Zipped Chapter", "1")
+        version = self.novel.bind("epub", formats=['epub'], workers=1)
+        with zipfile.ZipFile(version.materialize()) as epub:
+            names = epub.namelist()
+            self.assertEqual(names[0], 'mimetype')
+            self.assertIn('OEBPS/nav.xhtml', names)
+            nav = epub.read('OEBPS/nav.xhtml').decode('utf-8')
+            self.assertIn('Zipped Chapter', nav)
+    
+    def testEpubNavLevels(self):
+        import xml.etree.ElementTree as ET
+        from renderers import EpubRenderer
+        renderer = EpubRenderer.__new__(EpubRenderer)
+        # A chapter before the first part, and one that skips a level.
+        renderer.toc = [(2, "Prologue", "a"), (1, "Part", "b"),
+                        (3, "Deep", "c"), (2, "Chapter", "d")]
+        nav = ET.fromstring(renderer._nav_list())
+        for ol in nav.iter('ol'):
+            for child in ol:
+                self.assertEqual(child.tag, 'li')
+        self.assertEqual([li.find('a').text for li in nav.findall('li')],
+                         ["Prologue", "Part"])
+        self.assertEqual([a.text for a in nav.findall('li/ol/li/a')],
+                         ["Deep", "Chapter"])
+    
+    def testImportManuscript(self):
+        manuscript = os.path.join(self.proj_path, "manuscript.txt")
+        with open(manuscript, 'w') as f:
+            f.write("# Opening\nFirst words.\n# Closing\nLast words.\n")
+        before = len(self.novel.chapters)
+        chapters = import_manuscript(self.novel, manuscript, "main",
+                                     r"^# (?P<title>.+)$")
+        self.assertEqual(len(chapters), 2)
+        self.assertEqual(len(self.novel.chapters), before+2)
+        self.assertEqual(chapters[0].title, "Opening")
+        self.assertEqual(chapters[1].read(), "Last words.\n")
+    
+    def testImportManuscriptRollback(self):
+        manuscript = os.path.join(self.proj_path, "manuscript.txt")
+        with open(manuscript, 'wb') as f:
+            f.write(b"# Opening\n" + b"Many words.\n" * 2000)
+            f.write(b"# Closing\n\xff\xfe not text\n")
+        before = list(self.novel.chapters)
+        plotline = self.novel.find_plotline("main")
+        with self.assertRaises(UnicodeDecodeError):
+            import_manuscript(self.novel, manuscript, "main",
+                              r"^# (?P<title>.+)$")
+        self.assertEqual(self.novel.chapters, before)
+        self.assertEqual(plotline.chapters, [])
+        self.assertEqual(os.listdir(self.proj_path).count("main"), 0)
+    
+    def testImportDirectory(self):
+        origin = os.path.join(self.proj_path, "drafts")
+        os.makedirs(origin)
+        for name in ("10_last.txt", "2_middle.txt", "1_first.txt"):
+            with open(os.path.join(origin, name), 'w') as f:
+                f.write("%s\n" % name)
+        chapters = import_directory(self.novel, origin, "main", jobs=2)
+        self.assertEqual([c.title for c in chapters],
+                         ["first", "middle", "last"])
+        self.assertEqual(chapters[2].read(), "10_last.txt\n")
+    
+    def testWatchTally(self):
+        add_chapter(self.novel, "main", "Watched Chapter", "1")
+        chapter = self.novel.find_chapter("%d__watched_chapter" %
+                                          len(self.novel.chapters))
+        tree = self.novel.index_parts()
+        tree.rollup()
+        total = tree.total(chapter.plotline)[0]
+        watcher = StatWatcher([chapter.path], interval=0.01)
+        with open(chapter.path, 'w') as f:
+            f.write("three more words")
+        changed = watcher.wait()
+        self.assertEqual(changed, set([chapter.path]))
+        changes = recount(tree, {chapter.path: chapter}, changed)
+        self.assertEqual(changes[0][0], chapter)
+        self.assertEqual(tree.total(chapter.plotline)[0],
+                         total + changes[0][1])
+        self.assertEqual(tree.count(chapter)[0], 3)
+    
+    def testCoalescedCommits(self):
+        self.novel.config['git.commit_changes'].value = '2'
+        add_chapter(self.novel, "main", "Queued One", "1")
+        self.assertEqual(len(self.novel.pending_commits()), 1)
+        add_chapter(self.novel, "main", "Queued Two", "1")
+        self.assertEqual(len(self.novel.pending_commits()), 0)
+        add_chapter(self.novel, "main", "Queued Three", "1")
+        self.assertEqual(self.novel.git_flush(), 1)
+        # A due queue waits for another writer rather than being left.
+        import threading
+        from models import ProjectLock
+        add_chapter(self.novel, "main", "Queued Four", "1")
+        with open(self.novel.env.local_path('pending'), 'a') as f:
+            f.write("0,padding,\n")
+        other = ProjectLock(self.novel.env)
+        other.acquire()
+        threading.Timer(0.2, other.release).start()
+        self.assertEqual(self.novel.git_flush(force=False), 2)
+    
+    def testHistory(self):
+        add_chapter(self.novel, "main", "Dated Chapter", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("four words right here\n")
+        self.novel.git_commit_files([chapter.path], "Write words")
+        history = WordHistory(self.novel)
+        self.assertEqual(history.update(), 1)
+        path = os.path.relpath(chapter.path, self.proj_path)
+        self.assertEqual(history.by_path()[path], [4, 0])
+        # The second run is served from the cache.
+        history = WordHistory(self.novel)
+        self.assertEqual(history.update(), 0)
+        self.assertEqual(history.by_path()[path], [4, 0])
+    
+    def testHistoryRenames(self):
+        for title in ("Alpha", "Beta", "Gamma"):
+            add_chapter(self.novel, "side", title, "1")
+        chapters = self.novel.chapters[-3:]
+        for (n, c) in enumerate(chapters, 1):
+            with open(c.path, 'w') as f:
+                f.write(("%s has words\n" % c.title) * n)
+        self.novel.git_commit_files([c.path for c in chapters], "Write")
+        written = self.novel.git_output('rev-parse', 'HEAD').strip()
+        WordHistory(self.novel).update()
+        update_chapter(self.novel, chapters[2].tag, plotline_tag=None,
+                       title=None, part_tag=None, before_tag=chapters[0].tag,
+                       after_tag=None)
+        # Renumbering moves words, it does not write them.
+        history = WordHistory(self.novel)
+        self.assertEqual(history.update(), 0)
+        for cached in (True, False):
+            if not cached:
+                os.remove(history.cache_path)
+                history = WordHistory(self.novel)
+                self.assertEqual(history.update(), 1)
+            self.assertEqual(set(d[0] for d in history.deltas), set([written]))
+            words = history.by_path()
+            for (n, c) in enumerate(chapters, 1):
+                path = os.path.relpath(c.path, self.proj_path)
+                self.assertEqual(words[path], [3 * n, 0])
+    
+    def testSearch(self):
+        add_chapter(self.novel, "main", "Searched Chapter", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("The lighthouse keeper kept the light on.\n")
+        index = SearchIndex(self.novel)
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.update(), 0)
+        self.assertEqual(index.search('"lighthouse keeper"'), [(chapter, 1)])
+        self.assertEqual(index.search('"keeper lighthouse"'), [])
+        self.assertEqual(index.search('the light'), [(chapter, 3)])
+        os.remove(chapter.path)
+        index.update()
+        self.assertEqual(index.search('lighthouse'), [])
+        index.close()
+    
+    def testDiffVersions(self):
+        add_chapter(self.novel, "main", "Kept Chapter", "1")
+        add_chapter(self.novel, "main", "Edited Chapter", "1")
+        (kept, edited) = self.novel.chapters[-2:]
+        with open(edited.path, 'w') as f:
+            f.write("the old ending\n")
+        self.novel.git_commit_files([edited.path], "Draft ending")
+        old = self.novel.bind("before")
+        with open(edited.path, 'w') as f:
+            f.write("the new ending\n")
+        self.novel.git_commit_files([edited.path], "Rewrite ending")
+        new = self.novel.bind("after")
+        changes = diff_versions(self.novel, str(old.number), str(new.number))
+        self.assertEqual(len(changes), 1)
+        (status, old_path, new_path, title, codes, a, b) = changes[0]
+        self.assertEqual((status, title), ('modified', "Edited Chapter"))
+        self.assertIn(('replace', 1, 2, 1, 2), codes)
+    
+    def testVersionManifest(self):
+        add_chapter(self.novel, "main", "Stored Chapter", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("first words\n")
+        version = self.novel.bind("manifest", formats=['txt'])
+        self.assertIsNotNone(version.manifest)
+        self.assertFalse(os.path.exists(os.path.join(self.proj_path,
+                                                     version.path)))
+        path = version.materialize()
+        with open(path) as f:
+            bound = f.read()
+        with open(chapter.path, 'w') as f:
+            f.write("later words\n")
+        os.remove(path)
+        with open(version.materialize()) as f:
+            self.assertEqual(f.read(), bound)
+        self.assertIn("first words", bound)
+        self.assertTrue(version.materialize('md').endswith('.md'))
+    
+    def testArchiveVersions(self):
+        from models import Version
+        path = os.path.join(self.proj_path, "old_1.rst")
+        with open(path, 'w') as f:
+            f.write("an old bound copy\n" * 100)
+        self.novel.git_add_files([path])
+        self.novel.git_commit_files([path], "Old version")
+        old = Version(self.novel, "old_1.rst", "0" * 40, "old",
+                      "2001-01-01 00:00:00+00:00")
+        new = self.novel.bind("new", formats=['txt'])
+        self.novel.versions.insert(0, old)
+        archived = self.novel.archive_versions(age=30)
+        self.assertEqual(archived, [old])
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(old.archive_path("old_1.rst")))
+        self.assertEqual(old.location(),
+                         (old.archive_path("old_1.rst"), 'archived'))
+        with open(old.materialize()) as f:
+            self.assertEqual(f.read(), "an old bound copy\n" * 100)
+        self.assertTrue(os.path.exists(new.materialize()))
+        self.assertEqual(new.location(), (new.materialize(), None))
+    
+    def testChangesSince(self):
+        from makenovel import show_changes
+        add_chapter(self.novel, "main", "Same Chapter", "1")
+        add_chapter(self.novel, "main", "Grown Chapter", "1")
+        (same, grown) = self.novel.chapters[-2:]
+        for (chapter, text) in ((same, "left alone\n"), (grown, "one two\n")):
+            with open(chapter.path, 'w') as f:
+                f.write(text)
+        version = self.novel.bind("since")
+        with open(grown.path, 'w') as f:
+            f.write("one two three four\n")
+        changes = show_changes(self.novel, str(version.number))
+        changes = [(c[0], c[3], c[4]) for c in changes
+                   if c[3] in ("Same Chapter", "Grown Chapter")]
+        self.assertEqual(changes, [('modified', "Grown Chapter", 2)])
+    
+    def testListChapters(self):
+        import io
+        from contextlib import redirect_stdout
+        from makenovel import list_chapters
+        (first, second) = self.novel.parts
+        child = Part(self.novel, "Inner", parent=first)
+        self.novel.parts.append(child)
+        self.assertEqual(second.children, [])
+        add_chapter(self.novel, "main", "Nested Chapter", "1__inner")
+        self.novel.write_chapters()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            list_chapters(self.novel)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[:3], ["+- [1] ", "  +- [1__inner] Inner",
+                                     "    +- %s" % self.novel.chapters[-1]])
+        self.assertEqual(lines.count("  +- [1__inner] Inner"), 1)
+    
+    def testListRecords(self):
+        import io
+        import json
+        from makenovel import list_records, show_record
+        add_chapter(self.novel, "main", "Listed Chapter", "1")
+        out = io.StringIO()
+        list_records(self.novel, 'chapters', 'json', out)
+        records = json.loads(out.getvalue())
+        self.assertEqual(records[-1]['title'], "Listed Chapter")
+        self.assertEqual(records[-1]['plotline'], "main")
+        out = io.StringIO()
+        self.assertEqual(list_records(self.novel, 'parts', 'ndjson', out), 2)
+        self.assertEqual(json.loads(out.getvalue().splitlines()[1])['tag'], "2")
+        out = io.StringIO()
+        show_record(self.novel, 'part', "1", 'csv', out)
+        self.assertEqual(out.getvalue().splitlines()[0],
+                         "tag,number,title,parent,depth,parts,chapters,words,"
+                         "characters")
+    
+    def testRenumberChapters(self):
+        from models import rename_files
+        for title in ("Alpha", "Beta", "Gamma"):
+            add_chapter(self.novel, "side", title, "1")
+        chapters = self.novel.chapters[-3:]
+        for c in chapters:
+            with open(c.path, 'w') as f:
+                f.write(c.title)
+        self.novel.git_commit_files([c.path for c in chapters], "Write")
+        update_chapter(self.novel, chapters[2].tag, plotline_tag=None,
+                       title=None, part_tag=None, before_tag=chapters[0].tag,
+                       after_tag=None)
+        self.assertEqual(self.novel.chapters[-3:],
+                         [chapters[2], chapters[0], chapters[1]])
+        for c in chapters:
+            self.assertTrue(c.tag.startswith("%d__" % c.number))
+            with open(c.path) as f:
+                self.assertEqual(f.read(), c.title)
+        side = os.path.join(self.proj_path, "side")
+        self.assertEqual(len(os.listdir(side)), 3)
+        # A swap is a cycle; it needs a temporary name.
+        (a, b) = (chapters[0].path, chapters[1].path)
+        rename_files([(a, b), (b, a)])
+        with open(a) as f:
+            self.assertEqual(f.read(), "Beta")
+    
+    def testUpdatePlotline(self):
+        add_chapter(self.novel, "main", "Wanderer", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("moved across")
+        self.novel.git_commit_files([chapter.path], "Write")
+        tag = chapter.tag
+        update_chapter(self.novel, tag, plotline_tag="side", title=None,
+                       part_tag=None, before_tag=None, after_tag=None)
+        self.assertEqual(chapter.tag, tag)
+        path = os.path.join(self.proj_path, "side", "%s.%s" % (
+            tag, self.novel.get_config('chapter.ext')))
+        self.assertEqual(chapter.path, path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "moved across")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.proj_path, "main", os.path.basename(path))))
+        novel = Novel.load(self.proj_path)
+        self.assertEqual(novel.find_chapter(tag).path, path)
+    
+    def testMoveRange(self):
+        for title in ("One", "Two", "Three", "Four"):
+            add_chapter(self.novel, "main", title, "1")
+        chapters = self.novel.chapters[-4:]
+        (first, second) = self.novel.parts
+        move(self.novel, 'chapters', first_last=(chapters[2].tag,
+                                                 chapters[3].tag),
+             before_tag=chapters[0].tag, into_tag="2")
+        self.assertEqual(self.novel.chapters[-4:], [chapters[2], chapters[3],
+                                                    chapters[0], chapters[1]])
+        self.assertEqual(second.chapters, [chapters[2], chapters[3]])
+        self.assertNotIn(chapters[2], first.chapters)
+        move(self.novel, 'parts', ["2"], before_tag="1")
+        self.assertEqual(self.novel.parts, [second, first])
+        self.assertEqual(chapters[2].part.tag, "1")
+        # "2" is a top-level part, not a child of itself.
+        with self.assertRaises(RuntimeError):
+            move(self.novel, 'parts', ["1"], before_tag="2", into_tag="2")
+        self.assertEqual(self.novel.parts, [second, first])
+        self.assertIsNone(second.parent)
+    
+    def testProjectLock(self):
+        from models import ProjectLock
+        lock = self.novel.project_lock()
+        before = lock.generation()
+        with self.novel.writing():
+            self.assertEqual(lock.generation() % 2, 1)
+            other = ProjectLock(self.novel.env)
+            self.assertTrue(other.held_elsewhere())
+            self.novel.write_plotlines()
+            self.novel.write_parts()
+        self.assertEqual(lock.generation(), before + 2)
+        self.assertFalse(ProjectLock(self.novel.env).held_elsewhere())
+        novel = Novel.load(self.proj_path)
+        self.assertEqual(novel.generation, before + 2)
+        self.assertEqual(len(novel.plotlines), 2)
+    
+    def testLocalPathsExcluded(self):
+        SearchIndex(self.novel).close()
+        self.novel.env.local_path('history')
+        status = self.novel.git_output('status', '--porcelain', '--',
+                                       '.novel')
+        self.assertEqual(status, '')
+    
+    def testWriterCommands(self):
+        self.assertTrue(writes(parser.parse_args(['archive'])))
+        self.assertTrue(writes(parser.parse_args(
+            ['config', '-k', 'chapter.ext', '-s', 'txt'])))
+        self.assertFalse(writes(parser.parse_args(
+            ['config', '-k', 'chapter.ext', '-g'])))
+        self.assertFalse(writes(parser.parse_args(['list', 'chapters'])))
+    
+    def testPostEditQueue(self):
+        import postedit
+        add_chapter(self.novel, "main", "Edited Later", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("edited in the editor\n")
+        queue = postedit.PostEditQueue(self.novel.env)
+        queue.add(chapter.path, "Edit %s" % chapter)
+        self.assertTrue(queue.pending())
+        self.assertTrue(queue.wait(timeout=30))
+        self.assertFalse(queue.pending())
+        status = self.novel.git_output('status', '--porcelain', '--',
+                                       chapter.path)
+        self.assertEqual(status, '')
+    
+    def testPostEditBeforeWriter(self):
+        import subprocess
+        import postedit
+        add_chapter(self.novel, "main", "Edited Before Archive", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("edited before archiving\n")
+        postedit.PostEditQueue(self.novel.env).add(chapter.path,
+                                                   "Edit %s" % chapter)
+        # The queue is drained before `archive` takes the lock.
+        subprocess.run([sys.executable,
+                        os.path.join(TestNovel.CURRDIR, "makenovel.py"),
+                        "archive"], cwd=self.proj_path, check=True,
+                       stdout=subprocess.DEVNULL, timeout=60)
+        self.assertFalse(postedit.PostEditQueue(self.novel.env).pending())
+        status = self.novel.git_output('status', '--porcelain', '--',
+                                       chapter.path)
+        self.assertEqual(status, '')
+    
+    def testPostEditBeforeAdd(self):
+        import subprocess
+        import postedit
+        add_chapter(self.novel, "main", "Edited Before Add", "1")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("edited before adding\n")
+        queue = postedit.PostEditQueue(self.novel.env)
+        # Queueing does not wait for the project lock.
+        with self.novel.project_lock():
+            queue.add(chapter.path, "Edit %s" % chapter)
+        subprocess.run([sys.executable,
+                        os.path.join(TestNovel.CURRDIR, "makenovel.py"),
+                        "add", "chapter", "-t", "Later", "-p", "main"],
+                       cwd=self.proj_path, check=True,
+                       stdout=subprocess.DEVNULL, timeout=60)
+        # The edit has a commit of its own, not the writer's.
+        log = self.novel.git_output('log', '--format=%s', '-1', '--',
+                                    chapter.path)
+        self.assertIn("Edit", log)
+    
+    def testRollups(self):
+        (first, second) = self.novel.parts
+        sub = Part(self.novel, "Sub", parent=first)
+        self.novel.parts.append(sub)
+        add_chapter(self.novel, "main", "Top", "1")
+        add_chapter(self.novel, "side", "Below", "1")
+        (top, below) = self.novel.chapters[-2:]
+        below.part = sub
+        for (chapter, text) in ((top, "one two"), (below, "three four five")):
+            with open(chapter.path, 'w') as f:
+                f.write(text)
+        tree = self.novel.index_parts()
+        self.assertEqual(tree.total(sub), (3, 15))
+        self.assertEqual(tree.total(first), (5, 22))
+        self.assertEqual(tree.total(second), (0, 0))
+        main = self.novel.find_plotline("main")
+        self.assertEqual(tree.total(main), (2, 7))
+        with open(below.path, 'w') as f:
+            f.write("six")
+        self.assertEqual(tree.recount(below), (1, 3))
+        self.assertEqual(tree.total(sub), (1, 3))
+        self.assertEqual(tree.total(first), (3, 10))
+        self.assertEqual(tree.total(self.novel.find_plotline("side")), (1, 3))
+        self.assertEqual(tree.total(main), (2, 7))
+    
+    def testFleet(self):
+        import io
+        import json
+        import tempfile
+        from fleet import find_projects, run_fleet
+        root = tempfile.mkdtemp()
+        try:
+            for name in ("one", "two"):
+                create_project(name, "Fleet %s" % name,
+                               path=os.path.join(root, "shelf", name))
+            os.makedirs(os.path.join(root, "empty"))
+            self.assertEqual([os.path.basename(p) for p in
+                              find_projects(root)], ["one", "two"])
+            out = io.StringIO()
+            self.assertEqual(run_fleet(root, 'stats', jobs=2, out=out), 0)
+            records = [json.loads(l) for l in out.getvalue().splitlines()]
+            self.assertEqual(sorted(r['title'] for r in records),
+                             ["Fleet one", "Fleet two"])
+            self.assertTrue(all(r['ok'] for r in records))
+        finally:
+            shutil.rmtree(root)
+    
+    def testCreateProjects(self):
+        import io
+        import json
+        import tempfile
+        import subprocess
+        from mnadmin import read_manifest, create_projects
+        root = tempfile.mkdtemp()
+        try:
+            manifest = os.path.join(root, "class.csv")
+            with open(manifest, 'w') as f:
+                f.write("# name,title,branch\nann,Ann's Book\nbob,Bob's Book,"
+                        "draft\n")
+            projects = read_manifest(manifest, os.path.join(root, "class"))
+            self.assertEqual(len(projects), 2)
+            out = io.StringIO()
+            self.assertEqual(create_projects(projects, jobs=2, out=out), 0)
+            records = [json.loads(l) for l in out.getvalue().splitlines()]
+            self.assertTrue(all(r['ok'] and 'seconds' in r for r in records))
+            bob = os.path.join(root, "class", "bob")
+            self.assertEqual(NovelEnvironment.load(bob).title, "Bob's Book")
+            log = subprocess.check_output(
+                ['git', '-C', bob, 'log', '--all', '--format=%s'],
+                universal_newlines=True)
+            self.assertEqual(log, "makenovel - create project `Bob's Book'\n")
+            self.assertEqual(create_projects(projects[:1], out=io.StringIO()),
+                             1)
+        finally:
+            shutil.rmtree(root)
+    
+    def testSnapshotCache(self):
+        add_chapter(self.novel, "main", "Cached", "1")
+        novel = Novel.load(self.proj_path)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.proj_path, ".novel", "cache", "snapshot")))
+        from_file = Chapter.from_file
+        def fail(Klass, novel):
+            raise AssertionError("chapters parsed despite the cache")
+        Chapter.from_file = classmethod(fail)
+        try:
+            cached = Novel.load(self.proj_path)
+        finally:
+            Chapter.from_file = from_file
+        self.assertEqual([c.tag for c in cached.chapters],
+                         [c.tag for c in novel.chapters])
+        chapter = cached.chapters[-1]
+        self.assertIs(chapter.novel, cached)
+        self.assertIs(chapter.part, cached.parts[0])
+        self.assertIs(chapter.plotline, cached.find_plotline("main"))
+        chapter.title = "Changed"
+        cached.write_chapters()
+        self.assertEqual(Novel.load(self.proj_path).chapters[-1].title,
+                         "Changed")
+    
+    def testFsck(self):
+        import fsck
+        for title in ("Kept", "Gone"):
+            add_chapter(self.novel, "main", title, "1")
+        (kept, gone) = self.novel.chapters[-2:]
+        with open(kept.path, 'w') as f:
+            f.write("kept text\n")
+        self.novel.git_add_files([kept.path, gone.path])
+        self.novel.git_commit_files([kept.path, gone.path], "Write chapters")
+        os.remove(gone.path)
+        shutil.copyfile(kept.path, os.path.join(self.proj_path, "main",
+                                                "99__copy.rst"))
+        with open(os.path.join(self.proj_path, "main", "98__lost.rst"),
+                  'w') as f:
+            f.write("only copy\n")
+        (novel, problems) = fsck.load(self.proj_path)
+        self.assertEqual(problems, [])
+        problems = fsck.check(novel, workers=2)
+        found = sorted((p.kind, os.path.basename(p.path)) for p in problems)
+        self.assertEqual(found, [('missing', gone.tag + ".rst"),
+                                 ('orphan', "98__lost.rst"),
+                                 ('orphan', "99__copy.rst")])
+        self.assertEqual(fsck.repair(novel, problems), 3)
+        self.assertTrue(os.path.exists(gone.path))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.proj_path, ".novel", fsck.LOST_FOUND, "main", "98__lost.rst")))
+        self.assertEqual(fsck.check(Novel.load(self.proj_path)), [])
+    
+    def testStatus(self):
+        from status import chapter_status, StatusManifest
+        for title in ("Same", "Edited", "Deleted"):
+            add_chapter(self.novel, "main", title, "1")
+        (same, edited, deleted) = self.novel.chapters[-3:]
+        paths = [same.path, edited.path, deleted.path]
+        self.novel.git_add_files(paths)
+        self.novel.git_commit_files(paths, "Add chapters")
+        self.assertEqual(chapter_status(self.novel), [])
+        new = Chapter(self.novel, self.novel.find_plotline("main"), "New")
+        self.novel.chapters.append(new)
+        with open(new.path, 'w') as f:
+            f.write("not committed\n")
+        with open(edited.path, 'w') as f:
+            f.write("new text\n")
+        os.remove(deleted.path)
+        expected = [('modified', edited), ('missing', deleted),
+                    ('untracked', new)]
+        self.assertEqual(chapter_status(self.novel), expected)
+        manifest = StatusManifest(self.novel.env)
+        self.assertIn(os.path.relpath(same.path, self.proj_path),
+                      manifest.files)
+        self.assertEqual(chapter_status(self.novel), expected)
+    
+    def testIterRender(self):
+        import io
+        import zipfile
+        add_chapter(self.novel, "main", "Streamed", "2")
+        chapter = self.novel.chapters[-1]
+        with open(chapter.path, 'w') as f:
+            f.write("streamed text\n")
+        head = self.novel.git_output('rev-parse', 'HEAD')
+        chunks = list(self.novel.iter_render('txt', parts=["2"]))
+        self.assertTrue(len(chunks) > 2)
+        text = ''.join(chunks)
+        self.assertIn("streamed text", text)
+        self.assertNotIn("Part 1", text)
+        epub = b''.join(self.novel.iter_render('epub'))
+        self.assertIsNone(zipfile.ZipFile(io.BytesIO(epub)).testzip())
+        self.assertEqual(self.novel.git_output('rev-parse', 'HEAD'), head)
+        self.assertEqual(len(self.novel.versions), 0)
+        with self.assertRaises(RuntimeError):
+            self.novel.iter_render('txt', parts=["9"])
+    
     """
     " Update
     """
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    """
+    @brief Report changed files using Linux inotify.
+
+    The directories holding the files are watched rather than the files
+    themselves, so editors that save by writing a new file and renaming it
+    over the old one are still seen.
+    """
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        libname = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = set(os.path.abspath(p) for p in paths)
+        self.dirs = {}
+        for d in set(os.path.dirname(p) for p in self.paths):
+            if not os.path.isdir(d):
+                continue
+            wd = libc.inotify_add_watch(self.fd, d.encode(), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "%s: cannot watch" % d)
+            self.dirs[wd] = d
+
+    def wait(self, timeout=None):
+        """
+        @brief Block for up to `timeout` seconds (forever if None).
+
+        :returns: set of watched paths that changed
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        i = 0
+        while i < len(buf):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(buf, i)
+            i += EVENT_HEADER.size
+            name = buf[i:i+length].rstrip(b'\0').decode()
+            i += length
+            path = os.path.join(self.dirs.get(wd, ''), name)
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class StatWatcher(object):
+    """
+    @brief Report changed files by polling `os.stat`.
+    """
+
+    def __init__(self, paths, interval=1.0):
+        self.interval = interval
+        self.stats = dict((os.path.abspath(p), None) for p in paths)
+        for p in self.stats:
+            self.stats[p] = self._stat(p)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def wait(self, timeout=None):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+        changed = set()
+        for (p, old) in self.stats.items():
+            new = self._stat(p)
+            if new != old:
+                self.stats[p] = new
+                changed.add(p)
+        return changed
+
+    def close(self):
+        pass
+
+def get_watcher(paths, poll=False, interval=1.0):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            logger.info("inotify unavailable (%s); polling instead" % e)
+    return StatWatcher(paths, interval)
+
+def recount(tree, chapters, paths):
+    """
+    @brief Recount the chapters at `paths` in the novel's part tree, which
+        applies the difference to the totals above them.
+
+    :param chapters: chapters by absolute path
+    :returns: list of (chapter, word delta) for the changed chapters
+    """
+    changes = []
+    for path in paths:
+        chapter = chapters.get(os.path.abspath(path))
+        if chapter is not None:
+            old = tree.count(chapter)[0]
+            changes.append((chapter, tree.recount(chapter)[0] - old))
+    return changes
+
+def status_line(tree, total, changes=()):
+    fields = ["%d words" % total]
+    (parts, plotlines) = ([], [])
+    for (chapter, delta) in changes:
+        fields.append("%s %+d" % (chapter.tag, delta))
+        part = chapter.part
+        while part is not None and part in tree.chapters:
+            if part not in parts:
+                parts.append(part)
+            part = part.parent
+        if chapter.plotline is not None and chapter.plotline not in plotlines:
+            plotlines.append(chapter.plotline)
+    for part in parts:
+        fields.append("part %s: %d" % (part.tag, tree.total(part)[0]))
+    for plotline in plotlines:
+        fields.append("%s: %d" % (plotline.tag, tree.total(plotline)[0]))
+    return ' | '.join(fields)
+
+def watch(novel, poll=False, debounce=0.5, interval=1.0, out=sys.stdout):
+    """
+    @brief Follow the novel's chapter files and print a status line after
+        every burst of changes.
+
+    Changes are collected until none has arrived for `debounce` seconds, then
+    each changed chapter is recounted once in the part tree (see
+    `PartTree.recount`). Chapters added after the watch
+    started are picked up the next time it is run.
+    """
+    tree = novel.part_tree()
+    tree.rollup()
+    chapters = dict((os.path.abspath(c.path), c) for c in novel.chapters)
+    total = sum(tree.count(c)[0] for c in novel.chapters)
+    watcher = get_watcher(list(chapters.keys()), poll, interval)
+    out.write("Watching %d chapters (%s). Press Ctrl-C to stop.\n" % (
+        len(chapters), type(watcher).__name__))
+    out.write("%s\n" % status_line(tree, total))
+    out.flush()
+    pending = set()
+    deadline = None
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(deadline - time.time(), 0)
+            changed = watcher.wait(timeout)
+            if changed:
+                pending |= changed
+                deadline = time.time() + debounce
+                continue
+            # The watcher also wakes up for other files in the same
+            # directories (editor swap files...), so check the time.
+            if pending and time.time() >= deadline:
+                changes = recount(tree, chapters, pending)
+                total += sum(delta for (chapter, delta) in changes)
+                pending = set()
+                out.write("[%s] %s\n" % (time.strftime('%H:%M:%S'),
+                                         status_line(tree, total, changes)))
+                out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return tree
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os
+import re
+import html
+import logging
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'\S+')
+
+def words(text):
+    return WORD_RE.findall(text)
+
+def _myers(a, b):
+    """
+    @brief Myers' O(ND) shortest edit script.
+
+    :returns: list of ('=', i, j), ('-', i, None) and ('+', None, j) edits in
+        order
+    """
+    (n, m) = (len(a), len(b))
+    v = {1: 0}
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return []
+
+def _backtrack(trace, x, y):
+    edits = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v.get(prev_k, 0)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            edits.append(('=', x - 1, y - 1))
+            x -= 1
+            y -= 1
+        if d > 0:
+            if x == prev_x:
+                edits.append(('+', None, y - 1))
+            else:
+                edits.append(('-', x - 1, None))
+        (x, y) = (prev_x, prev_y)
+    edits.reverse()
+    return edits
+
+def opcodes(a, b):
+    """
+    @brief Word-level diff of two token lists.
+
+    The common prefix and suffix are stripped before running Myers, so the
+    cost depends on the size of the change rather than the chapter.
+
+    :returns: list of (tag, i1, i2, j1, j2) as in `difflib`, with tags
+        'equal', 'delete', 'insert' and 'replace'
+    """
+    pre = 0
+    while pre < len(a) and pre < len(b) and a[pre] == b[pre]:
+        pre += 1
+    suf = 0
+    while (suf < len(a) - pre and suf < len(b) - pre and
+           a[len(a) - 1 - suf] == b[len(b) - 1 - suf]):
+        suf += 1
+
+    codes = []
+    if pre:
+        codes.append(['equal', 0, pre, 0, pre])
+    (i, j) = (pre, pre)
+    for (op, x, y) in _myers(a[pre:len(a) - suf], b[pre:len(b) - suf]):
+        tag = {'=': 'equal', '-': 'delete', '+': 'insert'}[op]
+        last = codes[-1] if codes else None
+        if last and (last[0] == tag or
+                     (tag != 'equal' and last[0] in ('delete', 'insert',
+                                                     'replace'))):
+            if last[0] != tag:
+                last[0] = 'replace'
+        else:
+            last = [tag, i, i, j, j]
+            codes.append(last)
+        if op in ('=', '-'):
+            i += 1
+            last[2] = i
+        if op in ('=', '+'):
+            j += 1
+            last[4] = j
+    if suf:
+        if codes and codes[-1][0] == 'equal':
+            codes[-1][2] += suf
+            codes[-1][4] += suf
+        else:
+            codes.append(['equal', i, i + suf, j, j + suf])
+    return [tuple(c) for c in codes]
+
+def hunks(codes, context=5):
+    """
+    @brief Group opcodes into hunks with `context` words around each change.
+    """
+    group = []
+    for (tag, i1, i2, j1, j2) in codes:
+        if tag == 'equal':
+            if group and i2 - i1 > 2 * context:
+                group.append((tag, i1, i1 + context, j1, j1 + context))
+                yield group
+                group = []
+                (i1, j1) = (i2 - context, j2 - context)
+            elif not group:
+                (i1, j1) = (max(i1, i2 - context), max(j1, j2 - context))
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def match_chapters(a, b):
+    """
+    @brief Pair up the chapters of two (path, title, blob id) lists.
+
+    Chapters are matched by path. A chapter missing from `b` whose blob
+    reappears under a new path is reported as moved.
+
+    :returns: (moved, pairs) where moved is a list of (old path, new path,
+        title) and pairs a list of (old path, new path, title, old blob,
+        new blob) for the chapters that changed; the old path is None for
+        added chapters and the new path None for removed ones
+    """
+    a_paths = dict((p, (t, h)) for (p, t, h) in a)
+    b_paths = dict((p, (t, h)) for (p, t, h) in b)
+
+    moved = []
+    pairs = []
+    removed = [(p, t, h) for (p, t, h) in a if p not in b_paths]
+    by_hash = {}
+    for (path, title, h) in removed:
+        if h:
+            by_hash.setdefault(h, []).append(path)
+    origins = set()
+    for (path, title, h) in b:
+        if path in a_paths:
+            if a_paths[path][1] != h:
+                pairs.append((path, path, title, a_paths[path][1], h))
+        elif h and by_hash.get(h):
+            origin = by_hash[h].pop(0)
+            origins.add(origin)
+            moved.append((origin, path, title))
+        else:
+            pairs.append((None, path, title, None, h))
+    for (path, title, h) in removed:
+        if path not in origins:
+            pairs.append((path, None, title, h, None))
+    return (moved, pairs)
+
+def _status(old_path, new_path):
+    if old_path is None:
+        return 'added'
+    elif new_path is None:
+        return 'removed'
+    return 'modified'
+
+def diff_versions(novel, old, new):
+    """
+    @brief Compare the chapters of two versions.
+
+    Chapters whose blob is the same in both versions are skipped without
+    being read. A chapter that only moved (same blob, different path) is
+    reported as moved. The rest are fetched through one `git cat-file`
+    process and diffed word by word.
+
+    :returns: list of (status, old path, new path, title, opcodes, old words,
+        new words) where status is 'added', 'removed', 'moved' or 'modified'
+    """
+    (moved, pairs) = match_chapters(old.chapter_manifest(),
+                                    new.chapter_manifest())
+    changes = [('moved', o, n, t, [], [], []) for (o, n, t) in moved]
+
+    blobs = []
+    for p in pairs:
+        blobs.extend([p[3], p[4]])
+    contents = novel.git_blobs(blobs)
+    for (old_path, new_path, title, a_hash, b_hash) in pairs:
+        a_words = words(next(contents).decode('utf-8', 'replace'))
+        b_words = words(next(contents).decode('utf-8', 'replace'))
+        changes.append((_status(old_path, new_path), old_path, new_path,
+                        title, opcodes(a_words, b_words), a_words, b_words))
+    contents.close()
+    return changes
+
+def changes_since(novel, version):
+    """
+    @brief Compare the chapters in the working tree with a version.
+
+    Current blob ids come from `Novel.chapter_hashes`, so unchanged chapters
+    are never read. For the others only the word counts are computed: the
+    old text from git, the new one from the chapter file.
+
+    :returns: list of (status, old path, new path, title, word delta) where
+        status is 'added', 'removed', 'moved' or 'modified'
+    """
+    (moved, pairs) = match_chapters(version.chapter_manifest(),
+                                    novel.chapter_hashes())
+    changes = [('moved', o, n, t, 0) for (o, n, t) in moved]
+
+    proj_path = novel.env.proj_path
+    contents = novel.git_blobs(p[3] for p in pairs)
+    for (old_path, new_path, title, a_hash, b_hash) in pairs:
+        before = len(words(next(contents).decode('utf-8', 'replace')))
+        after = 0
+        if new_path is not None and b_hash is not None:
+            with open(os.path.join(proj_path, new_path), errors='replace') as f:
+                after = len(words(f.read()))
+        changes.append((_status(old_path, new_path), old_path, new_path,
+                        title, after - before))
+    contents.close()
+    return changes
+
+def format_text(changes, context=5):
+    out = []
+    for (status, old_path, new_path, title, codes, a, b) in changes:
+        if status == 'moved':
+            out.append("moved: %s -> %s\n" % (old_path, new_path))
+            continue
+        out.append("%s: %s (%s)\n" % (status, new_path or old_path, title))
+        for hunk in hunks(codes, context):
+            out.append("@@ word %d @@\n" % (hunk[0][3] + 1))
+            line = []
+            for (tag, i1, i2, j1, j2) in hunk:
+                if tag == 'equal':
+                    line.append(' '.join(a[i1:i2]))
+                if tag in ('delete', 'replace'):
+                    line.append('[-%s-]' % ' '.join(a[i1:i2]))
+                if tag in ('insert', 'replace'):
+                    line.append('{+%s+}' % ' '.join(b[j1:j2]))
+            out.append(' '.join(l for l in line if l) + '\n')
+        out.append('\n')
+    return ''.join(out)
+
+def format_html(changes, context=5):
+    e = html.escape
+    out = ['<div class="diff">\n']
+    for (status, old_path, new_path, title, codes, a, b) in changes:
+        if status == 'moved':
+            out.append('<h2 class="moved">moved: %s &rarr; %s</h2>\n' % (
+                e(old_path), e(new_path)))
+            continue
+        out.append('<h2 class="%s">%s: %s</h2>\n' % (
+            status, status, e(title or new_path or old_path)))
+        for hunk in hunks(codes, context):
+            para = []
+            for (tag, i1, i2, j1, j2) in hunk:
+                if tag == 'equal':
+                    para.append(e(' '.join(a[i1:i2])))
+                if tag in ('delete', 'replace'):
+                    para.append('<del>%s</del>' % e(' '.join(a[i1:i2])))
+                if tag in ('insert', 'replace'):
+                    para.append('<ins>%s</ins>' % e(' '.join(b[j1:j2])))
+            out.append('<p>%s</p>\n' % ' '.join(p for p in para if p))
+    out.append('</div>\n')
+    return ''.join(out)